@@ -26,6 +26,10 @@ target_metadata = Base.metadata
 
 
 def get_url():
+    # a shard is migrated with alembic -x url=<its DSN> upgrade head
+    url = context.get_x_argument(as_dictionary=True).get("url")
+    if url:
+        return url
     user = os.getenv("POSTGRES_USER", "postgres")
     password = os.getenv("POSTGRES_PASSWORD", "")
     server = os.getenv("POSTGRES_SERVER", "db")
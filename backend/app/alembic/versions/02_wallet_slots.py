@@ -0,0 +1,41 @@
+"""Wallet slots
+
+Revision ID: 02
+Revises: 01
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "02"
+down_revision = "01"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "wallet",
+        sa.Column("slots", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.create_table(
+        "walletslot",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("wallet_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("slot", sa.Integer(), nullable=False),
+        sa.Column("amount", sa.Numeric(scale=2), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["wallet_id"],
+            ["wallet.wallet_id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("wallet_id", "slot"),
+    )
+
+
+def downgrade():
+    op.drop_table("walletslot")
+    op.drop_column("wallet", "slots")
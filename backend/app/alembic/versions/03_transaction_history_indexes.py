@@ -0,0 +1,73 @@
+"""Transaction history indexes
+
+Revision ID: 03
+Revises: 02
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "03"
+down_revision = "02"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the table is written all the time, don't block it while building;
+    # op.create_index can't render INCLUDE columns of a stub table
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY"
+            " ix_transaction_from_wallet_id_created_at_id"
+            " ON transaction (from_wallet_id, created_at, id)"
+            " INCLUDE (idempotency_key, amount, to_wallet_id,"
+            " from_wallet_amount)"
+        )
+        op.execute(
+            "CREATE INDEX CONCURRENTLY"
+            " ix_transaction_to_wallet_id_created_at_id"
+            " ON transaction (to_wallet_id, created_at, id)"
+            " INCLUDE (idempotency_key, amount, from_wallet_id,"
+            " to_wallet_amount)"
+        )
+        # the new indexes start with the same columns
+        op.drop_index(
+            "ix_transaction_to_wallet_id",
+            table_name="transaction",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_transaction_from_wallet_id",
+            table_name="transaction",
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_transaction_to_wallet_id",
+            "transaction",
+            ["to_wallet_id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_transaction_from_wallet_id",
+            "transaction",
+            ["from_wallet_id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_transaction_to_wallet_id_created_at_id",
+            table_name="transaction",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_transaction_from_wallet_id_created_at_id",
+            table_name="transaction",
+            postgresql_concurrently=True,
+        )
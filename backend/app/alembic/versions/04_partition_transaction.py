@@ -0,0 +1,208 @@
+"""Partition transaction by month
+
+Revision ID: 04
+Revises: 03
+Create Date: 2026-10-18 16:00:00.000000
+
+Downtime: the migration runs in one transaction and copies every row
+of the ledger to the new table. From the rename at its start to the
+commit, the old table is locked ACCESS EXCLUSIVE, so every request that
+reads or writes the ledger waits, or times out under
+DB_STATEMENT_TIMEOUT. Stop the workers for it and time it on a copy of
+the database first. The copy and the index builds take time in
+proportion to the ledger. Copying in batches would not help here: the
+lock is held until the commit all the same. A ledger too big to stop
+for has to be moved out of band, with the workers writing to both
+tables meanwhile.
+
+transaction_default takes the rows out of the monthly partitions. As
+long as it exists, app/db/partitions.py detaches the old months with a
+short ACCESS EXCLUSIVE lock rather than concurrently. Revision 09 drops
+it.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "04"
+down_revision = "03"
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    "id, idempotency_key, amount, from_wallet_id, from_wallet_amount,"
+    " to_wallet_id, to_wallet_amount, created_at"
+)
+
+
+def upgrade():
+    op.create_table(
+        "transactionkey",
+        sa.Column(
+            "idempotency_key", postgresql.UUID(as_uuid=True), nullable=False,
+        ),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("idempotency_key"),
+    )
+    op.create_index(
+        "ix_transactionkey_created_at",
+        "transactionkey",
+        ["created_at"],
+        unique=False,
+    )
+
+    # names of indexes are global, free them for the new table
+    op.execute("ALTER TABLE transaction RENAME TO transaction_unpartitioned")
+    for index in (
+        "transaction_pkey",
+        "transaction_idempotency_key_key",
+        "ix_transaction_from_wallet_id_created_at_id",
+        "ix_transaction_to_wallet_id_created_at_id",
+    ):
+        op.execute(
+            "ALTER INDEX {0} RENAME TO {0}_unpartitioned".format(index)
+        )
+
+    op.execute(
+        """
+        CREATE TABLE transaction (
+            id bigint NOT NULL DEFAULT nextval('transaction_id_seq'),
+            idempotency_key uuid,
+            amount numeric,
+            from_wallet_id uuid
+                CONSTRAINT transaction_from_wallet_id_fkey
+                REFERENCES wallet (wallet_id),
+            from_wallet_amount numeric,
+            to_wallet_id uuid
+                CONSTRAINT transaction_to_wallet_id_fkey
+                REFERENCES wallet (wallet_id),
+            to_wallet_amount numeric,
+            created_at timestamp NOT NULL,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+        """
+    )
+    op.execute("ALTER SEQUENCE transaction_id_seq AS bigint")
+    op.execute("ALTER SEQUENCE transaction_id_seq OWNED BY transaction.id")
+    op.execute(
+        "CREATE INDEX ix_transaction_idempotency_key"
+        " ON transaction (idempotency_key)"
+    )
+    op.execute(
+        "CREATE INDEX ix_transaction_from_wallet_id_created_at_id"
+        " ON transaction (from_wallet_id, created_at, id)"
+        " INCLUDE (idempotency_key, amount, to_wallet_id,"
+        " from_wallet_amount)"
+    )
+    op.execute(
+        "CREATE INDEX ix_transaction_to_wallet_id_created_at_id"
+        " ON transaction (to_wallet_id, created_at, id)"
+        " INCLUDE (idempotency_key, amount, from_wallet_id,"
+        " to_wallet_amount)"
+    )
+
+    # Rows out of the monthly partitions, e.g. backdated imports, land
+    # here. A month can't be created while it has rows in the default.
+    op.execute(
+        "CREATE TABLE transaction_default"
+        " PARTITION OF transaction DEFAULT"
+    )
+    op.execute(
+        """
+        CREATE FUNCTION transaction_create_partitions(
+            months_ahead integer, since timestamp DEFAULT NULL
+        ) RETURNS SETOF text AS $$
+        DECLARE
+            today timestamp := now() at time zone 'utc';
+            month timestamp := date_trunc('month', coalesce(since, today));
+            name text;
+        BEGIN
+            WHILE month <= today + make_interval(months => months_ahead) LOOP
+                name := 'transaction_' || to_char(month, '"y"YYYY"m"MM');
+                IF to_regclass(name) IS NULL THEN
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF transaction'
+                        ' FOR VALUES FROM (%L) TO (%L)',
+                        name, month, month + interval '1 month'
+                    );
+                    RETURN NEXT name;
+                END IF;
+                month := month + interval '1 month';
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE FUNCTION transaction_key_insert() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.idempotency_key IS NOT NULL THEN
+                INSERT INTO transactionkey (idempotency_key, created_at)
+                VALUES (NEW.idempotency_key, NEW.created_at);
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        "CREATE TRIGGER transaction_key BEFORE INSERT ON transaction"
+        " FOR EACH ROW EXECUTE FUNCTION transaction_key_insert()"
+    )
+
+    op.execute(
+        "SELECT transaction_create_partitions("
+        "3, (SELECT min(created_at) FROM transaction_unpartitioned))"
+    )
+    op.execute(
+        "INSERT INTO transaction ({0})"
+        " SELECT {0} FROM transaction_unpartitioned".format(COLUMNS)
+    )
+    op.drop_table("transaction_unpartitioned")
+
+
+def downgrade():
+    op.execute("ALTER TABLE transaction RENAME TO transaction_partitioned")
+    op.execute(
+        """
+        CREATE TABLE transaction (
+            id integer NOT NULL DEFAULT nextval('transaction_id_seq'),
+            idempotency_key uuid UNIQUE,
+            amount numeric,
+            from_wallet_id uuid REFERENCES wallet (wallet_id),
+            from_wallet_amount numeric,
+            to_wallet_id uuid REFERENCES wallet (wallet_id),
+            to_wallet_amount numeric,
+            created_at timestamp NOT NULL
+        )
+        """
+    )
+    op.execute(
+        "INSERT INTO transaction ({0})"
+        " SELECT {0} FROM transaction_partitioned".format(COLUMNS)
+    )
+    op.execute("ALTER SEQUENCE transaction_id_seq OWNED BY transaction.id")
+    op.drop_table("transaction_partitioned")
+    op.execute("ALTER SEQUENCE transaction_id_seq AS integer")
+    op.execute("ALTER TABLE transaction ADD PRIMARY KEY (id)")
+    op.execute(
+        "CREATE INDEX ix_transaction_from_wallet_id_created_at_id"
+        " ON transaction (from_wallet_id, created_at, id)"
+        " INCLUDE (idempotency_key, amount, to_wallet_id,"
+        " from_wallet_amount)"
+    )
+    op.execute(
+        "CREATE INDEX ix_transaction_to_wallet_id_created_at_id"
+        " ON transaction (to_wallet_id, created_at, id)"
+        " INCLUDE (idempotency_key, amount, from_wallet_id,"
+        " to_wallet_amount)"
+    )
+    op.execute("DROP FUNCTION transaction_key_insert()")
+    op.execute(
+        "DROP FUNCTION transaction_create_partitions(integer, timestamp)"
+    )
+    op.drop_index("ix_transactionkey_created_at", table_name="transactionkey")
+    op.drop_table("transactionkey")
@@ -0,0 +1,37 @@
+"""Reconciliation
+
+Revision ID: 05
+Revises: 04
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "05"
+down_revision = "04"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "reconciliationcheckpoint",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("last_transaction_id", sa.BigInteger(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "reconciliationbalance",
+        sa.Column("wallet_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("amount", sa.Numeric(scale=2), nullable=False),
+        sa.PrimaryKeyConstraint("wallet_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("reconciliationbalance")
+    op.drop_table("reconciliationcheckpoint")
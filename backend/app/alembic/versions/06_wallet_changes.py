@@ -0,0 +1,55 @@
+"""Wallet change notifications
+
+Revision ID: 06
+Revises: 05
+Create Date: 2026-10-18 20:00:00.000000
+
+Every ledger row NOTIFYs the balances it leaves its wallets with, on
+commit. Only connections that set paymarket.wallet_changes do, see
+WALLET_CHANGES_ENABLED.
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "06"
+down_revision = "05"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE FUNCTION transaction_notify_wallet_changes()
+        RETURNS trigger AS $$
+        BEGIN
+            IF NEW.from_wallet_id IS NOT NULL THEN
+                PERFORM pg_notify(
+                    'wallet_changes',
+                    NEW.from_wallet_id || ' ' || NEW.from_wallet_amount
+                );
+            END IF;
+            IF NEW.to_wallet_id IS NOT NULL THEN
+                PERFORM pg_notify(
+                    'wallet_changes',
+                    NEW.to_wallet_id || ' ' || NEW.to_wallet_amount
+                );
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    # the condition is checked without calling the function
+    op.execute(
+        "CREATE TRIGGER wallet_changes AFTER INSERT ON transaction"
+        " FOR EACH ROW"
+        " WHEN (current_setting('paymarket.wallet_changes', true) = 'on')"
+        " EXECUTE FUNCTION transaction_notify_wallet_changes()"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER wallet_changes ON transaction")
+    op.execute("DROP FUNCTION transaction_notify_wallet_changes()")
@@ -0,0 +1,64 @@
+"""Transfer requests
+
+Revision ID: 07
+Revises: 06
+Create Date: 2026-10-18 22:00:00.000000
+
+Transfers accepted by /v1/wallet/transfer/async, applied by
+app/transfer_worker.py.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "07"
+down_revision = "06"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "transferrequest",
+        sa.Column(
+            "idempotency_key", postgresql.UUID(as_uuid=True), nullable=False,
+        ),
+        sa.Column(
+            "from_wallet_id", postgresql.UUID(as_uuid=True), nullable=False,
+        ),
+        sa.Column(
+            "to_wallet_id", postgresql.UUID(as_uuid=True), nullable=False,
+        ),
+        sa.Column("amount", sa.Numeric(scale=2), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("status_code", sa.Integer(), nullable=True),
+        sa.Column("detail", sa.String(), nullable=True),
+        sa.Column("from_wallet_amount", sa.Numeric(scale=2), nullable=True),
+        sa.Column("processed_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("idempotency_key"),
+    )
+    op.create_index(
+        "ix_transferrequest_pending_created_at",
+        "transferrequest",
+        ["created_at"],
+        postgresql_where=sa.text("status_code IS NULL"),
+    )
+    op.create_index(
+        op.f("ix_transferrequest_processed_at"),
+        "transferrequest",
+        ["processed_at"],
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_transferrequest_processed_at"),
+        table_name="transferrequest",
+    )
+    op.drop_index(
+        "ix_transferrequest_pending_created_at",
+        table_name="transferrequest",
+    )
+    op.drop_table("transferrequest")
@@ -0,0 +1,52 @@
+"""Shard transfers
+
+Revision ID: 08
+Revises: 07
+Create Date: 2026-10-19 00:00:00.000000
+
+Cross-shard transfers debited on a shard and not credited yet on the
+other one, see SQLALCHEMY_SHARD_URIS.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "08"
+down_revision = "07"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "shardtransfer",
+        sa.Column(
+            "idempotency_key", postgresql.UUID(as_uuid=True), nullable=False,
+        ),
+        sa.Column(
+            "from_wallet_id", postgresql.UUID(as_uuid=True), nullable=False,
+        ),
+        sa.Column(
+            "to_wallet_id", postgresql.UUID(as_uuid=True), nullable=False,
+        ),
+        sa.Column("amount", sa.Numeric(scale=2), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("credited_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("idempotency_key"),
+    )
+    op.create_index(
+        "ix_shardtransfer_pending_created_at",
+        "shardtransfer",
+        ["created_at"],
+        postgresql_where=sa.text("credited_at IS NULL"),
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "ix_shardtransfer_pending_created_at",
+        table_name="shardtransfer",
+    )
+    op.drop_table("shardtransfer")
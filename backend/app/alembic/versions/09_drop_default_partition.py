@@ -0,0 +1,69 @@
+"""Drop the default partition of transaction
+
+Revision ID: 09
+Revises: 08
+Create Date: 2026-10-19 12:00:00.000000
+
+DETACH PARTITION CONCURRENTLY is refused while transaction has a
+default partition, see app/db/partitions.py. The rows of
+transaction_default move to monthly partitions of their own, built
+aside and attached, not to fire transaction_key again for keys it has
+already registered. Without the default, a row of a month with no
+partition is refused: maintenance create-partitions has to keep ahead
+of the clock, with --since for backdated rows.
+
+Downtime: transaction is locked ACCESS EXCLUSIVE until the commit,
+for as long as it takes to copy the rows of transaction_default.
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "09"
+down_revision = "08"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE transaction DETACH PARTITION transaction_default")
+    op.execute(
+        """
+        DO $$
+        DECLARE
+            month timestamp;
+            name text;
+        BEGIN
+            FOR month IN
+                SELECT DISTINCT date_trunc('month', created_at)
+                FROM transaction_default
+            LOOP
+                name := 'transaction_' || to_char(month, '"y"YYYY"m"MM');
+                EXECUTE format(
+                    'CREATE TABLE %I (LIKE transaction'
+                    ' INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                    name
+                );
+                EXECUTE format(
+                    'INSERT INTO %I SELECT * FROM transaction_default'
+                    ' WHERE created_at >= %L AND created_at < %L',
+                    name, month, month + interval '1 month'
+                );
+                EXECUTE format(
+                    'ALTER TABLE transaction ATTACH PARTITION %I'
+                    ' FOR VALUES FROM (%L) TO (%L)',
+                    name, month, month + interval '1 month'
+                );
+            END LOOP;
+        END
+        $$
+        """
+    )
+    op.drop_table("transaction_default")
+
+
+def downgrade():
+    op.execute(
+        "CREATE TABLE transaction_default"
+        " PARTITION OF transaction DEFAULT"
+    )
@@ -0,0 +1,35 @@
+"""Reconciliation archive
+
+Revision ID: 10
+Revises: 09
+Create Date: 2026-10-19 14:00:00.000000
+
+Sums of the detached partitions of transaction, for the rebuild of
+the reconciliation, see app/db/reconciliation.py.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "10"
+down_revision = "09"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "reconciliationarchive",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("partition", sa.String(), nullable=False),
+        sa.Column("wallet_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("amount", sa.Numeric(scale=2), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("partition", "wallet_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("reconciliationarchive")
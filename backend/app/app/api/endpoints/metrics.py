@@ -0,0 +1,17 @@
+from fastapi import APIRouter
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest
+
+from app.core import metrics
+
+router = APIRouter()
+
+
+@router.get('/metrics')
+def read_metrics():
+    # of all the worker processes in multiprocess mode
+    return Response(
+        generate_latest(metrics.registry()),
+        media_type=CONTENT_TYPE_LATEST,
+    )
@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+
+from app.core import stats
+
+router = APIRouter()
+
+
+@router.get('/stats')
+def read_stats():
+    # counters are per worker process
+    return stats.snapshot()
@@ -0,0 +1,80 @@
+import uuid
+from typing import AsyncIterator
+from typing import List
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.core.metrics import MeasuredRoute
+from app.core.responses import encode_json
+from app.db.helper import DBHelper
+from app.db.session import DBSessionMaker
+from app.db.wallet_changes import Subscription
+from app.db.wallet_changes import wallet_changes
+from app.schemas import Amount
+from app.schemas import WalletResponse
+
+router = APIRouter(route_class=MeasuredRoute)
+
+
+def _balances(wallet_ids: List[uuid.UUID]) -> List[WalletResponse]:
+    # from the primary, a replica may be behind the notifications
+    db = DBSessionMaker()
+    try:
+        return DBHelper.wallet_balances(db, wallet_ids)
+    finally:
+        db.close()
+
+
+def _event(balance: WalletResponse) -> str:
+    return 'event: balance\ndata: {}\n\n'.format(encode_json(balance))
+
+
+async def _events(
+        balances: List[WalletResponse],
+        subscription: Subscription,
+) -> AsyncIterator[str]:
+    try:
+        for balance in balances:
+            yield _event(balance)
+        while True:
+            changed = await subscription.changes(
+                settings.WALLET_CHANGES_KEEPALIVE,
+            )
+            if subscription.lost:
+                # the client reconnects and reads the balances again
+                return
+            if not changed:
+                # keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+            for wallet_id, amount in changed.items():
+                yield _event(WalletResponse.construct(
+                    wallet_id=wallet_id, amount=Amount.validate(amount),
+                ))
+    finally:
+        wallet_changes.unsubscribe(subscription)
+
+
+@router.get('/v1/wallet/changes')
+async def v1_wallet_changes(wallet_id: List[uuid.UUID] = Query(...)):
+    """Server-sent events of the balances of the wallets: the current
+    ones first, then every change."""
+    if len(wallet_id) > settings.WALLET_CHANGES_MAX_WALLETS:
+        raise HTTPException(status_code=400, detail='Too many wallets')
+
+    # subscribed before reading, so no change falls in between
+    subscription = wallet_changes.subscribe(wallet_id)
+    try:
+        balances = await run_in_threadpool(_balances, wallet_id)
+    except Exception:
+        wallet_changes.unsubscribe(subscription)
+        raise
+    return StreamingResponse(
+        _events(balances, subscription),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
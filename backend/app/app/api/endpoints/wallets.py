@@ -4,16 +4,46 @@ from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import HTTPException
 from fastapi import Header
+from fastapi import Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
+from app.core.admission import admitted
+from app.core.config import settings
+from app.core.metrics import MeasuredRoute
+from app.core.responses import FastJSONRoute
+from app.db import transfer_queue
+from app.db.core_helper import CoreDBHelper
 from app.db.session import get_db_session
+from app.db.session import get_read_db_session
+from app.db.session import replica_session
 from app.db.helper import DBHelper
+from app.db.sharded_helper import ShardedDBHelper
+from app.schemas import WalletCreateBatchRequest
+from app.schemas import WalletCreateBatchResponse
+from app.schemas import WalletGetBatchRequest
+from app.schemas import WalletGetBatchResponse
 from app.schemas import WalletGetRequest
 from app.schemas import WalletResponse
 from app.schemas import WalletDonateRequest
 from app.schemas import WalletTransferRequest
+from app.schemas import WalletSlotsRequest
+from app.schemas import WalletTransferBatchRequest
+from app.schemas import WalletTransferBatchResponse
+from app.schemas import WalletTransferAcceptedResponse
+from app.schemas import WalletTransferStatus
+from app.schemas import WalletTransferStatusRequest
+from app.schemas import WalletTransferStatusResponse
+from app.schemas import WalletTransactionsRequest
+from app.schemas import WalletTransactionsResponse
 
-router = APIRouter()
+route_class = FastJSONRoute if settings.FAST_JSON_RESPONSES else MeasuredRoute
+if settings.ADMISSION_ENABLED:
+    route_class = admitted(route_class)
+router = APIRouter(route_class=route_class)
+helper = CoreDBHelper if settings.WALLET_CORE_STATEMENTS else DBHelper
+if settings.SQLALCHEMY_SHARD_URIS:
+    helper = ShardedDBHelper
 
 
 @router.post('/v1/wallet/create', response_model=WalletResponse)
@@ -21,15 +51,34 @@ def v1_wallet_create(
     db: Session = Depends(get_db_session),
     idempotency_key: uuid.UUID = Header(...),
 ):
-    return DBHelper.wallet_create(db, idempotency_key)
+    return helper.wallet_create(db, idempotency_key)
+
+
+@router.post(
+    '/v1/wallet/create/batch',
+    response_model=WalletCreateBatchResponse,
+)
+def v1_wallet_create_batch(
+    request: WalletCreateBatchRequest,
+    db: Session = Depends(get_db_session),
+):
+    return helper.wallet_create_batch(db, request)
 
 
 @router.post('/v1/wallet/get', response_model=WalletResponse)
 def v1_wallet_get(
     request: WalletGetRequest,
-    db: Session = Depends(get_db_session),
+    db: Session = Depends(get_read_db_session),
+):
+    return helper.wallet_get(db, request.wallet_id)
+
+
+@router.post('/v1/wallet/get/batch', response_model=WalletGetBatchResponse)
+def v1_wallet_get_batch(
+    request: WalletGetBatchRequest,
+    db: Session = Depends(get_read_db_session),
 ):
-    return DBHelper.wallet_get(db, request.wallet_id)
+    return helper.wallet_get_batch(db, request)
 
 
 @router.post('/v1/wallet/donate', response_model=WalletResponse)
@@ -38,7 +87,7 @@ def v1_wallet_donate(
     idempotency_key: uuid.UUID = Header(...),
     db: Session = Depends(get_db_session),
 ):
-    return DBHelper.wallet_donate(db, idempotency_key, request)
+    return helper.wallet_donate(db, idempotency_key, request)
 
 
 @router.post('/v1/wallet/transfer', response_model=WalletResponse)
@@ -52,4 +101,116 @@ def v1_wallet_transfer(
             status_code=400,
             detail='self-transfer is not possible',
         )
-    return DBHelper.wallet_transfer(db, idempotency_key, request)
+    return helper.wallet_transfer(db, idempotency_key, request)
+
+
+@router.post(
+    '/v1/wallet/transfer/batch',
+    response_model=WalletTransferBatchResponse,
+)
+def v1_wallet_transfer_batch(
+    request: WalletTransferBatchRequest,
+    db: Session = Depends(get_db_session),
+):
+    return helper.wallet_transfer_batch(db, request)
+
+
+@router.post(
+    '/v1/wallet/transfer/async',
+    response_model=WalletTransferAcceptedResponse,
+    status_code=202,
+)
+def v1_wallet_transfer_async(
+    request: WalletTransferRequest,
+    response: Response,
+    idempotency_key: uuid.UUID = Header(...),
+    db: Session = Depends(get_db_session),
+):
+    if request.from_wallet_id == request.to_wallet_id:
+        raise HTTPException(
+            status_code=400,
+            detail='self-transfer is not possible',
+        )
+    if settings.SQLALCHEMY_SHARD_URIS:
+        raise HTTPException(
+            status_code=501,
+            detail='asynchronous transfers are not sharded',
+        )
+    transfer_queue.enqueue(db, idempotency_key, request)
+
+    status_url = '/v1/wallet/transfer/status/{}'.format(idempotency_key)
+    # FastJSONRoute answers with the status of the response parameter
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return WalletTransferAcceptedResponse(
+        idempotency_key=idempotency_key,
+        status_url=status_url,
+    )
+
+
+@router.get(
+    '/v1/wallet/transfer/status/{idempotency_key}',
+    response_model=WalletTransferStatus,
+)
+def v1_wallet_transfer_status(
+    idempotency_key: uuid.UUID,
+    db: Session = Depends(get_db_session),
+):
+    status, = transfer_queue.statuses(db, [idempotency_key])
+    if status.status == 'unknown':
+        raise HTTPException(status_code=404, detail='transfer is not found')
+    return status
+
+
+@router.post(
+    '/v1/wallet/transfer/status',
+    response_model=WalletTransferStatusResponse,
+)
+def v1_wallet_transfer_status_batch(
+    request: WalletTransferStatusRequest,
+    db: Session = Depends(get_db_session),
+):
+    return WalletTransferStatusResponse(
+        results=transfer_queue.statuses(db, request.idempotency_keys),
+    )
+
+
+@router.post('/v1/wallet/slots', response_model=WalletResponse)
+def v1_wallet_slots(
+    request: WalletSlotsRequest,
+    db: Session = Depends(get_db_session),
+):
+    return helper.wallet_set_slots(db, request)
+
+
+@router.post(
+    '/v1/wallet/transactions',
+    response_model=WalletTransactionsResponse,
+)
+def v1_wallet_transactions(
+    request: WalletTransactionsRequest,
+    db: Session = Depends(get_read_db_session),
+):
+    return helper.wallet_transactions(db, request)
+
+
+@router.post('/v1/wallet/transactions/export')
+def v1_wallet_transactions_export(
+    request: WalletGetRequest,
+    db: Session = Depends(get_read_db_session),
+):
+    helper.wallet_check(db, request.wallet_id)
+
+    def _lines():
+        # the response outlives the request dependencies, so the stream
+        # reads from a session of its own
+        export_db = replica_session()
+        try:
+            for transaction in helper.wallet_transactions_export(
+                export_db, request.wallet_id,
+            ):
+                yield transaction.json() + '\n'
+        finally:
+            export_db.close()
+
+    return StreamingResponse(_lines(), media_type='application/x-ndjson')
@@ -0,0 +1,64 @@
+import uuid
+
+from fastapi import APIRouter
+from fastapi import Depends
+from fastapi import HTTPException
+from fastapi import Header
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.admission import admitted
+from app.core.config import settings
+from app.core.metrics import MeasuredRoute
+from app.core.responses import FastJSONRoute
+from app.db.session import get_async_db_session
+from app.db.async_helper import AsyncDBHelper
+from app.schemas import WalletGetRequest
+from app.schemas import WalletResponse
+from app.schemas import WalletDonateRequest
+from app.schemas import WalletTransferRequest
+
+route_class = FastJSONRoute if settings.FAST_JSON_RESPONSES else MeasuredRoute
+if settings.ADMISSION_ENABLED:
+    route_class = admitted(route_class)
+# The same API as in wallets.router, the sync routes still describe it
+# in the OpenAPI schema.
+router = APIRouter(include_in_schema=False, route_class=route_class)
+
+
+@router.post('/v1/wallet/create', response_model=WalletResponse)
+async def v1_wallet_create(
+    db: AsyncSession = Depends(get_async_db_session),
+    idempotency_key: uuid.UUID = Header(...),
+):
+    return await AsyncDBHelper.wallet_create(db, idempotency_key)
+
+
+@router.post('/v1/wallet/get', response_model=WalletResponse)
+async def v1_wallet_get(
+    request: WalletGetRequest,
+    db: AsyncSession = Depends(get_async_db_session),
+):
+    return await AsyncDBHelper.wallet_get(db, request.wallet_id)
+
+
+@router.post('/v1/wallet/donate', response_model=WalletResponse)
+async def v1_wallet_donate(
+    request: WalletDonateRequest,
+    idempotency_key: uuid.UUID = Header(...),
+    db: AsyncSession = Depends(get_async_db_session),
+):
+    return await AsyncDBHelper.wallet_donate(db, idempotency_key, request)
+
+
+@router.post('/v1/wallet/transfer', response_model=WalletResponse)
+async def v1_wallet_transfer(
+    request: WalletTransferRequest,
+    idempotency_key: uuid.UUID = Header(...),
+    db: AsyncSession = Depends(get_async_db_session),
+):
+    if request.from_wallet_id == request.to_wallet_id:
+        raise HTTPException(
+            status_code=400,
+            detail='self-transfer is not possible',
+        )
+    return await AsyncDBHelper.wallet_transfer(db, idempotency_key, request)
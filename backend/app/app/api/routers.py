@@ -1,8 +1,20 @@
 from fastapi import APIRouter
 
+from app.api.endpoints import wallet_changes
 from app.api.endpoints import wallets
+from app.api.endpoints import wallets_async
 from app.api.endpoints import homepage
+from app.api.endpoints import metrics
+from app.api.endpoints import stats
+from app.core.config import settings
 
 api_router = APIRouter()
+if settings.DB_ASYNC:
+    # matched first, so these take over the same paths of wallets.router
+    api_router.include_router(wallets_async.router)
 api_router.include_router(wallets.router)
+if settings.WALLET_CHANGES_ENABLED:
+    api_router.include_router(wallet_changes.router)
 api_router.include_router(homepage.router)
+api_router.include_router(stats.router)
+api_router.include_router(metrics.router)
@@ -0,0 +1,446 @@
+"""Load test the API against the local database.
+
+Starts the app with uvicorn, creates and funds the wallets, then drives
+every scenario for the given time with concurrent clients. The results
+are written as JSON, so runs of two commits can be compared:
+
+    python /app/app/benchmark.py run --output before.json
+    python /app/app/benchmark.py run --env WALLET_SINGLE_STATEMENT=true \\
+        --scenario uniform_transfers --output after.json
+    python /app/app/benchmark.py compare before.json after.json
+
+Rates of retries, aborts and round trips come from /metrics, they are
+of the whole app. It writes to the database, use a disposable one.
+"""
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import fnmatch
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+AMOUNT = '0.01'
+FUNDS = '1000'
+# requests sent with the same key by the retry storm
+RETRY_STORM_REPEATS = 10
+# share of the reads of the polling scenario
+POLLING_READS = 0.95
+
+Request = Tuple[str, Dict[str, Any], Optional[Dict[str, str]]]
+
+
+class State:
+    """Wallets of the run and what the scenarios derive from them."""
+
+    def __init__(self, wallet_ids: List[str], zipf_s: float) -> None:
+        self.wallet_ids = wallet_ids
+        self.zipf_cum_weights = list(itertools.accumulate(
+            1 / rank ** zipf_s for rank in range(1, len(wallet_ids) + 1)
+        ))
+        self.run_id = uuid.uuid4()
+        self.retry_counter = itertools.count()
+
+    def zipf_wallet(self, rng: random.Random) -> str:
+        # wallet_ids[0] is the hottest one
+        position = bisect.bisect(
+            self.zipf_cum_weights, rng.random() * self.zipf_cum_weights[-1],
+        )
+        return self.wallet_ids[min(position, len(self.wallet_ids) - 1)]
+
+
+def _new_key() -> Dict[str, str]:
+    return {'Idempotency-Key': str(uuid.uuid4())}
+
+
+def _transfer(from_wallet_id: str, to_wallet_id: str) -> Dict[str, Any]:
+    return {
+        'from_wallet_id': from_wallet_id,
+        'to_wallet_id': to_wallet_id,
+        'amount': AMOUNT,
+    }
+
+
+def uniform_transfers(state: State, rng: random.Random) -> Request:
+    from_wallet_id, to_wallet_id = rng.sample(state.wallet_ids, 2)
+    return (
+        '/v1/wallet/transfer',
+        _transfer(from_wallet_id, to_wallet_id),
+        _new_key(),
+    )
+
+
+def zipf_transfers(state: State, rng: random.Random) -> Request:
+    from_wallet_id = state.zipf_wallet(rng)
+    to_wallet_id = from_wallet_id
+    while to_wallet_id == from_wallet_id:
+        to_wallet_id = state.zipf_wallet(rng)
+    return (
+        '/v1/wallet/transfer',
+        _transfer(from_wallet_id, to_wallet_id),
+        _new_key(),
+    )
+
+
+def donation_storm(state: State, rng: random.Random) -> Request:
+    return (
+        '/v1/wallet/donate',
+        {'wallet_id': state.wallet_ids[0], 'amount': AMOUNT},
+        _new_key(),
+    )
+
+
+def read_polling(state: State, rng: random.Random) -> Request:
+    wallet_id = rng.choice(state.wallet_ids)
+    if rng.random() < POLLING_READS:
+        return '/v1/wallet/get', {'wallet_id': wallet_id}, None
+    return (
+        '/v1/wallet/donate',
+        {'wallet_id': wallet_id, 'amount': AMOUNT},
+        _new_key(),
+    )
+
+
+def retry_storm(state: State, rng: random.Random) -> Request:
+    # every transfer is sent RETRY_STORM_REPEATS times, concurrently by
+    # different clients, with the same key and body
+    number = next(state.retry_counter) // RETRY_STORM_REPEATS
+    transfer_rng = random.Random(number)
+    from_wallet_id, to_wallet_id = transfer_rng.sample(state.wallet_ids, 2)
+    key = uuid.uuid5(state.run_id, str(number))
+    return (
+        '/v1/wallet/transfer',
+        _transfer(from_wallet_id, to_wallet_id),
+        {'Idempotency-Key': str(key)},
+    )
+
+
+SCENARIOS: Dict[str, Callable[[State, random.Random], Request]] = dict(
+    uniform_transfers=uniform_transfers,
+    zipf_transfers=zipf_transfers,
+    donation_storm=donation_storm,
+    read_polling=read_polling,
+    retry_storm=retry_storm,
+)
+
+
+def start_app(port: int, workers: int, env: Dict[str, str]):
+    """Run the app in uvicorn workers, metrics summed over all of them."""
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'uvicorn', 'app.main:app',
+            '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(workers), '--no-access-log',
+        ],
+        env=dict(
+            os.environ,
+            PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp(prefix='benchmark'),
+            **env,
+        ),
+    )
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(300):
+        try:
+            if requests.get(base_url + '/stats').ok:
+                return process, base_url
+        except requests.ConnectionError:
+            pass
+        if process.poll() is not None:
+            raise RuntimeError('the app has exited')
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('the app has not started')
+
+
+def create_wallets(base_url: str, count: int, concurrency: int) -> List[str]:
+    wallet_ids = []
+    for start in range(0, count, 1000):
+        response = requests.post(
+            base_url + '/v1/wallet/create/batch',
+            json={'idempotency_keys': [
+                str(uuid.uuid4()) for _ in range(min(1000, count - start))
+            ]},
+        )
+        response.raise_for_status()
+        wallet_ids.extend(
+            wallet['wallet_id'] for wallet in response.json()['wallets']
+        )
+
+    def fund(wallet_id: str) -> None:
+        requests.post(
+            base_url + '/v1/wallet/donate',
+            json={'wallet_id': wallet_id, 'amount': FUNDS},
+            headers=_new_key(),
+        ).raise_for_status()
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(fund, wallet_ids))
+    return wallet_ids
+
+
+def read_events(base_url: str) -> Dict[str, float]:
+    """paymarket_events_total as {'namespace.event': value}."""
+    events = {}
+    text = requests.get(base_url + '/metrics').text
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            if sample.name == 'paymarket_events_total':
+                events['{namespace}.{event}'.format(
+                    **sample.labels,
+                )] = sample.value
+    return events
+
+
+def drive(
+        base_url: str,
+        scenario: Callable[[State, random.Random], Request],
+        state: State,
+        concurrency: int,
+        duration: float,
+        seed: int,
+) -> Tuple[List[float], collections.Counter, float]:
+    """Send requests until the time is up, returns latencies in seconds,
+    counts by status and the elapsed time."""
+    deadline = time.monotonic() + duration
+
+    def client(index: int) -> Tuple[List[float], collections.Counter]:
+        rng = random.Random(seed * 1000 + index)
+        latencies = []
+        statuses: collections.Counter = collections.Counter()
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                path, body, headers = scenario(state, rng)
+                started_at = time.perf_counter()
+                try:
+                    status = str(session.post(
+                        base_url + path, json=body, headers=headers,
+                    ).status_code)
+                except requests.RequestException:
+                    status = 'error'
+                latencies.append(time.perf_counter() - started_at)
+                statuses[status] += 1
+        return latencies, statuses
+
+    started_at = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+
+    latencies = sorted(itertools.chain(*(result[0] for result in results)))
+    statuses = sum(
+        (result[1] for result in results), collections.Counter(),
+    )
+    return latencies, statuses, elapsed
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest rank percentile of the sorted values."""
+    if not values:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def summarize(
+        latencies: List[float],
+        statuses: collections.Counter,
+        elapsed: float,
+        events: Dict[str, float],
+) -> Dict[str, Any]:
+    requests_count = len(latencies) or 1
+
+    def per_request(*patterns: str) -> float:
+        return sum(
+            value for name, value in events.items()
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+        ) / requests_count
+
+    return dict(
+        requests=len(latencies),
+        seconds=round(elapsed, 3),
+        throughput=round(len(latencies) / elapsed, 1),
+        latency_ms={
+            name: round(percentile(latencies, percent) * 1000, 2)
+            for name, percent in (
+                ('p50', 50), ('p95', 95), ('p99', 99), ('max', 100),
+            )
+        },
+        statuses=dict(statuses),
+        retries_per_request=per_request('transfer.retries'),
+        aborts_per_request=per_request('transfer.*_aborts'),
+        retries_exhausted=per_request('transfer.retries_exhausted'),
+        idempotent_replays_per_request=per_request(
+            'idempotency.cache_hits', 'idempotency.lookup_hits',
+        ),
+        integrity_error_rollbacks_per_request=per_request(
+            'idempotency.conflicts', '*integrity_errors',
+        ),
+        db_round_trips_per_request=per_request(
+            'db.statements', 'db.commits', 'db.rollbacks',
+        ),
+        events=events,
+    )
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    env = dict(item.split('=', 1) for item in args.env)
+    process, base_url = (
+        (None, args.url.rstrip('/')) if args.url
+        else start_app(args.port, args.workers, env)
+    )
+    try:
+        logger.info('Creating %s wallets', args.wallets)
+        state = State(
+            create_wallets(base_url, args.wallets, args.concurrency),
+            args.zipf_s,
+        )
+
+        results = {}
+        for name in args.scenario or SCENARIOS:
+            logger.info('Running %s for %ss', name, args.duration)
+            before = read_events(base_url)
+            latencies, statuses, elapsed = drive(
+                base_url, SCENARIOS[name], state,
+                args.concurrency, args.duration, args.seed,
+            )
+            after = read_events(base_url)
+            results[name] = summarize(latencies, statuses, elapsed, {
+                event: value - before.get(event, 0)
+                for event, value in after.items()
+                if value != before.get(event, 0)
+            })
+            logger.info(
+                '%s: %s req/s, p50 %s ms, p99 %s ms, %.2f round trips',
+                name,
+                results[name]['throughput'],
+                results[name]['latency_ms']['p50'],
+                results[name]['latency_ms']['p99'],
+                results[name]['db_round_trips_per_request'],
+            )
+    finally:
+        if process:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        commit=commit,
+        started_at=datetime.datetime.utcnow().isoformat(),
+        options=dict(
+            wallets=args.wallets,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            workers=args.workers,
+            zipf_s=args.zipf_s,
+            seed=args.seed,
+            env=env,
+        ),
+        scenarios=results,
+    )
+
+
+def _change(old: float, new: float) -> str:
+    change = '{:+.0%}'.format((new - old) / old) if old else 'n/a'
+    return '{:.4g} -> {:.4g} ({})'.format(old, new, change)
+
+
+def compare(before: Dict[str, Any], after: Dict[str, Any]) -> None:
+    print('{:<20}{:>28}{:>28}{:>28}'.format(
+        'scenario', 'req/s', 'p99 ms', 'round trips per request',
+    ))
+    for name, result in after['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if old:
+            print('{:<20}{:>28}{:>28}{:>28}'.format(
+                name,
+                _change(old['throughput'], result['throughput']),
+                _change(
+                    old['latency_ms']['p99'], result['latency_ms']['p99'],
+                ),
+                _change(
+                    old['db_round_trips_per_request'],
+                    result['db_round_trips_per_request'],
+                ),
+            ))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the scenarios')
+    run_parser.add_argument(
+        '--scenario', action='append', choices=SCENARIOS,
+        help='may be repeated, all of them by default',
+    )
+    run_parser.add_argument('--wallets', type=int, default=1000)
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument(
+        '--duration', type=float, default=10.0, help='seconds per scenario',
+    )
+    run_parser.add_argument('--workers', type=int, default=2)
+    run_parser.add_argument('--port', type=int, default=8765)
+    run_parser.add_argument(
+        '--env', action='append', default=[], metavar='NAME=VALUE',
+        help='setting of the started app, may be repeated',
+    )
+    run_parser.add_argument(
+        '--url', help='drive a running app instead of starting one',
+    )
+    run_parser.add_argument('--zipf-s', type=float, default=1.1)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='JSON file, stdout by default')
+
+    compare_parser = commands.add_parser(
+        'compare', help='compare the results of two runs',
+    )
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        with open(args.before) as before, open(args.after) as after:
+            compare(json.load(before), json.load(after))
+        return
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Compare the CPU time per request of DBHelper and CoreDBHelper.
+
+DBHelper runs with the default settings, on the ORM. CoreDBHelper
+reads and creates wallets by its Core statements, and donates and
+transfers by the single statements, so those two also take fewer
+round trips than on the ORM: the wall time tells that part apart.
+
+Every request runs in a session of its own, as the endpoints do. The
+wallets and transactions it makes are left in the database, so run it
+against a disposable one:
+
+    python /app/app/benchmark_helpers.py --requests 2000
+"""
+import argparse
+import decimal
+import time
+import uuid
+from typing import Callable
+from typing import Dict
+from typing import Tuple
+
+from sqlalchemy.orm import Session
+
+from app.db.core_helper import CoreDBHelper
+from app.db.helper import DBHelper
+from app.db.session import DBSessionMaker
+from app.schemas import WalletDonateRequest
+from app.schemas import WalletTransferRequest
+
+HELPERS = (DBHelper, CoreDBHelper)
+OPERATIONS = ('create', 'get', 'donate', 'transfer')
+
+
+def measure(
+        requests: int,
+        call: Callable[[Session, int], object],
+) -> Tuple[float, float]:
+    """CPU and wall time of one request, in microseconds."""
+    cpu_started_at = time.process_time()
+    started_at = time.perf_counter()
+    for i in range(requests):
+        db = DBSessionMaker()
+        try:
+            call(db, i)
+        finally:
+            db.close()
+    return (
+        (time.process_time() - cpu_started_at) / requests * 1e6,
+        (time.perf_counter() - started_at) / requests * 1e6,
+    )
+
+
+def operations(helper) -> Dict[str, Callable[[Session, int], object]]:
+    db = DBSessionMaker()
+    try:
+        wallet_id = helper.wallet_create(db, uuid.uuid4()).wallet_id
+        other_wallet_id = helper.wallet_create(db, uuid.uuid4()).wallet_id
+        # enough for every transfer
+        helper.wallet_donate(db, uuid.uuid4(), WalletDonateRequest(
+            wallet_id=wallet_id, amount=decimal.Decimal(10 ** 9),
+        ))
+    finally:
+        db.close()
+
+    # the requests are parsed by the endpoints, the same for both
+    donate = WalletDonateRequest(wallet_id=other_wallet_id, amount=1)
+    transfer = WalletTransferRequest(
+        from_wallet_id=wallet_id, to_wallet_id=other_wallet_id, amount=1,
+    )
+    return dict(
+        create=lambda db, i: helper.wallet_create(db, uuid.uuid4()),
+        get=lambda db, i: helper.wallet_get(db, wallet_id),
+        donate=lambda db, i: helper.wallet_donate(db, uuid.uuid4(), donate),
+        transfer=lambda db, i: helper.wallet_transfer(
+            db, uuid.uuid4(), transfer,
+        ),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument(
+        '--warmup', type=int, default=100,
+        help='requests made first and not measured',
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for helper in HELPERS:
+        for name, call in operations(helper).items():
+            measure(args.warmup, call)
+            results[helper.__name__, name] = measure(args.requests, call)
+
+    print('{:<10}{:>22}{:>22}{:>8}'.format(
+        'request', 'cpu us (ORM / Core)', 'wall us (ORM / Core)', 'cpu %',
+    ))
+    for name in OPERATIONS:
+        orm_cpu, orm_wall = results[DBHelper.__name__, name]
+        core_cpu, core_wall = results[CoreDBHelper.__name__, name]
+        print('{:<10}{:>22}{:>22}{:>8.0f}'.format(
+            name,
+            '{:.0f} / {:.0f}'.format(orm_cpu, core_cpu),
+            '{:.0f} / {:.0f}'.format(orm_wall, core_wall),
+            core_cpu / orm_cpu * 100,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Admission control of the wallet routes, see ADMISSION_ENABLED.
+
+A worker handles at most max_in_flight requests at once, about what
+its DB pool can serve: more would only wait for a connection, holding
+their threads, and make every other request late too. The next ones
+wait in a bounded queue for a short while and are rejected after it,
+and so are donations and transfers of a wallet that has enough of them
+in flight already, piling up on its row lock. A rejection is a 429 with
+Retry-After, cheap for the worker and clear for the client.
+
+All of it runs on the event loop of the worker, so plain counters do
+without locks.
+"""
+import asyncio
+import collections
+import json
+import time
+import uuid
+from typing import Callable
+from typing import Counter as CounterType
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Type
+
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi import Response
+from fastapi.routing import APIRoute
+
+from app.core.config import settings
+from app.core.metrics import ADMISSION_IN_FLIGHT
+from app.core.metrics import ADMISSION_LIMITS
+from app.core.metrics import ADMISSION_QUEUED
+from app.core.metrics import ADMISSION_WAIT_SECONDS
+from app.core.stats import Counters
+
+# route path: fields of its request body with the wallets it locks
+WALLET_FIELDS = {
+    '/v1/wallet/donate': ('wallet_id',),
+    '/v1/wallet/transfer': ('from_wallet_id', 'to_wallet_id'),
+}
+
+
+class AdmissionStats(Counters):
+
+    def __init__(self, admission: 'Admission') -> None:
+        super().__init__('admission')
+        self.admission = admission
+
+    def snapshot(self) -> Dict[str, int]:
+        values = super().snapshot()
+        values['in_flight'] = self.admission.in_flight
+        values['queued'] = len(self.admission.waiters)
+        return values
+
+
+class Admission:
+    """In-flight limits of one worker, global and by wallet."""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = collections.deque()
+        self.wallets: CounterType[uuid.UUID] = collections.Counter()
+        self.stats = AdmissionStats(self)
+
+    @property
+    def max_in_flight(self) -> int:
+        return settings.ADMISSION_MAX_IN_FLIGHT or (
+            settings.DB_POOL_SIZE + settings.DB_POOL_MAX_OVERFLOW
+        )
+
+    def export_limits(self) -> None:
+        ADMISSION_LIMITS.labels('in_flight').set(self.max_in_flight)
+        ADMISSION_LIMITS.labels('queued').set(settings.ADMISSION_MAX_QUEUED)
+        ADMISSION_LIMITS.labels('wallet_in_flight').set(
+            settings.ADMISSION_WALLET_MAX_IN_FLIGHT
+        )
+
+    async def acquire(self, wallet_ids: List[uuid.UUID]) -> None:
+        """Wait for a slot, raises 429 when there is none in time."""
+        self._check_wallets(wallet_ids)
+        if self.in_flight >= self.max_in_flight or self.waiters:
+            await self._wait()
+        try:
+            # the wallets may have got busy while waiting
+            self._check_wallets(wallet_ids)
+        except HTTPException:
+            self._wake()
+            raise
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.inc()
+        self.wallets.update(wallet_ids)
+        self.stats.inc('admitted')
+
+    def release(self, wallet_ids: List[uuid.UUID]) -> None:
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.dec()
+        self.wallets.subtract(wallet_ids)
+        for wallet_id in wallet_ids:
+            if self.wallets[wallet_id] <= 0:
+                self.wallets.pop(wallet_id, None)
+        self._wake()
+
+    def _check_wallets(self, wallet_ids: List[uuid.UUID]) -> None:
+        limit = settings.ADMISSION_WALLET_MAX_IN_FLIGHT
+        if limit and any(
+                self.wallets[wallet_id] >= limit for wallet_id in wallet_ids
+        ):
+            self._reject('rejected_wallet', 'wallet is busy, try again later')
+
+    async def _wait(self) -> None:
+        if len(self.waiters) >= settings.ADMISSION_MAX_QUEUED:
+            self._reject('rejected_queue_full', 'too many requests')
+
+        loop = asyncio.get_event_loop()
+        started_at = time.perf_counter()
+        deadline = started_at + settings.ADMISSION_QUEUE_TIMEOUT
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        ADMISSION_QUEUED.inc()
+        try:
+            while True:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    self._reject('rejected_timeout', 'too many requests')
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                if self.in_flight < self.max_in_flight:
+                    return
+                # taken by a request that has just come, first in line
+                waiter = loop.create_future()
+                self.waiters.appendleft(waiter)
+        except BaseException:
+            # rejected or cancelled, a turn given meanwhile is passed on
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter.done():
+                self._wake()
+            raise
+        finally:
+            ADMISSION_QUEUED.dec()
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started_at)
+
+    def _wake(self) -> None:
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _reject(self, event: str, detail: str) -> None:
+        self.stats.inc(event)
+        raise HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={'Retry-After': str(settings.ADMISSION_RETRY_AFTER)},
+        )
+
+
+admission = Admission()
+
+
+async def _wallet_ids(request: Request, fields: tuple) -> List[uuid.UUID]:
+    # the body is kept by the request, the endpoint parses it again;
+    # a malformed one is left for the endpoint to reject
+    try:
+        body = json.loads(await request.body())
+        return [uuid.UUID(body[field]) for field in fields]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+
+
+class AdmissionRoute(APIRoute):
+    """APIRoute admitted by the admission control of the worker.
+
+    Meant to be mixed in after the other route classes, see admitted.
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        fields = WALLET_FIELDS.get(self.path, ())
+
+        async def admitted_handler(request: Request) -> Response:
+            wallet_ids = await _wallet_ids(request, fields) if fields else []
+            await admission.acquire(wallet_ids)
+            try:
+                return await handler(request)
+            finally:
+                admission.release(wallet_ids)
+
+        return admitted_handler
+
+
+def admitted(route_class: Type[APIRoute]) -> Type[APIRoute]:
+    """The route class with the admission control within it.
+
+    Within, so that MeasuredRoute measures the rejections too.
+    """
+    admission.export_limits()
+    return type(
+        'Admitted' + route_class.__name__,
+        (route_class, AdmissionRoute),
+        {},
+    )
@@ -1,16 +1,144 @@
-from typing import Optional, Any, Dict
+import enum
+from typing import Optional, Any, Dict, List
 
 from pydantic import BaseSettings, PostgresDsn, validator
 
 
+class TransferLocking(str, enum.Enum):
+    # plain reads at SERIALIZABLE, conflicts abort and get retried
+    serializable = 'serializable'
+    # SELECT ... FOR UPDATE ordered by wallet_id at READ COMMITTED
+    pessimistic = 'pessimistic'
+
+
 class Settings(BaseSettings):
     CURRENCY_SCALE: int = 2
+    # amounts stored as bigint counts of 10 ** -CURRENCY_SCALE instead
+    # of numeric, the columns are converted by app/migrate_amounts.py
+    AMOUNT_MINOR_UNITS: bool = False
+    TRANSFER_BATCH_MAX_SIZE: int = 5000
+    WALLET_CREATE_BATCH_MAX_SIZE: int = 10000
+    WALLET_GET_BATCH_MAX_SIZE: int = 1000
+    # donate and transfer as one CTE statement instead of ORM round trips
+    WALLET_SINGLE_STATEMENT: bool = False
+    # the wallet endpoints on prebuilt Core statements instead of ORM
+    # queries, see app.db.core_helper; read once at startup
+    WALLET_CORE_STATEMENTS: bool = False
+    # wallet responses written straight from the returned models, without
+    # validating them against response_model again, amounts as exact
+    # decimal numbers instead of floats; read once at startup
+    FAST_JSON_RESPONSES: bool = False
+
+    # balances served by /v1/wallet/get from the process memory, writes
+    # of other workers are seen after at most WALLET_CACHE_TTL seconds
+    WALLET_CACHE_ENABLED: bool = False
+    WALLET_CACHE_SIZE: int = 100000
+    WALLET_CACHE_TTL: float = 1.0  # seconds
+
+    # responses of that many recently completed donate/transfer requests
+    # are kept in memory to answer retries, 0 turns it off
+    IDEMPOTENCY_CACHE_SIZE: int = 100000
+
+    # donations to a hot wallet are spread over up to that many rows
+    WALLET_MAX_SLOTS: int = 64
+    HOT_WALLETS_REFRESH_INTERVAL: float = 5.0  # seconds
+
+    # concurrent donations to one wallet are committed together, each of
+    # them waits at most DONATION_BATCH_WINDOW for the others to join
+    DONATION_BATCH_ENABLED: bool = False
+    DONATION_BATCH_WINDOW: float = 0.002  # seconds
+    DONATION_BATCH_MAX_SIZE: int = 100
+
+    # balance changes streamed to the subscribers of /v1/wallet/changes,
+    # every worker listens for them on one connection of its own
+    WALLET_CHANGES_ENABLED: bool = False
+    WALLET_CHANGES_MAX_WALLETS: int = 100
+    WALLET_CHANGES_KEEPALIVE: float = 15.0  # seconds
+
+    # transfers accepted by /v1/wallet/transfer/async are applied by
+    # app/transfer_worker.py, that many per transaction, its threads
+    # poll the empty queue every TRANSFER_QUEUE_POLL_INTERVAL; outcomes
+    # are kept for TRANSFER_QUEUE_RETENTION_DAYS, see app/maintenance.py
+    TRANSFER_QUEUE_BATCH_SIZE: int = 500
+    TRANSFER_QUEUE_WORKERS: int = 4
+    TRANSFER_QUEUE_POLL_INTERVAL: float = 0.1  # seconds
+    TRANSFER_QUEUE_RETENTION_DAYS: int = 7
+
+    # requests of wallets.router handled at once by a worker, the next
+    # ones wait up to ADMISSION_QUEUE_TIMEOUT for their turn, at most
+    # ADMISSION_MAX_QUEUED of them; donations and transfers of a wallet
+    # at ADMISSION_WALLET_MAX_IN_FLIGHT aren't queued. Rejected requests
+    # get 429 with Retry-After. ADMISSION_MAX_IN_FLIGHT 0 is the size of
+    # the DB pool with its overflow, ADMISSION_WALLET_MAX_IN_FLIGHT 0 is
+    # no limit; read once at startup
+    ADMISSION_ENABLED: bool = False
+    ADMISSION_MAX_IN_FLIGHT: int = 0
+    ADMISSION_MAX_QUEUED: int = 100
+    ADMISSION_QUEUE_TIMEOUT: float = 0.1  # seconds
+    ADMISSION_WALLET_MAX_IN_FLIGHT: int = 4
+    ADMISSION_RETRY_AFTER: int = 1  # seconds
+
+    # transaction partitions are created that many months ahead; a key
+    # is guaranteed to be idempotent for IDEMPOTENCY_KEY_RETENTION_DAYS,
+    # see app/maintenance.py
+    TRANSACTION_PARTITIONS_AHEAD: int = 3
+    IDEMPOTENCY_KEY_RETENTION_DAYS: int = 90
+
+    # rows of app/import_donations.py applied per transaction
+    DONATION_IMPORT_CHUNK_SIZE: int = 100000
+
+    # ledger rows summed up per transaction by app/reconcile.py, rows
+    # younger than RECONCILIATION_LAG are left for the next run, and so
+    # are all the new ones when the transactions in flight at the start
+    # of a run haven't finished within RECONCILIATION_WAIT
+    RECONCILIATION_CHUNK_SIZE: int = 100000
+    RECONCILIATION_LAG: float = 300.0  # seconds
+    RECONCILIATION_WAIT: float = 60.0  # seconds
+
+    # /v1/wallet/transactions pages, the export fetches from its
+    # server-side cursor that many rows at a time
+    TRANSACTIONS_PAGE_MAX_SIZE: int = 1000
+    TRANSACTIONS_EXPORT_BATCH_SIZE: int = 1000
+
+    TRANSFER_LOCKING: TransferLocking = TransferLocking.serializable
+    TRANSFER_MAX_RETRIES: int = 5
+    TRANSFER_RETRY_BACKOFF_BASE: float = 0.005  # seconds
+    TRANSFER_RETRY_BACKOFF_MAX: float = 0.2  # seconds
 
     POSTGRES_SERVER: str
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
     POSTGRES_DB: str
     SQLALCHEMY_DATABASE_URI: Optional[PostgresDsn] = None
+    # read-only queries are spread over these, see app.db.session
+    SQLALCHEMY_REPLICA_URIS: List[PostgresDsn] = []
+    # reads of a client go to the primary for that long after its write
+    READ_YOUR_WRITES_SECONDS: float = 0
+    # serve the wallet endpoints with async handlers on an asyncpg engine
+    DB_ASYNC: bool = False
+    # wallets spread over these databases by wallet_id instead of the
+    # primary, see app.db.sharded_helper; each one is migrated on its
+    # own, with neither replicas, DB_ASYNC nor WALLET_CHANGES_ENABLED.
+    # Batch transfers are served within one shard, async ones not at
+    # all; the scripts in app/ run on each shard in turn
+    SQLALCHEMY_SHARD_URIS: List[PostgresDsn] = []
+    # cross-shard transfers not credited by then are credited by
+    # app/maintenance.py settle-transfers
+    SHARD_TRANSFER_SETTLE_DELAY: float = 10.0  # seconds
+
+    # pool of every engine in every worker process, see app.db.pool;
+    # DB_POOL_RECYCLE -1 keeps the connections open forever
+    DB_POOL_SIZE: int = 5
+    DB_POOL_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0  # seconds
+    DB_POOL_RECYCLE: int = -1  # seconds
+    # ping on every checkout, or an idle connection in the background
+    # that often, 0 turns the background check off
+    DB_POOL_PRE_PING: bool = False
+    DB_POOL_HEALTH_CHECK_INTERVAL: float = 10.0  # seconds
+    # set on every connection, the scripts included; 0 is no limit
+    DB_STATEMENT_TIMEOUT: int = 0  # milliseconds
+    DB_LOCK_TIMEOUT: int = 0  # milliseconds
 
     @validator('SQLALCHEMY_DATABASE_URI', pre=True)
     def assemble_db_connection(
@@ -28,6 +156,20 @@ class Settings(BaseSettings):
             path=f'/{values.get("POSTGRES_DB") or ""}',
         )
 
+    @validator('SQLALCHEMY_SHARD_URIS')
+    def check_shard_replicas(
+            cls,
+            v: List[str],
+            values: Dict[str, Any],
+    ) -> Any:
+        if v and values.get('SQLALCHEMY_REPLICA_URIS'):
+            raise ValueError('shards have no replicas')
+        if v and values.get('DB_ASYNC'):
+            raise ValueError('shards are not served by DB_ASYNC')
+        if v and values.get('WALLET_CHANGES_ENABLED'):
+            raise ValueError('shards have no wallet change feed')
+        return v
+
     class Config:
         case_sensitive = True
 
@@ -0,0 +1,152 @@
+"""Prometheus metrics, served by /metrics.
+
+With PROMETHEUS_MULTIPROC_DIR set every worker process writes its
+values to files in that directory and /metrics sums them up, so the
+numbers are of the whole node whichever worker answers. The directory
+has to be emptied before the workers start, see prestart.sh.
+"""
+import os
+import time
+from typing import Callable
+from typing import Dict
+from typing import Tuple
+
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi import Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+from prometheus_client import multiprocess
+
+# wallet requests take milliseconds, the default buckets are too coarse
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+REQUEST_SECONDS = Histogram(
+    'paymarket_request_duration_seconds',
+    'Time to handle a request, by route.',
+    ['route'],
+    buckets=LATENCY_BUCKETS,
+)
+RESPONSES = Counter(
+    'paymarket_responses_total',
+    'Responses by route and status code.',
+    ['route', 'status'],
+)
+IN_PROGRESS = Gauge(
+    'paymarket_requests_in_progress',
+    'Requests being handled, by route.',
+    ['route'],
+    multiprocess_mode='livesum',
+)
+DB_PHASE_SECONDS = Histogram(
+    'paymarket_db_phase_duration_seconds',
+    'Time spent in each database phase of a wallet operation.',
+    ['operation', 'phase'],
+    buckets=LATENCY_BUCKETS,
+)
+ADMISSION_LIMITS = Gauge(
+    'paymarket_admission_limit',
+    'Limits of the admission control of every worker.',
+    ['limit'],
+    multiprocess_mode='max',
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    'paymarket_admission_in_flight',
+    'Requests admitted and not done yet.',
+    multiprocess_mode='livesum',
+)
+ADMISSION_QUEUED = Gauge(
+    'paymarket_admission_queued',
+    'Requests waiting to be admitted.',
+    multiprocess_mode='livesum',
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    'paymarket_admission_wait_duration_seconds',
+    'Time requests waited to be admitted, the rejected ones included.',
+    buckets=LATENCY_BUCKETS,
+)
+# idempotent replays, IntegrityError rollbacks, retries and the rest of
+# the app.core.stats counters, summed over the workers
+EVENTS = Counter(
+    'paymarket_events_total',
+    'Events counted by app.core.stats, by namespace.',
+    ['namespace', 'event'],
+)
+
+
+# labels() takes a lock on every call, the children are looked up here
+_phase_histograms: Dict[Tuple[str, str], Histogram] = {}
+
+
+def registry() -> CollectorRegistry:
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+class PhaseTimer:
+    """Times the consecutive database phases of one operation.
+
+    Every lap observes the time since the previous one, or since the
+    timer was made.
+    """
+
+    __slots__ = ('operation', '_last')
+
+    def __init__(self, operation: str) -> None:
+        self.operation = operation
+        self._last = time.perf_counter()
+
+    def lap(self, phase: str) -> None:
+        now = time.perf_counter()
+        key = (self.operation, phase)
+        histogram = _phase_histograms.get(key)
+        if histogram is None:
+            histogram = _phase_histograms.setdefault(
+                key, DB_PHASE_SECONDS.labels(*key),
+            )
+        histogram.observe(now - self._last)
+        self._last = now
+
+
+class MeasuredRoute(APIRoute):
+    """APIRoute that measures its latency, outcome and concurrency.
+
+    The route path is the label, so requests of one route share their
+    series whatever their parameters are.
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        seconds = REQUEST_SECONDS.labels(self.path)
+        in_progress = IN_PROGRESS.labels(self.path)
+
+        async def measured_handler(request: Request) -> Response:
+            status = 500
+            started_at = time.perf_counter()
+            in_progress.inc()
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            except RequestValidationError:
+                status = 422
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started_at)
+                in_progress.dec()
+                RESPONSES.labels(self.path, status).inc()
+
+        return measured_handler
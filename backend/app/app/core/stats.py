@@ -0,0 +1,33 @@
+import threading
+from collections import Counter
+from typing import Dict
+
+from app.core.metrics import EVENTS
+
+registry: Dict[str, 'Counters'] = {}
+
+
+class Counters:
+    """Named event counters of one component, local to the process."""
+
+    def __init__(self, namespace: str) -> None:
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._values: Counter = Counter()
+        registry[namespace] = self
+
+    def inc(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._values[name] += value
+        EVENTS.labels(self.namespace, name).inc(value)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
+
+
+def snapshot() -> Dict[str, Dict[str, int]]:
+    return {
+        namespace: counters.snapshot()
+        for namespace, counters in registry.items()
+    }
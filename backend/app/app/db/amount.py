@@ -0,0 +1,14 @@
+from sqlalchemy import BigInteger
+from sqlalchemy import Numeric
+
+from app.core.config import settings
+
+# Type of the amount columns. Minor units are integers: smaller rows and
+# indexes, and integer arithmetic in both the database and Python. The
+# API still speaks currency units, app.schemas converts at the boundary.
+if settings.AMOUNT_MINOR_UNITS:
+    AmountType = BigInteger
+    AMOUNT_SQL_TYPE = 'bigint'
+else:
+    AmountType = Numeric(scale=settings.CURRENCY_SCALE)
+    AMOUNT_SQL_TYPE = 'numeric'
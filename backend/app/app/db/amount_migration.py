@@ -0,0 +1,452 @@
+"""Online conversion of the amount columns from numeric to minor units.
+
+Every amount column gets a shadow column in the other type, kept in
+sync with it by a trigger on every write, and the two are swapped:
+
+* expand adds the bigint shadow columns, named <column>_minor, and the
+  triggers that fill them;
+* backfill fills the shadow columns of the existing rows in batches,
+  checks that none is missing and builds the covering indexes of
+  transaction over them;
+* switch swaps the columns: <column> becomes <column>_numeric, kept in
+  sync from the bigint one now, and <column>_minor becomes <column>;
+* revert swaps them back, while the shadow columns are still there;
+* cleanup drops the shadow columns and the triggers.
+
+Only the swaps and the DDL take exclusive locks, for a moment each,
+backfill runs alongside the writes. The workers write amounts in the
+units of AMOUNT_MINOR_UNITS, so they have to be stopped for the swap
+and started again with the other setting.
+"""
+import time
+from typing import Callable
+from typing import List
+from typing import Optional
+
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import retry
+
+# table: (column to page through it by, its type, amount columns)
+AMOUNT_COLUMNS = {
+    'wallet': ('id', 'integer', ('amount',)),
+    'walletslot': ('id', 'integer', ('amount',)),
+    'transaction': (
+        'id', 'bigint', ('amount', 'from_wallet_amount', 'to_wallet_amount'),
+    ),
+    'reconciliationbalance': ('wallet_id', 'uuid', ('amount',)),
+    'reconciliationarchive': ('id', 'integer', ('amount',)),
+    'transferrequest': (
+        'idempotency_key', 'uuid', ('amount', 'from_wallet_amount'),
+    ),
+    'shardtransfer': ('idempotency_key', 'uuid', ('amount',)),
+}
+# the other amount columns are NOT NULL
+NULLABLE_COLUMNS = {
+    'transaction': ('amount', 'from_wallet_amount', 'to_wallet_amount'),
+    'transferrequest': ('from_wallet_amount',),
+}
+
+# the indexes of transaction that include amounts, by a short name for
+# the indexes of the partitions
+COVERING_INDEXES = {
+    'ix_transaction_from_wallet_id_created_at_id': (
+        'from_wallet',
+        '(from_wallet_id, created_at, id) INCLUDE'
+        ' (idempotency_key, {amount}, to_wallet_id, {from_wallet_amount})',
+    ),
+    'ix_transaction_to_wallet_id_created_at_id': (
+        'to_wallet',
+        '(to_wallet_id, created_at, id) INCLUDE'
+        ' (idempotency_key, {amount}, from_wallet_id, {to_wallet_amount})',
+    ),
+}
+
+SYNC_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION {table}_amount_sync() RETURNS trigger AS $$
+    BEGIN
+        {assignments}
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+'''
+
+
+def stored_type(db: Session) -> str:
+    """numeric or bigint, the type the amounts are stored in now."""
+    return db.execute(text(
+        '''
+        SELECT data_type
+        FROM information_schema.columns
+        WHERE table_name = 'wallet' AND column_name = 'amount'
+        '''
+    )).scalar()
+
+
+def _sync_function(table: str, to_minor: bool) -> str:
+    factor = 10 ** settings.CURRENCY_SCALE
+    if to_minor:
+        assignment = 'NEW.{0}_minor := round(NEW.{0} * %d);' % factor
+    else:
+        assignment = 'NEW.{0}_numeric := round(NEW.{0}::numeric / %d, %d);' % (
+            factor, settings.CURRENCY_SCALE,
+        )
+    return SYNC_FUNCTION.format(
+        table=table,
+        assignments='\n        '.join(
+            assignment.format(column) for column in AMOUNT_COLUMNS[table][2]
+        ),
+    )
+
+
+def _check(table: str) -> str:
+    """Constraint of the shadow columns being filled in."""
+    nullable = NULLABLE_COLUMNS.get(table, ())
+    condition = ' AND '.join(
+        '({0} IS NULL) = ({0}_minor IS NULL)'.format(column)
+        if column in nullable else '{}_minor IS NOT NULL'.format(column)
+        for column in AMOUNT_COLUMNS[table][2]
+    )
+    return 'ALTER TABLE {0} ADD CONSTRAINT {0}_amount_minor_check CHECK ({1})' \
+        ' NOT VALID'.format(table, condition)
+
+
+def _execute_locked(
+        db: Session,
+        statements: List[str],
+        lock_timeout: str,
+        attempts: int,
+        wait_seconds: float,
+) -> None:
+    """Run the statements in one transaction that gives up waiting for a
+    lock after lock_timeout, not to stall the writes queued behind it,
+    and tries again later."""
+    for attempt in range(attempts):
+        try:
+            db.execute(text(
+                "SET LOCAL lock_timeout = '{}'".format(lock_timeout)
+            ))
+            for statement in statements:
+                db.execute(text(statement))
+            db.commit()
+            return
+        except exc.OperationalError as e:
+            db.rollback()
+            if (
+                    retry.pgcode(e) != retry.LOCK_NOT_AVAILABLE
+                    or attempt == attempts - 1
+            ):
+                raise
+            time.sleep(wait_seconds)
+
+
+def expand(
+        db: Session,
+        lock_timeout: str = '1s',
+        attempts: int = 10,
+        wait_seconds: float = 1.0,
+) -> None:
+    """Add the shadow columns and start filling them on every write."""
+    if stored_type(db) != 'numeric':
+        raise ValueError('The amounts are in minor units already')
+    statements = []
+    for table, (_, _, columns) in AMOUNT_COLUMNS.items():
+        statements.extend(
+            'ALTER TABLE {} ADD COLUMN IF NOT EXISTS {}_minor bigint'.format(
+                table, column,
+            )
+            for column in columns
+        )
+        statements.append(_sync_function(table, to_minor=True))
+        statements.append(
+            'DROP TRIGGER IF EXISTS amount_sync ON {}'.format(table)
+        )
+        statements.append(
+            'CREATE TRIGGER amount_sync BEFORE INSERT OR UPDATE ON {0}'
+            ' FOR EACH ROW EXECUTE FUNCTION {0}_amount_sync()'.format(table)
+        )
+    _execute_locked(db, statements, lock_timeout, attempts, wait_seconds)
+
+
+def _backfill_table(
+        db: Session,
+        table: str,
+        batch_size: int,
+        progress: Optional[Callable[[str, int], None]],
+) -> None:
+    key, key_type, columns = AMOUNT_COLUMNS[table]
+    factor = 10 ** settings.CURRENCY_SCALE
+    # rows filled by the trigger or an earlier run are not written again
+    assignments = ', '.join(
+        '{0}_minor = round({0} * {1})'.format(column, factor)
+        for column in columns
+    )
+    stale = ' OR '.join(
+        '{0}_minor IS DISTINCT FROM round({0} * {1})'.format(column, factor)
+        for column in columns
+    )
+    after = None
+    while True:
+        result = db.execute(
+            text(
+                '''
+                WITH batch AS (
+                    SELECT {key}
+                    FROM {table}
+                    {where}
+                    ORDER BY {key}
+                    LIMIT :batch_size
+                ), updated AS (
+                    UPDATE {table}
+                    SET {assignments}
+                    FROM batch
+                    WHERE {table}.{key} = batch.{key} AND ({stale})
+                    RETURNING 1
+                )
+                SELECT
+                    (
+                        SELECT {key}::text
+                        FROM batch
+                        ORDER BY {key} DESC
+                        LIMIT 1
+                    ) AS last,
+                    (SELECT count(*) FROM updated) AS updated
+                '''.format(
+                    key=key,
+                    table=table,
+                    where=(
+                        'WHERE {} > CAST(:after AS {})'.format(key, key_type)
+                        if after is not None else ''
+                    ),
+                    assignments=assignments,
+                    stale=stale,
+                )
+            ),
+            dict(after=after, batch_size=batch_size),
+        ).first()
+        db.commit()
+        if result.last is None:
+            return
+        after = result.last
+        if progress:
+            progress(table, result.updated)
+
+
+def backfill(
+        db: Session,
+        batch_size: int = 10000,
+        progress: Optional[Callable[[str, int], None]] = None,
+        lock_timeout: str = '1s',
+        attempts: int = 10,
+        wait_seconds: float = 1.0,
+) -> None:
+    """Fill the shadow columns of the existing rows, each batch in its
+    own transaction, and get everything switch needs ready.
+
+    progress is called with the table and the rows updated after every
+    batch.
+    """
+    if stored_type(db) != 'numeric':
+        raise ValueError('The amounts are in minor units already')
+    _execute_locked(
+        db,
+        [
+            'ALTER TABLE {0} DROP CONSTRAINT IF EXISTS'
+            ' {0}_amount_minor_check'.format(table)
+            for table in AMOUNT_COLUMNS
+        ] + [_check(table) for table in AMOUNT_COLUMNS],
+        lock_timeout,
+        attempts,
+        wait_seconds,
+    )
+    for table in AMOUNT_COLUMNS:
+        _backfill_table(db, table, batch_size, progress)
+        # scans the table without blocking the writes, new rows are
+        # checked on their way in since the constraint was added
+        db.execute(text(
+            'ALTER TABLE {0} VALIDATE CONSTRAINT {0}_amount_minor_check'.format(
+                table,
+            )
+        ))
+        db.commit()
+    _create_covering_indexes(db)
+
+
+def _partitions(db: Session) -> List[str]:
+    return [
+        name for name, in db.execute(text(
+            '''
+            SELECT inhrelid::regclass::text
+            FROM pg_inherits
+            WHERE inhparent = 'transaction'::regclass
+            '''
+        ))
+    ]
+
+
+def _create_covering_indexes(db: Session) -> None:
+    """Build the indexes of transaction over the shadow columns.
+
+    An index of a partitioned table can't be built concurrently, the
+    index of every partition is, and attached to an empty one of the
+    table. New partitions get theirs from it.
+    """
+    columns = {
+        column: column + '_minor'
+        for column in AMOUNT_COLUMNS['transaction'][2]
+    }
+    partitions = _partitions(db)
+    db.commit()
+    with db.get_bind().connect().execution_options(
+            isolation_level='AUTOCOMMIT',
+    ) as connection:
+        for name, (short_name, definition) in COVERING_INDEXES.items():
+            definition = definition.format(**columns)
+            connection.exec_driver_sql(
+                'CREATE INDEX IF NOT EXISTS {}_minor'
+                ' ON ONLY transaction {}'.format(name, definition)
+            )
+            for partition in partitions:
+                connection.exec_driver_sql(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS {0}_{1}_minor'
+                    ' ON {0} {2}'.format(partition, short_name, definition)
+                )
+                connection.exec_driver_sql(
+                    'ALTER INDEX {}_minor ATTACH PARTITION {}_{}_minor'.format(
+                        name, partition, short_name,
+                    )
+                )
+
+
+def _is_ready(db: Session) -> bool:
+    """Whether backfill has finished since the shadow columns were last
+    swapped."""
+    checks = db.execute(
+        text(
+            '''
+            SELECT count(*)
+            FROM pg_constraint
+            WHERE conrelid = ANY(CAST(:tables AS regclass[]))
+                AND conname = conrelid::regclass::text || '_amount_minor_check'
+                AND convalidated
+            '''
+        ),
+        dict(tables=list(AMOUNT_COLUMNS)),
+    ).scalar()
+    indexes = db.execute(
+        text(
+            '''
+            SELECT count(*)
+            FROM pg_index
+            JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            WHERE pg_class.relname = ANY(:names) AND pg_index.indisvalid
+            '''
+        ),
+        dict(names=[name + '_minor' for name in COVERING_INDEXES]),
+    ).scalar()
+    return (
+        checks == len(AMOUNT_COLUMNS) and indexes == len(COVERING_INDEXES)
+    )
+
+
+def _swap(shadow: str, retired: str) -> List[str]:
+    """Statements making the shadow columns and indexes the used ones."""
+    statements = [
+        'LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(
+            ', '.join(AMOUNT_COLUMNS),
+        ),
+    ]
+    for table, (_, _, columns) in AMOUNT_COLUMNS.items():
+        for column in columns:
+            statements.append(
+                'ALTER TABLE {0} RENAME COLUMN {1} TO {1}_{2}'.format(
+                    table, column, retired,
+                )
+            )
+            statements.append(
+                'ALTER TABLE {0} RENAME COLUMN {1}_{2} TO {1}'.format(
+                    table, column, shadow,
+                )
+            )
+            if column not in NULLABLE_COLUMNS.get(table, ()):
+                # the validated check spares the scan
+                statements.append(
+                    'ALTER TABLE {} ALTER COLUMN {} SET NOT NULL'.format(
+                        table, column,
+                    )
+                )
+        statements.append(
+            'ALTER TABLE {0} DROP CONSTRAINT IF EXISTS'
+            ' {0}_amount_minor_check'.format(table)
+        )
+        statements.append(_sync_function(table, to_minor=retired == 'minor'))
+    for name in COVERING_INDEXES:
+        statements.append(
+            'ALTER INDEX {0} RENAME TO {0}_{1}'.format(name, retired)
+        )
+        statements.append(
+            'ALTER INDEX {0}_{1} RENAME TO {0}'.format(name, shadow)
+        )
+    return statements
+
+
+def switch(
+        db: Session,
+        lock_timeout: str = '5s',
+        attempts: int = 10,
+        wait_seconds: float = 1.0,
+) -> None:
+    """Store the amounts in minor units from now on."""
+    if stored_type(db) != 'numeric':
+        raise ValueError('The amounts are in minor units already')
+    if not _is_ready(db):
+        raise ValueError('The minor units are not backfilled')
+    _execute_locked(
+        db, _swap('minor', 'numeric'), lock_timeout, attempts, wait_seconds,
+    )
+
+
+def revert(
+        db: Session,
+        lock_timeout: str = '5s',
+        attempts: int = 10,
+        wait_seconds: float = 1.0,
+) -> None:
+    """Store the amounts in numeric again, before cleanup only."""
+    if stored_type(db) != 'bigint':
+        raise ValueError('The amounts are in numeric already')
+    _execute_locked(
+        db, _swap('numeric', 'minor'), lock_timeout, attempts, wait_seconds,
+    )
+
+
+def cleanup(
+        db: Session,
+        lock_timeout: str = '1s',
+        attempts: int = 10,
+        wait_seconds: float = 1.0,
+) -> None:
+    """Drop the shadow columns, their indexes and the triggers.
+
+    Before switch it undoes expand, after switch there is no way back.
+    """
+    shadow = 'minor' if stored_type(db) == 'numeric' else 'numeric'
+    statements = []
+    for table, (_, _, columns) in AMOUNT_COLUMNS.items():
+        statements.append(
+            'DROP TRIGGER IF EXISTS amount_sync ON {}'.format(table)
+        )
+        statements.append(
+            'DROP FUNCTION IF EXISTS {}_amount_sync()'.format(table)
+        )
+        # the indexes and checks over the columns are dropped with them
+        statements.extend(
+            'ALTER TABLE {} DROP COLUMN IF EXISTS {}_{}'.format(
+                table, column, shadow,
+            )
+            for column in columns
+        )
+    _execute_locked(db, statements, lock_timeout, attempts, wait_seconds)
@@ -0,0 +1,284 @@
+import datetime
+import uuid
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import exc
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import retry
+from app.db.cache import wallet_cache
+from app.db.idempotency import idempotency_stats
+from app.db.idempotency import recent_keys
+from app.db.helper import DONATE_STATEMENT
+from app.db.helper import TRANSFER_STATEMENT
+from app.db.helper import transaction_by_key
+from app.db.helper import transfer_stats
+from app.models import Transaction
+from app.models import TransactionKey
+from app.models import Wallet
+from app.models import WalletSlot
+from app.schemas import WalletDonateRequest
+from app.schemas import WalletResponse
+from app.schemas import WalletTransferRequest
+
+
+class AsyncDBHelper:
+    """DBHelper for the async mode.
+
+    Donate and transfer always take the single-statement path, it needs
+    no ORM state and the least awaits per request.
+    """
+
+    @classmethod
+    async def wallet_get(
+            cls,
+            db: AsyncSession,
+            wallet_id: uuid.UUID,
+    ) -> WalletResponse:
+        amount = wallet_cache.get(wallet_id)
+        if amount is not None:
+            return WalletResponse(wallet_id=wallet_id, amount=amount)
+
+        result = (
+            await db.execute(
+                select(
+                    Wallet.wallet_id,
+                    Wallet.amount,
+                    Wallet.slots,
+                    Wallet.updated_at,
+                )
+                .where(Wallet.wallet_id == wallet_id)
+            )
+        ).first()
+
+        if not result:
+            raise HTTPException(status_code=404, detail='Wallet is not found')
+
+        amount = result.amount
+        if result.slots:
+            amount += (
+                await db.execute(
+                    select(func.coalesce(func.sum(WalletSlot.amount), 0))
+                    .where(WalletSlot.wallet_id == wallet_id)
+                )
+            ).scalar()
+        wallet_cache.put(result.wallet_id, amount, result.updated_at)
+
+        return WalletResponse(
+            wallet_id=result.wallet_id,
+            amount=amount,
+        )
+
+    @classmethod
+    async def wallet_create(
+            cls,
+            db: AsyncSession,
+            idempotency_key: uuid.UUID,
+    ) -> WalletResponse:
+        query = (
+            pg_insert(Wallet)
+            .values(wallet_id=uuid.uuid4(), idempotency_key=idempotency_key)
+            .returning(Wallet.wallet_id, Wallet.amount)
+        )
+        query = query.on_conflict_do_update(
+            constraint='wallet_idempotency_key_key',
+            set_=dict(idempotency_key=query.excluded.idempotency_key),
+        )
+        result = (await db.execute(query)).first()
+        await db.commit()
+        wallet_cache.put(result.wallet_id, result.amount, None)
+
+        return WalletResponse(
+            wallet_id=result.wallet_id,
+            amount=result.amount,
+        )
+
+    @classmethod
+    async def wallet_donate(
+            cls,
+            db: AsyncSession,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> WalletResponse:
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        try:
+            utcnow = datetime.datetime.utcnow()
+            result = (
+                await db.execute(
+                    DONATE_STATEMENT,
+                    dict(
+                        idempotency_key=idempotency_key,
+                        wallet_id=request.wallet_id,
+                        amount=request.amount,
+                        utcnow=utcnow,
+                    ),
+                )
+            ).first()
+            if not result:
+                raise HTTPException(
+                    status_code=404,
+                    detail='Wallet is not found',
+                )
+
+            await db.commit()
+            if result.replayed:
+                idempotency_stats.inc('lookup_hits')
+            else:
+                wallet_cache.put(result.wallet_id, result.amount, utcnow)
+
+            response = WalletResponse(
+                wallet_id=result.wallet_id,
+                amount=result.amount,
+            )
+            recent_keys.put(idempotency_key, response)
+            return response
+        except exc.IntegrityError:
+            await db.rollback()
+
+            idempotency_stats.inc('conflicts')
+            existed_transaction = await cls._existed_transaction(
+                db, idempotency_key,
+            )
+            if not existed_transaction:
+                raise await cls._missing_transaction(db, idempotency_key)
+
+            response = WalletResponse(
+                wallet_id=existed_transaction.to_wallet_id,
+                amount=existed_transaction.to_wallet_amount,
+            )
+            recent_keys.put(idempotency_key, response)
+            return response
+
+    @classmethod
+    async def wallet_transfer(
+            cls,
+            db: AsyncSession,
+            idempotency_key: uuid.UUID,
+            request: WalletTransferRequest,
+    ) -> WalletResponse:
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        async for _ in retry.async_attempts(transfer_stats):
+            try:
+                utcnow = datetime.datetime.utcnow()
+                result = (
+                    await db.execute(
+                        TRANSFER_STATEMENT,
+                        dict(
+                            idempotency_key=idempotency_key,
+                            from_wallet_id=request.from_wallet_id,
+                            to_wallet_id=request.to_wallet_id,
+                            amount=request.amount,
+                            utcnow=utcnow,
+                        ),
+                    )
+                ).first()
+
+                if not result.wallet_id:
+                    # nothing is changed, just release the locks
+                    await db.rollback()
+
+                    if result.from_wallet_amount is None:
+                        raise HTTPException(
+                            status_code=404,
+                            detail='from_wallet_id is not found',
+                        )
+                    if result.from_wallet_amount < request.amount:
+                        raise HTTPException(
+                            status_code=400,
+                            detail='not enough money',
+                        )
+                    raise HTTPException(
+                        status_code=404,
+                        detail='db_to_wallet is not found',
+                    )
+
+                await db.commit()
+                if result.replayed:
+                    idempotency_stats.inc('lookup_hits')
+                else:
+                    transfer_stats.inc('async_commits')
+                    wallet_cache.put(result.wallet_id, result.amount, utcnow)
+                    wallet_cache.put(
+                        request.to_wallet_id, result.to_wallet_amount, utcnow,
+                    )
+
+                response = WalletResponse(
+                    wallet_id=result.wallet_id,
+                    amount=result.amount,
+                )
+                recent_keys.put(idempotency_key, response)
+                return response
+            except exc.IntegrityError as exception:
+                await db.rollback()
+
+                if retry.pgcode(exception) == retry.UNIQUE_VIOLATION:
+                    idempotency_stats.inc('conflicts')
+                    existed_transaction = await cls._existed_transaction(
+                        db, idempotency_key,
+                    )
+                    if not existed_transaction:
+                        raise await cls._missing_transaction(
+                            db, idempotency_key,
+                        )
+
+                    response = WalletResponse(
+                        wallet_id=existed_transaction.from_wallet_id,
+                        amount=existed_transaction.from_wallet_amount,
+                    )
+                    recent_keys.put(idempotency_key, response)
+                    return response
+                transfer_stats.inc('integrity_errors')
+            except exc.DBAPIError as exception:
+                await db.rollback()
+
+                if not retry.is_transient(exception):
+                    raise
+                transfer_stats.inc('async_aborts')
+
+    @classmethod
+    async def _missing_transaction(
+            cls,
+            db: AsyncSession,
+            idempotency_key: uuid.UUID,
+    ) -> HTTPException:
+        """Same as DBHelper._missing_transaction."""
+        archived = (
+            await db.execute(
+                select(TransactionKey.idempotency_key)
+                .where(TransactionKey.idempotency_key == idempotency_key)
+            )
+        ).first()
+        await db.rollback()
+        if archived:
+            idempotency_stats.inc('archived')
+            return HTTPException(
+                status_code=410,
+                detail='the transaction of the key is archived',
+            )
+        return HTTPException(
+            status_code=409,
+            detail='idempotency key is used by another request',
+        )
+
+    @classmethod
+    async def _existed_transaction(
+            cls,
+            db: AsyncSession,
+            idempotency_key: uuid.UUID,
+    ) -> Optional[Transaction]:
+        return (
+            await db.execute(
+                select(Transaction)
+                .where(transaction_by_key(idempotency_key))
+            )
+        ).scalars().first()
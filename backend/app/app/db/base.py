@@ -2,3 +2,10 @@
 # imported by Alembic
 from app.db.base_class import Base  # noqa
 from app.models.wallet import Wallet  # noqa
+from app.models.wallet_slot import WalletSlot  # noqa
+from app.models.transaction_key import TransactionKey  # noqa
+from app.models.reconciliation import ReconciliationArchive  # noqa
+from app.models.reconciliation import ReconciliationBalance  # noqa
+from app.models.reconciliation import ReconciliationCheckpoint  # noqa
+from app.models.transfer_request import TransferRequest  # noqa
+from app.models.shard_transfer import ShardTransfer  # noqa
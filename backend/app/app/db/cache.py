@@ -0,0 +1,84 @@
+import datetime
+import decimal
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+from typing import Tuple
+
+from app.core.config import settings
+from app.core.stats import Counters
+
+cache_stats = Counters('wallet_cache')
+
+
+class WalletCache:
+    """Bounded LRU of wallet balances, local to the process.
+
+    Writes of this process go through the cache on commit, writes of
+    other workers become visible after at most ttl seconds. Every entry
+    keeps the wallet updated_at it was read or written with, so a slow
+    request can't put back a balance older than the cached one.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[uuid.UUID, Tuple[decimal.Decimal, datetime.datetime, float]]' = OrderedDict()  # noqa: E501
+
+    def get(self, wallet_id: uuid.UUID) -> Optional[decimal.Decimal]:
+        if not settings.WALLET_CACHE_ENABLED:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(wallet_id)
+            if entry and entry[2] < time.monotonic():
+                del self._entries[wallet_id]
+                entry = None
+            if entry:
+                self._entries.move_to_end(wallet_id)
+
+        if not entry:
+            cache_stats.inc('misses')
+            return None
+        cache_stats.inc('hits')
+        return entry[0]
+
+    def put(
+            self,
+            wallet_id: uuid.UUID,
+            amount: decimal.Decimal,
+            updated_at: Optional[datetime.datetime],
+    ) -> None:
+        if not settings.WALLET_CACHE_ENABLED:
+            return
+
+        version = updated_at or datetime.datetime.min
+        evicted = 0
+        with self._lock:
+            entry = self._entries.get(wallet_id)
+            if entry and entry[1] > version:
+                return
+
+            self._entries[wallet_id] = (
+                amount, version, time.monotonic() + self.ttl,
+            )
+            self._entries.move_to_end(wallet_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+
+        if evicted:
+            cache_stats.inc('evictions', evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+wallet_cache = WalletCache(
+    settings.WALLET_CACHE_SIZE,
+    settings.WALLET_CACHE_TTL,
+)
@@ -0,0 +1,323 @@
+import datetime
+import uuid
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam
+from sqlalchemy import case
+from sqlalchemy import exc
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import retry
+from app.db.cache import wallet_cache
+from app.db.helper import DBHelper
+from app.db.helper import DONATE_STATEMENT
+from app.db.helper import TRANSFER_STATEMENT
+from app.db.helper import transfer_stats
+from app.db.hot_wallets import hot_wallets
+from app.db.idempotency import idempotency_stats
+from app.db.idempotency import recent_keys
+from app.db.session import replica_session
+from app.models import Transaction
+from app.models import TransactionKey
+from app.models import Wallet
+from app.models import WalletSlot
+from app.schemas import Amount
+from app.schemas import WalletDonateRequest
+from app.schemas import WalletResponse
+from app.schemas import WalletTransferRequest
+
+wallet_table = Wallet.__table__
+slot_table = WalletSlot.__table__
+transaction_table = Transaction.__table__
+transaction_key_table = TransactionKey.__table__
+
+# The statements are built once, every request only binds its values:
+# SQLAlchemy compiles each of them once and takes it from the compiled
+# cache afterwards.
+
+# The balance of the wallet with its slots, the slots are only summed
+# up for a hot wallet.
+GET_WALLET_STATEMENT = select(
+    wallet_table.c.wallet_id,
+    (
+        wallet_table.c.amount
+        + case(
+            (
+                wallet_table.c.slots > 0,
+                select(func.coalesce(func.sum(slot_table.c.amount), 0))
+                .where(slot_table.c.wallet_id == wallet_table.c.wallet_id)
+                .scalar_subquery(),
+            ),
+            else_=0,
+        )
+    ).label('amount'),
+    wallet_table.c.updated_at,
+).where(wallet_table.c.wallet_id == bindparam('wallet_id'))
+
+_create_wallet = pg_insert(wallet_table).values(
+    wallet_id=bindparam('wallet_id'),
+    idempotency_key=bindparam('idempotency_key'),
+)
+CREATE_WALLET_STATEMENT = _create_wallet.on_conflict_do_update(
+    constraint='wallet_idempotency_key_key',
+    set_=dict(idempotency_key=_create_wallet.excluded.idempotency_key),
+).returning(wallet_table.c.wallet_id, wallet_table.c.amount)
+
+# See transaction_by_key
+EXISTED_TRANSACTION_STATEMENT = select(
+    transaction_table.c.from_wallet_id,
+    transaction_table.c.from_wallet_amount,
+    transaction_table.c.to_wallet_id,
+    transaction_table.c.to_wallet_amount,
+).where(
+    transaction_table.c.idempotency_key == bindparam('idempotency_key'),
+    transaction_table.c.created_at == (
+        select(transaction_key_table.c.created_at)
+        .where(
+            transaction_key_table.c.idempotency_key
+            == bindparam('idempotency_key')
+        )
+        .scalar_subquery()
+    ),
+)
+
+
+class CoreDBHelper(DBHelper):
+    """DBHelper without the ORM on the hot endpoints.
+
+    The wallets are read and created by the prebuilt Core statements
+    above, donations and transfers are made by the single statements of
+    DBHelper, run on the connection of the session as well. Rows are
+    never loaded into the session, responses are built from the
+    database values without validating them again, and no phase is
+    timed. Selected by WALLET_CORE_STATEMENTS.
+    """
+
+    @classmethod
+    def wallet_get(cls, db: Session, wallet_id: uuid.UUID) -> WalletResponse:
+        amount = wallet_cache.get(wallet_id)
+        if amount is not None:
+            return WalletResponse.construct(
+                wallet_id=wallet_id, amount=Amount.validate(amount),
+            )
+
+        result = db.connection().execute(
+            GET_WALLET_STATEMENT, dict(wallet_id=wallet_id),
+        ).first()
+        if not result:
+            raise HTTPException(status_code=404, detail='Wallet is not found')
+
+        wallet_cache.put(wallet_id, result['amount'], result['updated_at'])
+        return WalletResponse.construct(
+            wallet_id=result['wallet_id'],
+            amount=Amount.validate(result['amount']),
+        )
+
+    @classmethod
+    def wallet_create(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+    ) -> WalletResponse:
+        result = db.connection().execute(
+            CREATE_WALLET_STATEMENT,
+            dict(wallet_id=uuid.uuid4(), idempotency_key=idempotency_key),
+        ).first()
+        db.commit()
+        wallet_cache.put(result['wallet_id'], result['amount'], None)
+
+        return WalletResponse.construct(
+            wallet_id=result['wallet_id'],
+            amount=Amount.validate(result['amount']),
+        )
+
+    @classmethod
+    def wallet_donate(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> WalletResponse:
+        if hot_wallets.contains(db, request.wallet_id):
+            response = cls.wallet_donate_slot(db, idempotency_key, request)
+            if response:
+                return response
+
+        if settings.DONATION_BATCH_ENABLED:
+            response = cls.wallet_donate_batched(db, idempotency_key, request)
+            if response:
+                return response
+
+        return cls.wallet_donate_cte(db, idempotency_key, request)
+
+    @classmethod
+    def wallet_donate_cte(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> WalletResponse:
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        try:
+            utcnow = datetime.datetime.utcnow()
+            result = db.connection().execute(
+                DONATE_STATEMENT,
+                dict(
+                    idempotency_key=idempotency_key,
+                    wallet_id=request.wallet_id,
+                    amount=request.amount,
+                    utcnow=utcnow,
+                ),
+            ).first()
+            if not result:
+                raise HTTPException(
+                    status_code=404,
+                    detail='Wallet is not found',
+                )
+
+            db.commit()
+            if result['replayed']:
+                idempotency_stats.inc('lookup_hits')
+            else:
+                wallet_cache.put(
+                    result['wallet_id'], result['amount'], utcnow,
+                )
+
+            response = WalletResponse.construct(
+                wallet_id=result['wallet_id'],
+                amount=Amount.validate(result['amount']),
+            )
+            recent_keys.put(idempotency_key, response)
+            return response
+        except exc.IntegrityError:
+            db.rollback()
+
+            idempotency_stats.inc('conflicts')
+            return cls._existed_response(
+                db, idempotency_key, to_wallet=True, committed=True,
+            )
+
+    @classmethod
+    def wallet_transfer(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletTransferRequest,
+    ) -> WalletResponse:
+        return cls.wallet_transfer_cte(db, idempotency_key, request)
+
+    @classmethod
+    def wallet_transfer_cte(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletTransferRequest,
+    ) -> WalletResponse:
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        for _ in retry.attempts(transfer_stats):
+            try:
+                utcnow = datetime.datetime.utcnow()
+                result = db.connection().execute(
+                    TRANSFER_STATEMENT,
+                    dict(
+                        idempotency_key=idempotency_key,
+                        from_wallet_id=request.from_wallet_id,
+                        to_wallet_id=request.to_wallet_id,
+                        amount=request.amount,
+                        utcnow=utcnow,
+                    ),
+                ).first()
+
+                if not result['wallet_id']:
+                    # nothing is changed, just release the locks
+                    db.rollback()
+
+                    from_wallet_amount = result['from_wallet_amount']
+                    if from_wallet_amount is None:
+                        raise HTTPException(
+                            status_code=404,
+                            detail='from_wallet_id is not found',
+                        )
+                    if from_wallet_amount < request.amount:
+                        raise HTTPException(
+                            status_code=400,
+                            detail='not enough money',
+                        )
+                    raise HTTPException(
+                        status_code=404,
+                        detail='db_to_wallet is not found',
+                    )
+
+                db.commit()
+                if result['replayed']:
+                    idempotency_stats.inc('lookup_hits')
+                else:
+                    transfer_stats.inc('single_statement_commits')
+                    wallet_cache.put(
+                        result['wallet_id'], result['amount'], utcnow,
+                    )
+                    wallet_cache.put(
+                        request.to_wallet_id,
+                        result['to_wallet_amount'],
+                        utcnow,
+                    )
+
+                response = WalletResponse.construct(
+                    wallet_id=result['wallet_id'],
+                    amount=Amount.validate(result['amount']),
+                )
+                recent_keys.put(idempotency_key, response)
+                return response
+            except exc.IntegrityError as exception:
+                db.rollback()
+
+                if retry.pgcode(exception) == retry.UNIQUE_VIOLATION:
+                    idempotency_stats.inc('conflicts')
+                    return cls._existed_response(
+                        db, idempotency_key, to_wallet=False, committed=True,
+                    )
+                transfer_stats.inc('integrity_errors')
+            except exc.OperationalError as exception:
+                db.rollback()
+
+                if not retry.is_transient(exception):
+                    raise
+                transfer_stats.inc('single_statement_aborts')
+
+    @classmethod
+    def _existed_transaction(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            committed: bool = True,
+    ) -> Optional[Row]:
+        """Same as DBHelper._existed_transaction, returns just a Row."""
+        if settings.SQLALCHEMY_REPLICA_URIS:
+            replica_db = replica_session()
+            try:
+                existed_transaction = replica_db.connection().execute(
+                    EXISTED_TRANSACTION_STATEMENT,
+                    dict(idempotency_key=idempotency_key),
+                ).first()
+            finally:
+                replica_db.close()
+
+            if existed_transaction or not committed:
+                return existed_transaction
+
+        return db.connection().execute(
+            EXISTED_TRANSACTION_STATEMENT,
+            dict(idempotency_key=idempotency_key),
+        ).first()
@@ -0,0 +1,194 @@
+import csv
+import datetime
+import decimal
+import io
+import itertools
+import uuid
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.amount import AMOUNT_SQL_TYPE
+from app.db.sharded_helper import shard_index
+from app.schemas import to_stored_amount
+
+CREATE_STAGING_TABLE = text(
+    '''
+    CREATE TEMPORARY TABLE donation_import (
+        position bigint NOT NULL,
+        idempotency_key uuid NOT NULL,
+        wallet_id uuid NOT NULL,
+        amount {amount_type} NOT NULL
+    ) ON COMMIT DROP
+    '''.format(amount_type=AMOUNT_SQL_TYPE)
+)
+
+# Apply the staged chunk: skip the used keys and the unknown wallets,
+# lock the wallets in order, write the ledger rows with the balance
+# after each of them in file order, and credit every wallet once.
+APPLY_STATEMENT = text(
+    '''
+    WITH fresh AS (
+        SELECT DISTINCT ON (idempotency_key) *
+        FROM donation_import
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM transactionkey
+            WHERE transactionkey.idempotency_key
+                = donation_import.idempotency_key
+        )
+        ORDER BY idempotency_key, position
+    ), locked AS (
+        SELECT
+            wallet_id,
+            amount + (
+                SELECT coalesce(sum(amount), 0)
+                FROM walletslot
+                WHERE walletslot.wallet_id = wallet.wallet_id
+            ) AS amount
+        FROM wallet
+        WHERE wallet_id IN (SELECT wallet_id FROM fresh)
+        ORDER BY wallet_id
+        FOR UPDATE
+    ), running AS (
+        SELECT
+            fresh.idempotency_key,
+            fresh.wallet_id,
+            fresh.amount,
+            locked.amount + sum(fresh.amount) OVER (
+                PARTITION BY fresh.wallet_id ORDER BY fresh.position
+            ) AS to_wallet_amount,
+            fresh.position
+        FROM fresh
+        JOIN locked USING (wallet_id)
+    ), ledger AS (
+        INSERT INTO transaction (
+            idempotency_key, amount, to_wallet_id, to_wallet_amount, created_at
+        )
+        SELECT
+            idempotency_key, amount, wallet_id, to_wallet_amount,
+            CAST(:utcnow AS timestamp)
+        FROM running
+        ORDER BY position
+        RETURNING 1
+    ), credited AS (
+        UPDATE wallet
+        SET amount = wallet.amount + total.amount, updated_at = :utcnow
+        FROM (
+            SELECT wallet_id, sum(amount) AS amount
+            FROM running
+            GROUP BY wallet_id
+        ) AS total
+        WHERE wallet.wallet_id = total.wallet_id
+        RETURNING 1
+    )
+    SELECT
+        (SELECT count(*) FROM donation_import) AS rows,
+        (SELECT count(*) FROM fresh) AS fresh,
+        (SELECT count(*) FROM ledger) AS imported,
+        (SELECT count(*) FROM credited) AS wallets
+    '''
+)
+
+
+def parse_row(
+        position: int,
+        idempotency_key: str,
+        wallet_id: str,
+        amount: str,
+) -> Tuple[int, uuid.UUID, uuid.UUID, Union[int, decimal.Decimal]]:
+    """Validate and convert a row the way WalletDonateRequest does."""
+    try:
+        row = (
+            position,
+            uuid.UUID(idempotency_key),
+            uuid.UUID(wallet_id),
+            decimal.Decimal(amount),
+        )
+    except (ValueError, TypeError, decimal.InvalidOperation):
+        raise ValueError('row {} is not valid'.format(position))
+
+    if not (
+            row[3].is_finite()
+            and row[3] > 0
+            and row[3].as_tuple().exponent >= -settings.CURRENCY_SCALE
+    ):
+        raise ValueError('amount of row {} is not valid'.format(position))
+    return row[:3] + (to_stored_amount(row[3]),)
+
+
+def import_donations(
+        db: Session,
+        rows: Iterable[Tuple[str, str, str]],
+        chunk_size: Optional[int] = None,
+        progress: Optional[Callable[[Dict[str, int]], None]] = None,
+        attempts: int = 3,
+        shard: Optional[int] = None,
+) -> Dict[str, int]:
+    """Donate (idempotency_key, wallet_id, amount) rows in chunks.
+
+    Every chunk is copied to a staging table and applied by one
+    statement in its own transaction, so memory doesn't depend on the
+    number of rows and an interrupted import can just be run again.
+    Rows of used keys and unknown wallets are skipped. Invalid rows
+    raise ValueError, the chunks before them are imported. With a shard,
+    db is a session of it and the rows of the wallets of the other
+    shards are skipped as well.
+    """
+    chunk_size = chunk_size or settings.DONATION_IMPORT_CHUNK_SIZE
+    totals = dict(
+        rows=0, imported=0, duplicates=0, unknown_wallets=0, other_shards=0,
+    )
+
+    positions = itertools.count(1)
+    rows = iter(rows)
+    while True:
+        chunk = io.StringIO()
+        writer = csv.writer(chunk)
+        read = 0
+        for row in itertools.islice(rows, chunk_size):
+            read += 1
+            row = parse_row(next(positions), *row)
+            if shard is not None and shard_index(row[2]) != shard:
+                totals['other_shards'] += 1
+            else:
+                writer.writerow(row)
+        if not read:
+            return totals
+
+        for attempt in range(attempts):
+            try:
+                chunk.seek(0)
+                db.execute(CREATE_STAGING_TABLE)
+                db.connection().connection.cursor().copy_expert(
+                    'COPY donation_import'
+                    ' (position, idempotency_key, wallet_id, amount)'
+                    ' FROM STDIN WITH (FORMAT csv)',
+                    chunk,
+                )
+                result = db.execute(
+                    APPLY_STATEMENT,
+                    dict(utcnow=datetime.datetime.utcnow()),
+                ).first()
+                db.commit()
+                break
+            except exc.IntegrityError:
+                # a key has been used concurrently, it is skipped now
+                db.rollback()
+                if attempt == attempts - 1:
+                    raise
+
+        totals['rows'] += result['rows']
+        totals['imported'] += result['imported']
+        totals['duplicates'] += result['rows'] - result['fresh']
+        totals['unknown_wallets'] += result['fresh'] - result['imported']
+        if progress:
+            progress(dict(totals))
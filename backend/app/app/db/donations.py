@@ -0,0 +1,102 @@
+import threading
+import uuid
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from app.core.config import settings
+from app.core.stats import Counters
+
+donation_stats = Counters('donations')
+
+
+class _Waiter:
+    __slots__ = ('item', 'done', 'result', 'error')
+
+    def __init__(self, item: Any) -> None:
+        self.item = item
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.waiters: List[_Waiter] = []
+        self.full = threading.Event()
+
+
+class DonationBatcher:
+    """Group commit of concurrent donations to the same wallet.
+
+    The first donation to a wallet becomes the leader: it waits up to
+    window seconds or until max_size donations have joined, then flushes
+    all of them at once in its own thread and hands every waiter its
+    result. flush gets the items in arrival order and returns one result
+    per item, an exception it raises is raised by every waiter.
+    """
+
+    def __init__(self, window: float, max_size: int) -> None:
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._batches: Dict[uuid.UUID, _Batch] = {}
+
+    def submit(
+            self,
+            wallet_id: uuid.UUID,
+            item: Any,
+            flush: Callable[[List[Any]], List[Any]],
+    ) -> Any:
+        waiter = _Waiter(item)
+        with self._lock:
+            batch = self._batches.get(wallet_id)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._batches[wallet_id] = _Batch()
+            batch.waiters.append(waiter)
+            if len(batch.waiters) >= self.max_size:
+                # nobody else can join, the leader flushes right away
+                del self._batches[wallet_id]
+                batch.full.set()
+
+        if is_leader:
+            self._lead(wallet_id, batch, flush)
+        else:
+            waiter.done.wait()
+
+        if waiter.error:
+            raise waiter.error
+        return waiter.result
+
+    def _lead(
+            self,
+            wallet_id: uuid.UUID,
+            batch: _Batch,
+            flush: Callable[[List[Any]], List[Any]],
+    ) -> None:
+        batch.full.wait(self.window)
+        with self._lock:
+            if self._batches.get(wallet_id) is batch:
+                del self._batches[wallet_id]
+
+        donation_stats.inc('batches')
+        donation_stats.inc('donations', len(batch.waiters))
+        try:
+            results = flush([waiter.item for waiter in batch.waiters])
+            for waiter, result in zip(batch.waiters, results):
+                waiter.result = result
+        except BaseException as e:
+            for waiter in batch.waiters:
+                waiter.error = e
+            raise
+        finally:
+            for waiter in batch.waiters:
+                waiter.done.set()
+
+
+donation_batcher = DonationBatcher(
+    settings.DONATION_BATCH_WINDOW, settings.DONATION_BATCH_MAX_SIZE,
+)
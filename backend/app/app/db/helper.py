@@ -1,42 +1,523 @@
 import datetime
+import decimal
+import functools
 import uuid
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 from fastapi import HTTPException
 from psycopg2.errors import UniqueViolation
+from sqlalchemy import and_
 from sqlalchemy import exc
+from sqlalchemy import bindparam
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import tuple_
+from sqlalchemy import union_all
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 
+from app.core.config import TransferLocking
+from app.core.config import settings
+from app.core.metrics import PhaseTimer
+from app.core.stats import Counters
+from app.db import retry
+from app.db.amount import AMOUNT_SQL_TYPE
+from app.db.cache import wallet_cache
+from app.db.donations import donation_batcher
+from app.db.donations import donation_stats
+from app.db.hot_wallets import FOLD_SLOTS_STATEMENT
+from app.db.hot_wallets import SLOT_DONATE_STATEMENT
+from app.db.hot_wallets import hot_wallets
+from app.db.idempotency import idempotency_stats
+from app.db.idempotency import recent_keys
+from app.db.session import replica_session
+from app.schemas import WalletCreateBatchRequest
+from app.schemas import WalletCreateBatchResponse
 from app.schemas import WalletDonateRequest
+from app.schemas import WalletGetBatchItemResponse
+from app.schemas import WalletGetBatchRequest
+from app.schemas import WalletGetBatchResponse
 from app.schemas import WalletTransferRequest
+from app.schemas import WalletTransferBatchItem
+from app.schemas import WalletTransferBatchRequest
+from app.schemas import WalletTransferBatchItemResponse
+from app.schemas import WalletTransferBatchResponse
 from app.schemas import WalletResponse
+from app.schemas import WalletSlotsRequest
+from app.schemas import WalletTransaction
+from app.schemas import WalletTransactionsRequest
+from app.schemas import WalletTransactionsResponse
 from app.models import Wallet
+from app.models import WalletSlot
 from app.models import Transaction
+from app.models import TransactionKey
+
+transfer_stats = Counters('transfer')
+
+
+def transaction_by_key(idempotency_key: uuid.UUID):
+    """Filter of the transaction with the key.
+
+    created_at from TransactionKey lets Postgres look into the one
+    partition of the transaction instead of all of them.
+    """
+    return and_(
+        Transaction.idempotency_key == idempotency_key,
+        Transaction.created_at == (
+            select(TransactionKey.created_at)
+            .where(TransactionKey.idempotency_key == idempotency_key)
+            .scalar_subquery()
+        ),
+    )
+
+
+# Credit the wallet and write the ledger row in one statement, unless
+# the key is already used: then its transaction is returned as replayed
+# without touching the wallet. No row means the wallet is not found.
+DONATE_STATEMENT = text(
+    '''
+    WITH existed AS (
+        SELECT to_wallet_id, to_wallet_amount
+        FROM transaction
+        WHERE idempotency_key = :idempotency_key
+            AND created_at = (
+                SELECT created_at
+                FROM transactionkey
+                WHERE idempotency_key = :idempotency_key
+            )
+    ), credited AS (
+        UPDATE wallet
+        SET amount = amount + :amount, updated_at = :utcnow
+        WHERE wallet_id = :wallet_id AND NOT EXISTS (SELECT 1 FROM existed)
+        RETURNING wallet_id, amount
+    ), ledger AS (
+        INSERT INTO transaction (
+            idempotency_key, amount, to_wallet_id, to_wallet_amount, created_at
+        )
+        SELECT
+            CAST(:idempotency_key AS uuid), CAST(:amount AS {amount_type}),
+            wallet_id,
+            amount + (
+                SELECT coalesce(sum(amount), 0)
+                FROM walletslot
+                WHERE wallet_id = :wallet_id
+            ),
+            CAST(:utcnow AS timestamp)
+        FROM credited
+        RETURNING to_wallet_id, to_wallet_amount
+    )
+    SELECT
+        to_wallet_id AS wallet_id, to_wallet_amount AS amount,
+        false AS replayed
+    FROM ledger
+    UNION ALL
+    SELECT to_wallet_id, to_wallet_amount, true
+    FROM existed
+    '''.format(amount_type=AMOUNT_SQL_TYPE)
+).bindparams(
+    bindparam('idempotency_key', type_=UUID(as_uuid=True)),
+    bindparam('wallet_id', type_=UUID(as_uuid=True)),
+)
+
+# Lock both wallets ordered by wallet_id, fold the slots of a hot payer,
+# move the money only when both exist and the balance is enough, and
+# write the ledger row. The slots of a hot recipient are left to its
+# donations, they are only added to its balance, as in DONATE_STATEMENT.
+# A used key is replayed without locking anything.
+# The result is always one row: wallet_id is NULL when nothing has been
+# changed, from_wallet_amount then tells the reason.
+TRANSFER_STATEMENT = text(
+    '''
+    WITH existed AS (
+        SELECT from_wallet_id, from_wallet_amount
+        FROM transaction
+        WHERE idempotency_key = :idempotency_key
+            AND created_at = (
+                SELECT created_at
+                FROM transactionkey
+                WHERE idempotency_key = :idempotency_key
+            )
+    ), locked AS (
+        SELECT wallet_id, amount
+        FROM wallet
+        WHERE wallet_id IN (:from_wallet_id, :to_wallet_id)
+            AND NOT EXISTS (SELECT 1 FROM existed)
+        ORDER BY wallet_id
+        FOR UPDATE
+    ), folded AS (
+        UPDATE walletslot
+        SET amount = 0
+        FROM (
+            SELECT id, amount
+            FROM walletslot
+            WHERE wallet_id = :from_wallet_id
+                AND amount <> 0
+                AND (SELECT count(*) FROM locked) = 2
+            ORDER BY id
+            FOR UPDATE
+        ) AS slot
+        WHERE walletslot.id = slot.id
+        RETURNING slot.amount
+    ), debited AS (
+        UPDATE wallet
+        SET
+            amount = (
+                amount + (SELECT coalesce(sum(amount), 0) FROM folded)
+                - :amount
+            ),
+            updated_at = :utcnow
+        WHERE wallet_id = :from_wallet_id
+            AND (
+                amount + (SELECT coalesce(sum(amount), 0) FROM folded)
+                >= :amount
+            )
+            AND (SELECT count(*) FROM locked) = 2
+        RETURNING wallet_id, amount
+    ), credited AS (
+        UPDATE wallet
+        SET amount = amount + :amount, updated_at = :utcnow
+        WHERE wallet_id = :to_wallet_id AND EXISTS (SELECT 1 FROM debited)
+        RETURNING wallet_id, amount
+    ), ledger AS (
+        INSERT INTO transaction (
+            idempotency_key, amount,
+            from_wallet_id, from_wallet_amount,
+            to_wallet_id, to_wallet_amount,
+            created_at
+        )
+        SELECT
+            CAST(:idempotency_key AS uuid), CAST(:amount AS {amount_type}),
+            debited.wallet_id, debited.amount,
+            credited.wallet_id,
+            credited.amount + (
+                SELECT coalesce(sum(amount), 0)
+                FROM walletslot
+                WHERE wallet_id = :to_wallet_id
+            ),
+            CAST(:utcnow AS timestamp)
+        FROM debited, credited
+        RETURNING from_wallet_id, from_wallet_amount, to_wallet_amount
+    )
+    SELECT
+        coalesce(ledger.from_wallet_id, existed.from_wallet_id) AS wallet_id,
+        coalesce(
+            ledger.from_wallet_amount, existed.from_wallet_amount
+        ) AS amount,
+        ledger.to_wallet_amount,
+        (
+            SELECT amount FROM locked WHERE wallet_id = :from_wallet_id
+        ) + (
+            SELECT coalesce(sum(amount), 0)
+            FROM walletslot
+            WHERE wallet_id = :from_wallet_id
+        ) AS from_wallet_amount,
+        existed.from_wallet_id IS NOT NULL AS replayed
+    FROM (SELECT 1) AS outcome
+    LEFT JOIN ledger ON true
+    LEFT JOIN existed ON true
+    '''.format(amount_type=AMOUNT_SQL_TYPE)
+).bindparams(
+    bindparam('idempotency_key', type_=UUID(as_uuid=True)),
+    bindparam('from_wallet_id', type_=UUID(as_uuid=True)),
+    bindparam('to_wallet_id', type_=UUID(as_uuid=True)),
+)
+
+# Balances of the wallets with their slots, the ones that don't exist
+# are left out
+GET_WALLETS_STATEMENT = text(
+    '''
+    SELECT
+        wallet_id,
+        amount + CASE
+            WHEN slots > 0 THEN (
+                SELECT coalesce(sum(walletslot.amount), 0)
+                FROM walletslot
+                WHERE walletslot.wallet_id = wallet.wallet_id
+            )
+            ELSE 0
+        END AS amount,
+        updated_at
+    FROM wallet
+    WHERE wallet_id = ANY(CAST(:wallet_ids AS uuid[]))
+    '''
+)
+
+UPDATE_WALLET_AMOUNTS = text(
+    '''
+    UPDATE wallet
+    SET amount = batch.amount, updated_at = :updated_at
+    FROM unnest(
+        CAST(:wallet_ids AS uuid[]),
+        CAST(:amounts AS {amount_type}[])
+    ) AS batch(wallet_id, amount)
+    WHERE wallet.wallet_id = batch.wallet_id
+    '''.format(amount_type=AMOUNT_SQL_TYPE)
+)
+
+# Create the wallets of the new keys, a used key gets its wallet back
+# without writing anything. Wallets created by a concurrent request
+# after the statement has started are not seen: their wallet_id is NULL.
+CREATE_WALLETS_STATEMENT = text(
+    '''
+    WITH requested AS (
+        SELECT idempotency_key, wallet_id, position
+        FROM unnest(
+            CAST(:idempotency_keys AS uuid[]),
+            CAST(:wallet_ids AS uuid[])
+        ) WITH ORDINALITY AS batch(idempotency_key, wallet_id, position)
+    ), inserted AS (
+        INSERT INTO wallet (idempotency_key, wallet_id, amount, created_at)
+        SELECT DISTINCT ON (idempotency_key)
+            idempotency_key, wallet_id, 0, CAST(:utcnow AS timestamp)
+        FROM requested
+        ORDER BY idempotency_key, position
+        ON CONFLICT ON CONSTRAINT wallet_idempotency_key_key DO NOTHING
+        RETURNING idempotency_key, wallet_id, amount
+    )
+    SELECT
+        requested.idempotency_key,
+        coalesce(inserted.wallet_id, wallet.wallet_id) AS wallet_id,
+        coalesce(inserted.amount, wallet.amount) AS amount
+    FROM requested
+    LEFT JOIN inserted USING (idempotency_key)
+    LEFT JOIN wallet ON wallet.idempotency_key = requested.idempotency_key
+    ORDER BY requested.position
+    '''
+)
 
 
 class DBHelper:
 
     @classmethod
     def wallet_get(cls, db: Session, wallet_id: uuid.UUID) -> WalletResponse:
+        amount = wallet_cache.get(wallet_id)
+        if amount is not None:
+            return WalletResponse(wallet_id=wallet_id, amount=amount)
+
         wallet = db.query(Wallet).filter(Wallet.wallet_id == wallet_id).first()
 
         if not wallet:
             raise HTTPException(status_code=404, detail='Wallet is not found')
 
+        amount = wallet.amount
+        if wallet.slots:
+            amount += cls._slots_amount(db, wallet_id)
+        wallet_cache.put(wallet.wallet_id, amount, wallet.updated_at)
+
         return WalletResponse(
             wallet_id=wallet.wallet_id,
-            amount=wallet.amount,
+            amount=amount,
+        )
+
+    @classmethod
+    def wallet_get_batch(
+            cls,
+            db: Session,
+            request: WalletGetBatchRequest,
+    ) -> WalletGetBatchResponse:
+        """Balances of the wallets in the order requested.
+
+        The ones not cached are read with one query, a missing wallet
+        is reported in its item.
+        """
+        amounts = {}
+        for wallet_id in request.wallet_ids:
+            amount = wallet_cache.get(wallet_id)
+            if amount is not None:
+                amounts[wallet_id] = amount
+
+        unknown_ids = {
+            wallet_id
+            for wallet_id in request.wallet_ids
+            if wallet_id not in amounts
+        }
+        if unknown_ids:
+            for row in db.execute(
+                GET_WALLETS_STATEMENT,
+                dict(wallet_ids=[str(i) for i in unknown_ids]),
+            ):
+                amounts[row.wallet_id] = row.amount
+                wallet_cache.put(row.wallet_id, row.amount, row.updated_at)
+
+        results = []
+        for wallet_id in request.wallet_ids:
+            if wallet_id in amounts:
+                results.append(
+                    WalletGetBatchItemResponse(
+                        wallet_id=wallet_id,
+                        status_code=200,
+                        amount=amounts[wallet_id],
+                    )
+                )
+            else:
+                results.append(
+                    WalletGetBatchItemResponse(
+                        wallet_id=wallet_id,
+                        status_code=404,
+                        detail='Wallet is not found',
+                    )
+                )
+        return WalletGetBatchResponse(results=results)
+
+    @classmethod
+    def wallet_transactions(
+            cls,
+            db: Session,
+            request: WalletTransactionsRequest,
+    ) -> WalletTransactionsResponse:
+        """One page of the wallet history, newest first."""
+        cls.wallet_check(db, request.wallet_id)
+
+        after = None
+        if request.cursor:
+            try:
+                created_at, id_ = request.cursor.rsplit('_', 1)
+                after = (
+                    datetime.datetime.fromisoformat(created_at), int(id_),
+                )
+            except ValueError:
+                raise HTTPException(
+                    status_code=400,
+                    detail='cursor is not valid',
+                )
+
+        rows = db.execute(cls._transactions_query(
+            request.wallet_id, after, request.limit + 1,
+        )).all()
+
+        next_cursor = None
+        if len(rows) > request.limit:
+            rows = rows[:request.limit]
+            next_cursor = '{}_{}'.format(
+                rows[-1]['created_at'].isoformat(), rows[-1]['id'],
+            )
+
+        return WalletTransactionsResponse(
+            transactions=[WalletTransaction(**row) for row in rows],
+            next_cursor=next_cursor,
+        )
+
+    @classmethod
+    def wallet_transactions_export(
+            cls,
+            db: Session,
+            wallet_id: uuid.UUID,
+    ) -> Iterator[WalletTransaction]:
+        """The whole wallet history, newest first, read from a
+        server-side cursor so memory doesn't grow with the history.
+        """
+        result = db.execute(
+            cls._transactions_query(wallet_id)
+            .execution_options(stream_results=True)
+        )
+        try:
+            for rows in result.partitions(
+                    settings.TRANSACTIONS_EXPORT_BATCH_SIZE,
+            ):
+                for row in rows:
+                    yield WalletTransaction(**row)
+        finally:
+            # the client may go away in the middle
+            result.close()
+
+    @classmethod
+    def _transactions_query(
+            cls,
+            wallet_id: uuid.UUID,
+            after: Optional[Tuple[datetime.datetime, int]] = None,
+            limit: Optional[int] = None,
+    ):
+        """Transactions of both sides, each side is an index-only scan
+        and Postgres merges them in order.
+        """
+        sides = []
+        for wallet_column, balance_column in (
+                (Transaction.from_wallet_id, Transaction.from_wallet_amount),
+                (Transaction.to_wallet_id, Transaction.to_wallet_amount),
+        ):
+            side = (
+                select(
+                    Transaction.id,
+                    Transaction.idempotency_key,
+                    Transaction.from_wallet_id,
+                    Transaction.to_wallet_id,
+                    Transaction.amount,
+                    balance_column.label('balance'),
+                    Transaction.created_at,
+                )
+                .where(wallet_column == wallet_id)
+                .order_by(Transaction.created_at.desc(), Transaction.id.desc())
+                .limit(limit)
+            )
+            if after:
+                side = side.where(
+                    tuple_(Transaction.created_at, Transaction.id)
+                    < tuple_(*after)
+                )
+            sides.append(side)
+
+        history = union_all(*sides).subquery()
+        return (
+            select(history)
+            .order_by(history.c.created_at.desc(), history.c.id.desc())
+            .limit(limit)
         )
 
+    @classmethod
+    def wallet_check(cls, db: Session, wallet_id: uuid.UUID) -> None:
+        """Raise 404 unless the wallet exists."""
+        if not (
+            db.query(Wallet.id).filter(Wallet.wallet_id == wallet_id).first()
+        ):
+            raise HTTPException(status_code=404, detail='Wallet is not found')
+
+    @classmethod
+    def wallet_balances(
+            cls,
+            db: Session,
+            wallet_ids: List[uuid.UUID],
+    ) -> List[WalletResponse]:
+        """Balances of the wallets with their slots, in one query.
+
+        Raises 404 unless all of them exist.
+        """
+        slots = (
+            select(func.coalesce(func.sum(WalletSlot.amount), 0))
+            .where(WalletSlot.wallet_id == Wallet.wallet_id)
+            .scalar_subquery()
+        )
+        rows = (
+            db.query(Wallet.wallet_id, (Wallet.amount + slots).label('amount'))
+            .filter(Wallet.wallet_id.in_(wallet_ids))
+            .all()
+        )
+        if len(rows) < len(set(wallet_ids)):
+            raise HTTPException(status_code=404, detail='Wallet is not found')
+        return [
+            WalletResponse(wallet_id=row.wallet_id, amount=row.amount)
+            for row in rows
+        ]
+
     @classmethod
     def wallet_create(
             cls,
             db: Session,
             idempotency_key: uuid.UUID,
+            wallet_id: Optional[uuid.UUID] = None,
     ) -> WalletResponse:
+        """The wallet of the key, a new one gets wallet_id or a random id."""
         query = (
             pg_insert(Wallet)
-            .values(wallet_id=uuid.uuid4(), idempotency_key=idempotency_key)
+            .values(
+                wallet_id=wallet_id or uuid.uuid4(),
+                idempotency_key=idempotency_key,
+            )
             .returning(Wallet.wallet_id, Wallet.amount)
         )
         query = query.on_conflict_do_update(
@@ -45,12 +526,63 @@ class DBHelper:
         )
         result = db.execute(query).first()
         db.commit()
+        wallet_cache.put(result['wallet_id'], result['amount'], None)
 
         return WalletResponse(
             wallet_id=result['wallet_id'],
             amount=result['amount'],
         )
 
+    @classmethod
+    def wallet_create_batch(
+            cls,
+            db: Session,
+            request: WalletCreateBatchRequest,
+    ) -> WalletCreateBatchResponse:
+        """Create the wallets in one statement, see CREATE_WALLETS_STATEMENT.
+
+        Wallets are returned in the order of the keys.
+        """
+        rows = db.execute(
+            CREATE_WALLETS_STATEMENT,
+            dict(
+                idempotency_keys=[str(i) for i in request.idempotency_keys],
+                wallet_ids=[
+                    str(uuid.uuid4()) for _ in request.idempotency_keys
+                ],
+                utcnow=datetime.datetime.utcnow(),
+            ),
+        ).all()
+        db.commit()
+
+        wallets = {
+            row['idempotency_key']: (row['wallet_id'], row['amount'])
+            for row in rows
+            if row['wallet_id']
+        }
+        racing_keys = set(request.idempotency_keys) - set(wallets)
+        if racing_keys:
+            # committed by now, a new statement sees them
+            wallets.update(
+                (idempotency_key, (wallet_id, amount))
+                for idempotency_key, wallet_id, amount in (
+                    db.query(
+                        Wallet.idempotency_key,
+                        Wallet.wallet_id,
+                        Wallet.amount,
+                    )
+                    .filter(Wallet.idempotency_key.in_(racing_keys))
+                )
+            )
+
+        return WalletCreateBatchResponse(wallets=[
+            WalletResponse(
+                wallet_id=wallets[idempotency_key][0],
+                amount=wallets[idempotency_key][1],
+            )
+            for idempotency_key in request.idempotency_keys
+        ])
+
     @classmethod
     def wallet_donate(
             cls,
@@ -58,6 +590,113 @@ class DBHelper:
             idempotency_key: uuid.UUID,
             request: WalletDonateRequest,
     ) -> WalletResponse:
+        if hot_wallets.contains(db, request.wallet_id):
+            response = cls.wallet_donate_slot(db, idempotency_key, request)
+            if response:
+                return response
+
+        if settings.DONATION_BATCH_ENABLED:
+            response = cls.wallet_donate_batched(db, idempotency_key, request)
+            if response:
+                return response
+
+        if settings.WALLET_SINGLE_STATEMENT:
+            return cls.wallet_donate_cte(db, idempotency_key, request)
+        return cls.wallet_donate_orm(db, idempotency_key, request)
+
+    @classmethod
+    def wallet_donate_batched(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> Optional[WalletResponse]:
+        """Donate together with the concurrent donations to the wallet.
+
+        Returns None when the batch could not be committed, the donation
+        then has to be made on its own.
+        """
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        return donation_batcher.submit(
+            request.wallet_id,
+            (idempotency_key, request),
+            functools.partial(cls._apply_donation_batch, db),
+        )
+
+    @classmethod
+    def wallet_donate_slot(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> Optional[WalletResponse]:
+        """Donate to a free slot of a hot wallet, see SLOT_DONATE_STATEMENT.
+
+        Returns None when there is no free slot, the donation then has
+        to wait for the wallet row as usual.
+        """
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        try:
+            timer = PhaseTimer('donate_slot')
+            utcnow = datetime.datetime.utcnow()
+            result = db.execute(
+                SLOT_DONATE_STATEMENT,
+                dict(
+                    idempotency_key=idempotency_key,
+                    wallet_id=request.wallet_id,
+                    amount=request.amount,
+                    utcnow=utcnow,
+                ),
+            ).first()
+            timer.lap('statement')
+            if not result:
+                db.rollback()
+                return None
+
+            db.commit()
+            timer.lap('commit')
+            if result['replayed']:
+                idempotency_stats.inc('lookup_hits')
+            else:
+                wallet_cache.put(
+                    result['wallet_id'], result['amount'], utcnow,
+                )
+
+            response = WalletResponse(
+                wallet_id=result['wallet_id'],
+                amount=result['amount'],
+            )
+            recent_keys.put(idempotency_key, response)
+            return response
+        except exc.IntegrityError:
+            db.rollback()
+
+            idempotency_stats.inc('conflicts')
+            return cls._existed_response(
+                db, idempotency_key, to_wallet=True, committed=True,
+            )
+
+    @classmethod
+    def wallet_donate_orm(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> WalletResponse:
+        timer = PhaseTimer('donate')
+        existed_response = cls._existed_response(
+            db, idempotency_key, to_wallet=True,
+        )
+        timer.lap('lookup')
+        if existed_response:
+            return existed_response
+
         try:
             db_wallet = (
                 db.query(Wallet)
@@ -71,11 +710,19 @@ class DBHelper:
                     detail='Wallet is not found',
                 )
 
+            if db_wallet.slots:
+                db_wallet.amount += cls._fold_slots(
+                    db, [db_wallet.wallet_id],
+                ).get(db_wallet.wallet_id, 0)
+            timer.lap('lock')
+
             utcnow = datetime.datetime.utcnow()
 
             db_wallet.amount = db_wallet.amount + request.amount
             db_wallet.updated_at = utcnow
             db.add(db_wallet)
+            db.flush()
+            timer.lap('update')
 
             insert_transaction = (
                 pg_insert(Transaction)
@@ -89,25 +736,78 @@ class DBHelper:
                 .returning(Transaction.to_wallet_amount)
             )
             db.execute(insert_transaction).first()
+            timer.lap('ledger')
 
             db.commit()
+            timer.lap('commit')
+            wallet_cache.put(db_wallet.wallet_id, db_wallet.amount, utcnow)
 
-            return WalletResponse(
+            response = WalletResponse(
                 wallet_id=db_wallet.wallet_id,
                 amount=db_wallet.amount,
             )
+            recent_keys.put(idempotency_key, response)
+            return response
         except exc.IntegrityError:
             db.rollback()
 
-            existed_transaction = (
-                db.query(Transaction)
-                .filter(Transaction.idempotency_key == idempotency_key)
-                .first()
+            idempotency_stats.inc('conflicts')
+            return cls._existed_response(
+                db, idempotency_key, to_wallet=True, committed=True,
             )
 
-            return WalletResponse(
-                wallet_id=existed_transaction.to_wallet_id,
-                amount=existed_transaction.to_wallet_amount,
+    @classmethod
+    def wallet_donate_cte(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> WalletResponse:
+        """Donate in one round trip, see DONATE_STATEMENT."""
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        try:
+            timer = PhaseTimer('donate_single_statement')
+            utcnow = datetime.datetime.utcnow()
+            result = db.execute(
+                DONATE_STATEMENT,
+                dict(
+                    idempotency_key=idempotency_key,
+                    wallet_id=request.wallet_id,
+                    amount=request.amount,
+                    utcnow=utcnow,
+                ),
+            ).first()
+            timer.lap('statement')
+            if not result:
+                raise HTTPException(
+                    status_code=404,
+                    detail='Wallet is not found',
+                )
+
+            db.commit()
+            timer.lap('commit')
+            if result['replayed']:
+                idempotency_stats.inc('lookup_hits')
+            else:
+                wallet_cache.put(
+                    result['wallet_id'], result['amount'], utcnow,
+                )
+
+            response = WalletResponse(
+                wallet_id=result['wallet_id'],
+                amount=result['amount'],
+            )
+            recent_keys.put(idempotency_key, response)
+            return response
+        except exc.IntegrityError:
+            db.rollback()
+
+            idempotency_stats.inc('conflicts')
+            return cls._existed_response(
+                db, idempotency_key, to_wallet=True, committed=True,
             )
 
     @classmethod
@@ -117,28 +817,69 @@ class DBHelper:
             idempotency_key: uuid.UUID,
             request: WalletTransferRequest,
     ) -> WalletResponse:
-        db.connection(execution_options={'isolation_level': 'SERIALIZABLE'})
+        if settings.WALLET_SINGLE_STATEMENT:
+            return cls.wallet_transfer_cte(db, idempotency_key, request)
+        return cls.wallet_transfer_orm(db, idempotency_key, request)
 
-        while True:
+    @classmethod
+    def wallet_transfer_orm(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletTransferRequest,
+    ) -> WalletResponse:
+        locking = settings.TRANSFER_LOCKING
+        isolation_level = (
+            'READ COMMITTED'
+            if locking == TransferLocking.pessimistic
+            else 'SERIALIZABLE'
+        )
+
+        existed_response = cls._existed_response(
+            db, idempotency_key, to_wallet=False,
+        )
+        if existed_response:
+            return existed_response
+        # the isolation level can be set only for a new transaction
+        db.rollback()
+
+        for _ in retry.attempts(transfer_stats):
             try:
-                db_from_wallet = (
-                    db.query(Wallet)
-                    .filter(Wallet.wallet_id == request.from_wallet_id)
-                    .first()
+                timer = PhaseTimer('transfer')
+                db.connection(
+                    execution_options={'isolation_level': isolation_level},
+                )
+
+                query = db.query(Wallet).filter(
+                    Wallet.wallet_id.in_(
+                        (request.from_wallet_id, request.to_wallet_id)
+                    )
                 )
+                if locking == TransferLocking.pessimistic:
+                    # lock in a deterministic order, so two opposite
+                    # transfers can't deadlock
+                    query = query.order_by(Wallet.wallet_id).with_for_update()
+                wallets = {wallet.wallet_id: wallet for wallet in query}
+
+                db_from_wallet = wallets.get(request.from_wallet_id)
                 if not db_from_wallet:
                     raise HTTPException(
                         status_code=404, detail='from_wallet_id is not found'
                     )
 
+                if db_from_wallet.slots:
+                    db_from_wallet.amount += cls._fold_slots(
+                        db, [db_from_wallet.wallet_id],
+                    ).get(db_from_wallet.wallet_id, 0)
+                timer.lap('lock')
+
                 if db_from_wallet.amount < request.amount:
-                    raise HTTPException(status_code=400, detail='not enough money')
+                    raise HTTPException(
+                        status_code=400,
+                        detail='not enough money',
+                    )
 
-                db_to_wallet = (
-                    db.query(Wallet)
-                    .filter(Wallet.wallet_id == request.to_wallet_id)
-                    .first()
-                )
+                db_to_wallet = wallets.get(request.to_wallet_id)
                 if not db_to_wallet:
                     raise HTTPException(
                         status_code=404,
@@ -153,6 +894,15 @@ class DBHelper:
                 db_to_wallet.updated_at = utcnow
                 db.add(db_from_wallet)
                 db.add(db_to_wallet)
+                db.flush()
+                timer.lap('update')
+
+                # the slots of a hot recipient stay with its donations
+                to_wallet_amount = db_to_wallet.amount
+                if db_to_wallet.slots:
+                    to_wallet_amount += cls._slots_amount(
+                        db, db_to_wallet.wallet_id,
+                    )
 
                 # insert Transaction
                 insert_transaction = pg_insert(Transaction).values(
@@ -161,28 +911,575 @@ class DBHelper:
                     from_wallet_id=db_from_wallet.wallet_id,
                     from_wallet_amount=db_from_wallet.amount,
                     to_wallet_id=db_to_wallet.wallet_id,
-                    to_wallet_amount=db_to_wallet.amount,
+                    to_wallet_amount=to_wallet_amount,
                     created_at=utcnow,
                 )
                 db.execute(insert_transaction).first()
+                timer.lap('ledger')
 
                 db.commit()
+                timer.lap('commit')
+                transfer_stats.inc(f'{locking.value}_commits')
+                wallet_cache.put(
+                    db_from_wallet.wallet_id, db_from_wallet.amount, utcnow,
+                )
+                wallet_cache.put(
+                    db_to_wallet.wallet_id, to_wallet_amount, utcnow,
+                )
 
-                return WalletResponse(
+                response = WalletResponse(
                     wallet_id=db_from_wallet.wallet_id,
                     amount=db_from_wallet.amount,
                 )
+                recent_keys.put(idempotency_key, response)
+                return response
             except exc.IntegrityError as exception:
                 db.rollback()
 
                 if isinstance(exception.orig, UniqueViolation):
-                    existed_transaction = (
-                        db.query(Transaction)
-                        .filter(Transaction.idempotency_key == idempotency_key)
-                        .first()
+                    idempotency_stats.inc('conflicts')
+                    return cls._existed_response(
+                        db, idempotency_key, to_wallet=False, committed=True,
+                    )
+                transfer_stats.inc('integrity_errors')
+            except exc.OperationalError as exception:
+                db.rollback()
+
+                if not retry.is_transient(exception):
+                    raise
+                transfer_stats.inc(f'{locking.value}_aborts')
+
+    @classmethod
+    def wallet_transfer_cte(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletTransferRequest,
+    ) -> WalletResponse:
+        """Transfer in one round trip, see TRANSFER_STATEMENT."""
+        existed_response = recent_keys.get(idempotency_key)
+        if existed_response:
+            return existed_response
+
+        for _ in retry.attempts(transfer_stats):
+            try:
+                timer = PhaseTimer('transfer_single_statement')
+                utcnow = datetime.datetime.utcnow()
+                result = db.execute(
+                    TRANSFER_STATEMENT,
+                    dict(
+                        idempotency_key=idempotency_key,
+                        from_wallet_id=request.from_wallet_id,
+                        to_wallet_id=request.to_wallet_id,
+                        amount=request.amount,
+                        utcnow=utcnow,
+                    ),
+                ).first()
+                timer.lap('statement')
+
+                if not result['wallet_id']:
+                    # nothing is changed, just release the locks
+                    db.rollback()
+
+                    from_wallet_amount = result['from_wallet_amount']
+                    if from_wallet_amount is None:
+                        raise HTTPException(
+                            status_code=404,
+                            detail='from_wallet_id is not found',
+                        )
+                    if from_wallet_amount < request.amount:
+                        raise HTTPException(
+                            status_code=400,
+                            detail='not enough money',
+                        )
+                    raise HTTPException(
+                        status_code=404,
+                        detail='db_to_wallet is not found',
+                    )
+
+                db.commit()
+                timer.lap('commit')
+                if result['replayed']:
+                    idempotency_stats.inc('lookup_hits')
+                else:
+                    transfer_stats.inc('single_statement_commits')
+                    wallet_cache.put(
+                        result['wallet_id'], result['amount'], utcnow,
+                    )
+                    wallet_cache.put(
+                        request.to_wallet_id,
+                        result['to_wallet_amount'],
+                        utcnow,
+                    )
+
+                response = WalletResponse(
+                    wallet_id=result['wallet_id'],
+                    amount=result['amount'],
+                )
+                recent_keys.put(idempotency_key, response)
+                return response
+            except exc.IntegrityError as exception:
+                db.rollback()
+
+                if isinstance(exception.orig, UniqueViolation):
+                    idempotency_stats.inc('conflicts')
+                    return cls._existed_response(
+                        db, idempotency_key, to_wallet=False, committed=True,
+                    )
+                transfer_stats.inc('integrity_errors')
+            except exc.OperationalError as exception:
+                db.rollback()
+
+                if not retry.is_transient(exception):
+                    raise
+                transfer_stats.inc('single_statement_aborts')
+
+    @classmethod
+    def wallet_transfer_batch(
+            cls,
+            db: Session,
+            request: WalletTransferBatchRequest,
+    ) -> WalletTransferBatchResponse:
+        for _ in retry.attempts(transfer_stats):
+            try:
+                utcnow = datetime.datetime.utcnow()
+                results, balances = cls._apply_transfer_batch(
+                    db, request.transfers, utcnow,
+                )
+                db.commit()
+                transfer_stats.inc('batch_commits')
+                for wallet_id, amount in balances.items():
+                    wallet_cache.put(wallet_id, amount, utcnow)
+                for result in results:
+                    if result.status_code == 200:
+                        recent_keys.put(
+                            result.idempotency_key,
+                            WalletResponse(
+                                wallet_id=result.wallet_id,
+                                amount=result.amount,
+                            ),
+                        )
+
+                return WalletTransferBatchResponse(results=results)
+            except exc.IntegrityError as exception:
+                db.rollback()
+
+                # a concurrent request has committed one of the keys,
+                # the next pass replays it like any other existed transaction
+                if not isinstance(exception.orig, UniqueViolation):
+                    raise
+                transfer_stats.inc('batch_integrity_errors')
+            except exc.OperationalError as exception:
+                db.rollback()
+
+                if not retry.is_transient(exception):
+                    raise
+                transfer_stats.inc('batch_aborts')
+
+    @classmethod
+    def wallet_set_slots(
+            cls,
+            db: Session,
+            request: WalletSlotsRequest,
+    ) -> WalletResponse:
+        """Make the wallet hot with that many slots, or cool with none.
+
+        The money of the current slots is moved back to the wallet row,
+        the new slots start empty.
+        """
+        db_wallet = (
+            db.query(Wallet)
+            .filter(Wallet.wallet_id == request.wallet_id)
+            .with_for_update()
+            .first()
+        )
+        if not db_wallet:
+            raise HTTPException(status_code=404, detail='Wallet is not found')
+
+        db_wallet.amount += cls._fold_slots(
+            db, [db_wallet.wallet_id],
+        ).get(db_wallet.wallet_id, 0)
+        db_wallet.slots = request.slots
+        db_wallet.updated_at = datetime.datetime.utcnow()
+        db.add(db_wallet)
+        db.query(WalletSlot).filter(
+            WalletSlot.wallet_id == db_wallet.wallet_id,
+        ).delete(synchronize_session=False)
+        db.add_all(
+            WalletSlot(wallet_id=db_wallet.wallet_id, slot=slot, amount=0)
+            for slot in range(request.slots)
+        )
+        db.commit()
+        hot_wallets.invalidate()
+        wallet_cache.put(
+            db_wallet.wallet_id, db_wallet.amount, db_wallet.updated_at,
+        )
+
+        return WalletResponse(
+            wallet_id=db_wallet.wallet_id,
+            amount=db_wallet.amount,
+        )
+
+    @classmethod
+    def _apply_donation_batch(
+            cls,
+            db: Session,
+            donations: List[Tuple[uuid.UUID, WalletDonateRequest]],
+    ) -> List[Optional[WalletResponse]]:
+        """Credit one wallet with all donations in one transaction.
+
+        Every donation gets the running balance right after it, used
+        keys get their original response.
+        """
+        wallet_id = donations[0][1].wallet_id
+        try:
+            db_wallet = (
+                db.query(Wallet)
+                .filter(Wallet.wallet_id == wallet_id)
+                .with_for_update()
+                .first()
+            )
+            if not db_wallet:
+                raise HTTPException(
+                    status_code=404,
+                    detail='Wallet is not found',
+                )
+
+            responses: Dict[uuid.UUID, WalletResponse] = {}
+            for key, to_wallet_id, to_wallet_amount in (
+                db.query(
+                    Transaction.idempotency_key,
+                    Transaction.to_wallet_id,
+                    Transaction.to_wallet_amount,
+                )
+                .filter(Transaction.idempotency_key.in_(
+                    {key for key, _ in donations}
+                ))
+            ):
+                idempotency_stats.inc('lookup_hits')
+                responses[key] = WalletResponse(
+                    wallet_id=to_wallet_id,
+                    amount=to_wallet_amount,
+                )
+
+            if db_wallet.slots:
+                db_wallet.amount += cls._fold_slots(
+                    db, [db_wallet.wallet_id],
+                ).get(db_wallet.wallet_id, 0)
+
+            utcnow = datetime.datetime.utcnow()
+            transaction_rows = []
+            for key, request in donations:
+                if key in responses:
+                    continue
+
+                db_wallet.amount += request.amount
+                transaction_rows.append(dict(
+                    idempotency_key=key,
+                    amount=request.amount,
+                    to_wallet_id=db_wallet.wallet_id,
+                    to_wallet_amount=db_wallet.amount,
+                    created_at=utcnow,
+                ))
+                responses[key] = WalletResponse(
+                    wallet_id=db_wallet.wallet_id,
+                    amount=db_wallet.amount,
+                )
+
+            if transaction_rows:
+                db_wallet.updated_at = utcnow
+                db.add(db_wallet)
+                db.execute(pg_insert(Transaction).values(transaction_rows))
+            db.commit()
+        except exc.SQLAlchemyError:
+            db.rollback()
+
+            donation_stats.inc('fallbacks')
+            return [None] * len(donations)
+
+        if transaction_rows:
+            wallet_cache.put(db_wallet.wallet_id, db_wallet.amount, utcnow)
+        for key, response in responses.items():
+            recent_keys.put(key, response)
+        return [responses[key] for key, _ in donations]
+
+    @classmethod
+    def _fold_slots(
+            cls,
+            db: Session,
+            wallet_ids: List[uuid.UUID],
+    ) -> Dict[uuid.UUID, decimal.Decimal]:
+        """Empty the slots of the locked wallets, returns the amounts."""
+        folded: Dict[uuid.UUID, decimal.Decimal] = {}
+        for wallet_id, amount in db.execute(
+                FOLD_SLOTS_STATEMENT,
+                dict(wallet_ids=[str(i) for i in wallet_ids]),
+        ):
+            folded[wallet_id] = folded.get(wallet_id, 0) + amount
+        return folded
+
+    @classmethod
+    def _slots_amount(
+            cls,
+            db: Session,
+            wallet_id: uuid.UUID,
+    ) -> decimal.Decimal:
+        """Money in the slots of the wallet, left where it is."""
+        return (
+            db.query(func.coalesce(func.sum(WalletSlot.amount), 0))
+            .filter(WalletSlot.wallet_id == wallet_id)
+            .scalar()
+        )
+
+    @classmethod
+    def _existed_response(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            to_wallet: bool,
+            committed: bool = False,
+    ) -> Optional[WalletResponse]:
+        """Response of the completed request with the key, if there is one.
+
+        Donations are answered with the credited wallet, transfers with
+        the debited one. A key known to be committed always has one, or
+        raises, see _missing_transaction.
+        """
+        response = recent_keys.get(idempotency_key)
+        if response:
+            return response
+
+        existed_transaction = cls._existed_transaction(
+            db, idempotency_key, committed,
+        )
+        if not existed_transaction:
+            if committed:
+                raise cls._missing_transaction(db, idempotency_key)
+            return None
+        if not committed:
+            idempotency_stats.inc('lookup_hits')
+
+        if to_wallet:
+            response = WalletResponse(
+                wallet_id=existed_transaction.to_wallet_id,
+                amount=existed_transaction.to_wallet_amount,
+            )
+        else:
+            response = WalletResponse(
+                wallet_id=existed_transaction.from_wallet_id,
+                amount=existed_transaction.from_wallet_amount,
+            )
+        recent_keys.put(idempotency_key, response)
+        return response
+
+    @classmethod
+    def _missing_transaction(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+    ) -> HTTPException:
+        """Error for a used key whose transaction is not found.
+
+        The key outlives a transaction whose month has been detached,
+        see app.db.partitions, and is gone once pruned.
+        """
+        archived = (
+            db.query(TransactionKey.idempotency_key)
+            .filter(TransactionKey.idempotency_key == idempotency_key)
+            .first()
+        )
+        db.rollback()
+        if archived:
+            idempotency_stats.inc('archived')
+            return HTTPException(
+                status_code=410,
+                detail='the transaction of the key is archived',
+            )
+        return HTTPException(
+            status_code=409,
+            detail='idempotency key is used by another request',
+        )
+
+    @classmethod
+    def _existed_transaction(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            committed: bool = True,
+    ) -> Optional[Transaction]:
+        """Look the key up, on a replica when there are ones.
+
+        A key known to be committed is looked for on the primary too
+        if the replica is behind.
+        """
+        if settings.SQLALCHEMY_REPLICA_URIS:
+            replica_db = replica_session()
+            try:
+                existed_transaction = (
+                    replica_db.query(Transaction)
+                    .filter(transaction_by_key(idempotency_key))
+                    .first()
+                )
+            finally:
+                replica_db.close()
+
+            if existed_transaction or not committed:
+                return existed_transaction
+
+        return (
+            db.query(Transaction)
+            .filter(transaction_by_key(idempotency_key))
+            .first()
+        )
+
+    @classmethod
+    def _apply_transfer_batch(
+            cls,
+            db: Session,
+            transfers: List[WalletTransferBatchItem],
+            utcnow: datetime.datetime,
+    ) -> Tuple[
+        List[WalletTransferBatchItemResponse],
+        Dict[uuid.UUID, decimal.Decimal],
+    ]:
+        """Apply transfers in order within the current DB transaction.
+
+        All involved wallets are locked in one pass sorted by wallet_id,
+        so concurrent batches can't deadlock each other. Balances are
+        tracked in memory and written back with one UPDATE, the ledger
+        with one multi-row INSERT.
+
+        Returns the result of every transfer and the new balances of
+        the changed wallets.
+        """
+        done: Dict[uuid.UUID, WalletTransferBatchItemResponse] = {}
+        for transfer in transfers:
+            response = recent_keys.get(transfer.idempotency_key)
+            if response:
+                done[transfer.idempotency_key] = (
+                    WalletTransferBatchItemResponse(
+                        idempotency_key=transfer.idempotency_key,
+                        status_code=200,
+                        wallet_id=response.wallet_id,
+                        amount=response.amount,
                     )
+                )
 
-                    return WalletResponse(
-                        wallet_id=existed_transaction.from_wallet_id,
-                        amount=existed_transaction.from_wallet_amount,
+        unknown_keys = [
+            transfer.idempotency_key
+            for transfer in transfers
+            if transfer.idempotency_key not in done
+        ]
+        existed_transactions = []
+        if unknown_keys:
+            existed_transactions = (
+                db.query(Transaction)
+                .filter(Transaction.idempotency_key.in_(unknown_keys))
+                .all()
+            )
+        for existed_transaction in existed_transactions:
+            done[existed_transaction.idempotency_key] = (
+                WalletTransferBatchItemResponse(
+                    idempotency_key=existed_transaction.idempotency_key,
+                    status_code=200,
+                    wallet_id=existed_transaction.from_wallet_id,
+                    amount=existed_transaction.from_wallet_amount,
+                )
+            )
+
+        wallet_ids = set()
+        for transfer in transfers:
+            if transfer.idempotency_key not in done:
+                wallet_ids.update(
+                    (transfer.from_wallet_id, transfer.to_wallet_id)
+                )
+        balances: Dict[uuid.UUID, decimal.Decimal] = {}
+        hot_wallet_ids = []
+        if wallet_ids:
+            locked_wallets = (
+                db.query(Wallet.wallet_id, Wallet.amount, Wallet.slots)
+                .filter(Wallet.wallet_id.in_(wallet_ids))
+                .order_by(Wallet.wallet_id)
+                .with_for_update()
+            )
+            for wallet_id, amount, slots in locked_wallets:
+                balances[wallet_id] = amount
+                if slots:
+                    hot_wallet_ids.append(wallet_id)
+
+        changed_wallet_ids = set()
+        if hot_wallet_ids:
+            for wallet_id, amount in cls._fold_slots(
+                    db, hot_wallet_ids,
+            ).items():
+                balances[wallet_id] += amount
+                changed_wallet_ids.add(wallet_id)
+        transaction_rows = []
+        results = []
+        for transfer in transfers:
+            key = transfer.idempotency_key
+            if key in done:
+                results.append(done[key])
+                continue
+
+            status_code, detail = 200, None
+            if transfer.from_wallet_id == transfer.to_wallet_id:
+                status_code, detail = 400, 'self-transfer is not possible'
+            elif transfer.from_wallet_id not in balances:
+                status_code, detail = 404, 'from_wallet_id is not found'
+            elif balances[transfer.from_wallet_id] < transfer.amount:
+                status_code, detail = 400, 'not enough money'
+            elif transfer.to_wallet_id not in balances:
+                status_code, detail = 404, 'db_to_wallet is not found'
+
+            if status_code != 200:
+                results.append(
+                    WalletTransferBatchItemResponse(
+                        idempotency_key=key,
+                        status_code=status_code,
+                        detail=detail,
                     )
+                )
+                continue
+
+            balances[transfer.from_wallet_id] -= transfer.amount
+            balances[transfer.to_wallet_id] += transfer.amount
+            changed_wallet_ids.update(
+                (transfer.from_wallet_id, transfer.to_wallet_id)
+            )
+            transaction_rows.append(
+                dict(
+                    idempotency_key=key,
+                    amount=transfer.amount,
+                    from_wallet_id=transfer.from_wallet_id,
+                    from_wallet_amount=balances[transfer.from_wallet_id],
+                    to_wallet_id=transfer.to_wallet_id,
+                    to_wallet_amount=balances[transfer.to_wallet_id],
+                    created_at=utcnow,
+                )
+            )
+            done[key] = WalletTransferBatchItemResponse(
+                idempotency_key=key,
+                status_code=200,
+                wallet_id=transfer.from_wallet_id,
+                amount=balances[transfer.from_wallet_id],
+            )
+            results.append(done[key])
+
+        changed_balances = {
+            wallet_id: balances[wallet_id]
+            for wallet_id in sorted(changed_wallet_ids)
+        }
+        if changed_balances:
+            db.execute(
+                UPDATE_WALLET_AMOUNTS,
+                dict(
+                    wallet_ids=[str(i) for i in changed_balances],
+                    amounts=list(changed_balances.values()),
+                    updated_at=utcnow,
+                ),
+            )
+        if transaction_rows:
+            db.execute(pg_insert(Transaction).values(transaction_rows))
+
+        return results, changed_balances
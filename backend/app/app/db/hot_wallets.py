@@ -0,0 +1,139 @@
+import threading
+import time
+import uuid
+from typing import Dict
+from typing import Set
+
+from sqlalchemy import bindparam
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.amount import AMOUNT_SQL_TYPE
+from app.models import WalletSlot
+
+# Credit a random slot of the wallet that is not locked by another
+# donation, the wallet row itself is not touched. to_wallet_amount is
+# the balance as seen by this transaction: the committed wallet and
+# slots plus the credited slot. No row means there is no free slot or
+# the wallet is not hot anymore.
+SLOT_DONATE_STATEMENT = text(
+    '''
+    WITH existed AS (
+        SELECT to_wallet_id, to_wallet_amount
+        FROM transaction
+        WHERE idempotency_key = :idempotency_key
+            AND created_at = (
+                SELECT created_at
+                FROM transactionkey
+                WHERE idempotency_key = :idempotency_key
+            )
+    ), slot AS (
+        SELECT id
+        FROM walletslot
+        WHERE wallet_id = :wallet_id AND NOT EXISTS (SELECT 1 FROM existed)
+        ORDER BY random()
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), credited AS (
+        UPDATE walletslot
+        SET amount = walletslot.amount + :amount
+        FROM slot
+        WHERE walletslot.id = slot.id
+        RETURNING walletslot.id, walletslot.amount
+    ), balance AS (
+        SELECT
+            credited.amount
+            + (SELECT amount FROM wallet WHERE wallet_id = :wallet_id)
+            + (
+                SELECT coalesce(sum(amount), 0)
+                FROM walletslot
+                WHERE wallet_id = :wallet_id AND id <> credited.id
+            ) AS amount
+        FROM credited
+    ), ledger AS (
+        INSERT INTO transaction (
+            idempotency_key, amount, to_wallet_id, to_wallet_amount, created_at
+        )
+        SELECT
+            CAST(:idempotency_key AS uuid), CAST(:amount AS {amount_type}),
+            CAST(:wallet_id AS uuid), balance.amount,
+            CAST(:utcnow AS timestamp)
+        FROM balance
+        RETURNING to_wallet_id, to_wallet_amount
+    )
+    SELECT
+        to_wallet_id AS wallet_id, to_wallet_amount AS amount,
+        false AS replayed
+    FROM ledger
+    UNION ALL
+    SELECT to_wallet_id, to_wallet_amount, true
+    FROM existed
+    '''.format(amount_type=AMOUNT_SQL_TYPE)
+).bindparams(
+    bindparam('idempotency_key', type_=UUID(as_uuid=True)),
+    bindparam('wallet_id', type_=UUID(as_uuid=True)),
+)
+
+# Move the money of the slots back to their wallets before a debit,
+# returns the moved amounts. The wallet rows must be locked already.
+FOLD_SLOTS_STATEMENT = text(
+    '''
+    UPDATE walletslot
+    SET amount = 0
+    FROM (
+        SELECT id, wallet_id, amount
+        FROM walletslot
+        WHERE wallet_id = ANY(CAST(:wallet_ids AS uuid[])) AND amount <> 0
+        ORDER BY id
+        FOR UPDATE
+    ) AS folded
+    WHERE walletslot.id = folded.id
+    RETURNING folded.wallet_id, folded.amount
+    '''
+)
+
+
+class HotWallets:
+    """Process-local sets of the wallets that have slots, by database.
+
+    It only tells donations which path to try first: a wallet that
+    has become hot recently takes the usual path until the next refresh,
+    one that has cooled down finds no slot and falls back to it. Every
+    shard has a set of its own, refreshed from it.
+    """
+
+    def __init__(self, refresh_interval: float) -> None:
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._wallet_ids: Dict[Engine, Set[uuid.UUID]] = {}
+        self._refreshed_at: Dict[Engine, float] = {}
+
+    def contains(self, db: Session, wallet_id: uuid.UUID) -> bool:
+        engine = db.get_bind().engine
+        if self._is_stale(engine):
+            with self._lock:
+                if self._is_stale(engine):
+                    self._wallet_ids[engine] = {
+                        hot_wallet_id
+                        for hot_wallet_id, in (
+                            db.query(WalletSlot.wallet_id).distinct()
+                        )
+                    }
+                    self._refreshed_at[engine] = time.monotonic()
+
+        return wallet_id in self._wallet_ids[engine]
+
+    def invalidate(self) -> None:
+        self._refreshed_at.clear()
+
+    def _is_stale(self, engine: Engine) -> bool:
+        return (
+            time.monotonic() - self._refreshed_at.get(engine, float('-inf'))
+            > self.refresh_interval
+        )
+
+
+hot_wallets = HotWallets(settings.HOT_WALLETS_REFRESH_INTERVAL)
@@ -0,0 +1,56 @@
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from app.core.config import settings
+from app.core.stats import Counters
+from app.schemas import WalletResponse
+
+idempotency_stats = Counters('idempotency')
+
+
+class RecentKeys:
+    """Bounded LRU of responses of recently completed requests by key.
+
+    A completed request never changes its response, so entries don't
+    expire and a retry can be answered without touching the database.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._responses: 'OrderedDict[uuid.UUID, WalletResponse]' = (
+            OrderedDict()
+        )
+
+    def get(self, idempotency_key: uuid.UUID) -> Optional[WalletResponse]:
+        with self._lock:
+            response = self._responses.get(idempotency_key)
+            if response:
+                self._responses.move_to_end(idempotency_key)
+
+        if response:
+            idempotency_stats.inc('cache_hits')
+        return response
+
+    def put(
+            self,
+            idempotency_key: uuid.UUID,
+            response: WalletResponse,
+    ) -> None:
+        if not self.max_size:
+            return
+
+        with self._lock:
+            self._responses[idempotency_key] = response
+            self._responses.move_to_end(idempotency_key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._responses.clear()
+
+
+recent_keys = RecentKeys(settings.IDEMPOTENCY_CACHE_SIZE)
@@ -0,0 +1,224 @@
+import datetime
+import re
+import time
+from typing import List
+from typing import Optional
+
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import reconciliation
+from app.db import retry
+
+PARTITION_NAME = re.compile(r'^transaction_y(\d{4})m(\d{2})$')
+
+
+def create_partitions(
+        db: Session,
+        months_ahead: int,
+        since: Optional[datetime.date] = None,
+) -> List[str]:
+    """Create the missing monthly partitions up to months_ahead from now.
+
+    Returns the names of the created ones. They start from the current
+    month, or from the month of since, for backdated rows: transaction
+    has no default partition to take them.
+    """
+    names = [
+        name for name, in db.execute(
+            text(
+                'SELECT transaction_create_partitions('
+                ':months_ahead, CAST(:since AS timestamp))'
+            ),
+            dict(months_ahead=months_ahead, since=since),
+        )
+    ]
+    db.commit()
+    return names
+
+
+def list_partitions(db: Session) -> List[str]:
+    """Names of the monthly partitions, oldest first."""
+    names = [
+        name for name, in db.execute(text(
+            '''
+            SELECT inhrelid::regclass::text
+            FROM pg_inherits
+            WHERE inhparent = 'transaction'::regclass
+            '''
+        ))
+    ]
+    return sorted(name for name in names if PARTITION_NAME.match(name))
+
+
+def detaches_concurrently(db: Session) -> bool:
+    """Whether partitions of transaction can be detached concurrently.
+
+    DETACH PARTITION CONCURRENTLY needs PostgreSQL 14, and a table with
+    no default partition, as since revision 09 of the migrations.
+    """
+    concurrently = db.execute(text(
+        '''
+        SELECT
+            current_setting('server_version_num')::int >= 140000
+            AND partdefid = 0
+        FROM pg_partitioned_table
+        WHERE partrelid = 'transaction'::regclass
+        '''
+    )).scalar()
+    db.commit()
+    return concurrently
+
+
+def _detach_concurrently(db: Session, name: str, lock_timeout: str) -> None:
+    # one interrupted after its first transaction is left pending and
+    # can only be finalized
+    pending = db.execute(
+        text(
+            'SELECT inhdetachpending FROM pg_inherits'
+            ' WHERE inhrelid = CAST(:name AS regclass)'
+        ),
+        dict(name=name),
+    ).scalar()
+    db.commit()
+    if pending is None:
+        # detached by an attempt before
+        return
+
+    # it can't run in a transaction block
+    with db.get_bind().connect().execution_options(
+            isolation_level='AUTOCOMMIT',
+    ) as connection:
+        connection.execute(text(
+            "SET lock_timeout = '{}'".format(lock_timeout)
+        ))
+        try:
+            connection.execute(text(
+                'ALTER TABLE transaction DETACH PARTITION {} {}'.format(
+                    name, 'FINALIZE' if pending else 'CONCURRENTLY',
+                )
+            ))
+        finally:
+            connection.execute(text('RESET lock_timeout'))
+
+
+def _detach(
+        db: Session,
+        name: str,
+        concurrently: bool,
+        drop: bool,
+        lock_timeout: str,
+        attempts: int,
+        wait_seconds: float,
+) -> None:
+    for attempt in range(attempts):
+        try:
+            if concurrently:
+                _detach_concurrently(db, name, lock_timeout)
+            db.execute(text(
+                "SET LOCAL lock_timeout = '{}'".format(lock_timeout)
+            ))
+            if not concurrently:
+                db.execute(text(
+                    'ALTER TABLE transaction DETACH PARTITION {}'.format(
+                        name,
+                    )
+                ))
+            if drop:
+                db.execute(text('DROP TABLE {}'.format(name)))
+            db.commit()
+            return
+        except exc.OperationalError as e:
+            db.rollback()
+            if (
+                    retry.pgcode(e) != retry.LOCK_NOT_AVAILABLE
+                    or attempt == attempts - 1
+            ):
+                raise
+            time.sleep(wait_seconds)
+
+
+def detach_partitions(
+        db: Session,
+        before: datetime.date,
+        drop: bool = False,
+        lock_timeout: str = '1s',
+        attempts: int = 10,
+        wait_seconds: float = 1.0,
+) -> List[str]:
+    """Detach the partitions of the months before the given one.
+
+    A detached partition is a plain table, it can be dumped to the
+    archive and dropped, or dropped right away with drop.
+
+    Where detaches_concurrently, partitions are detached concurrently,
+    the writes go on meanwhile. Otherwise, as with a default partition
+    or before PostgreSQL 14, detaching takes an ACCESS EXCLUSIVE lock on
+    transaction, held only for the catalog update. Either way it gives
+    up waiting for a lock after lock_timeout, not to stall the writes
+    queued behind it, and tries again later.
+
+    Months within IDEMPOTENCY_KEY_RETENTION_DAYS are kept, their keys
+    must still be replayed: before later than that raises ValueError.
+    The sums of a month are archived for the reconciliation before it
+    is detached, see reconciliation.archive_partition.
+    """
+    retained_since = datetime.datetime.utcnow() - datetime.timedelta(
+        days=settings.IDEMPOTENCY_KEY_RETENTION_DAYS,
+    )
+    if before > retained_since.date():
+        raise ValueError(
+            'months since {:%Y-%m-%d} are within '
+            'IDEMPOTENCY_KEY_RETENTION_DAYS'.format(retained_since)
+        )
+
+    concurrently = detaches_concurrently(db)
+    detached = []
+    with reconciliation.exclusive(db):
+        for name in list_partitions(db):
+            year, month = PARTITION_NAME.match(name).groups()
+            if datetime.date(int(year), int(month), 1) >= before:
+                continue
+
+            reconciliation.archive_partition(db, name)
+            db.commit()
+            _detach(
+                db, name, concurrently, drop, lock_timeout, attempts,
+                wait_seconds,
+            )
+            detached.append(name)
+    return detached
+
+
+def prune_keys(
+        db: Session,
+        before: datetime.datetime,
+        batch_size: int = 10000,
+) -> int:
+    """Delete the idempotency keys created before the time.
+
+    Deletes in batches, each in its own transaction, so vacuum can keep
+    up and no lock is held for long. Returns the number of keys.
+    """
+    deleted = 0
+    while True:
+        result = db.execute(
+            text(
+                '''
+                DELETE FROM transactionkey
+                WHERE idempotency_key IN (
+                    SELECT idempotency_key
+                    FROM transactionkey
+                    WHERE created_at < :before
+                    LIMIT :batch_size
+                )
+                '''
+            ),
+            dict(before=before, batch_size=batch_size),
+        )
+        db.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
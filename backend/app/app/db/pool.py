@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.pool import QueuePool
+
+from app.core.config import settings
+from app.core.stats import Counters
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the checkout wait histogram, in seconds
+WAIT_BUCKETS = (0.001, 0.01, 0.1, 1.0)
+
+# Round trips to the databases: every statement, commit and rollback of
+# every engine. Beginning a transaction goes with its first statement.
+round_trip_stats = Counters('db')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(*args: Any) -> None:
+    round_trip_stats.inc('statements')
+
+
+@event.listens_for(Engine, 'commit')
+def _count_commit(*args: Any) -> None:
+    round_trip_stats.inc('commits')
+
+
+@event.listens_for(Engine, 'rollback')
+def _count_rollback(*args: Any) -> None:
+    round_trip_stats.inc('rollbacks')
+
+
+class PoolStats(Counters):
+    """Checkout counters of an engine's pool plus its current state."""
+
+    def __init__(self, name: str) -> None:
+        super().__init__('pool_{}'.format(name))
+        # the engine replaces its pool on dispose, the new one sets itself
+        self.pool: Optional[QueuePool] = None
+
+    def observe_wait(self, seconds: float) -> None:
+        for bucket in WAIT_BUCKETS:
+            if seconds <= bucket:
+                self.inc('wait_le_{}ms'.format(int(bucket * 1000)))
+                break
+        else:
+            self.inc('wait_gt_{}ms'.format(int(WAIT_BUCKETS[-1] * 1000)))
+        self.inc('wait_us_total', int(seconds * 1e6))
+
+    def snapshot(self) -> Dict[str, int]:
+        values = super().snapshot()
+        pool = self.pool
+        if pool is not None:
+            values.update(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                # negative while the pool is not full yet
+                overflow=max(pool.overflow(), 0),
+            )
+        return values
+
+
+pool_stats: Dict[str, PoolStats] = {}
+
+
+class MeasuredQueuePool(QueuePool):
+    """QueuePool that counts its checkouts in pool_stats[logging_name].
+
+    The wait includes connecting when the pool opens a new connection.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        name = self._orig_logging_name
+        if name not in pool_stats:
+            pool_stats[name] = PoolStats(name)
+        self.stats = pool_stats[name]
+        self.stats.pool = self
+
+    def connect(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.stats.inc('checkout_timeouts')
+            raise
+        finally:
+            self.stats.observe_wait(time.perf_counter() - started_at)
+        self.stats.inc('checkouts')
+        return connection
+
+
+class MeasuredAsyncPool(MeasuredQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(name: str, is_async: bool = False) -> Dict[str, Any]:
+    """create_engine arguments of the pool and connection settings.
+
+    Every worker process has its own pools: a node opens up to
+    (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW) * workers connections per
+    database.
+    """
+    options: Dict[str, Any] = dict(
+        poolclass=MeasuredAsyncPool if is_async else MeasuredQueuePool,
+        pool_logging_name=name,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_POOL_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+
+    server_settings = {}
+    if settings.DB_STATEMENT_TIMEOUT:
+        server_settings['statement_timeout'] = settings.DB_STATEMENT_TIMEOUT
+    if settings.DB_LOCK_TIMEOUT:
+        server_settings['lock_timeout'] = settings.DB_LOCK_TIMEOUT
+    if settings.WALLET_CHANGES_ENABLED:
+        # the ledger trigger notifies the balance changes, see
+        # app.db.wallet_changes
+        server_settings['paymarket.wallet_changes'] = 'on'
+    if server_settings and is_async:
+        options['connect_args'] = dict(server_settings={
+            key: str(value) for key, value in server_settings.items()
+        })
+    elif server_settings:
+        options['connect_args'] = dict(options=' '.join(
+            '-c {}={}'.format(key, value)
+            for key, value in server_settings.items()
+        ))
+    return options
+
+
+class HealthChecker:
+    """Ping an idle connection of every engine now and then.
+
+    Instead of a round trip on every checkout (pool_pre_ping), one idle
+    connection per engine is checked every interval. The pool hands
+    them out oldest first, so all of them get their turn. A connection
+    found dead makes SQLAlchemy invalidate the whole pool: after a
+    database restart or failover the other idle connections are
+    replaced on their next checkout instead of failing a request each.
+    """
+
+    def __init__(self, engines: List[Engine], interval: float) -> None:
+        self.engines = engines
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if not self.interval or self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='db-health-check', daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def check(self) -> None:
+        for engine in self.engines:
+            pool = engine.pool
+            if not pool.checkedin():
+                # every connection is busy, so it has just been used
+                continue
+            try:
+                with engine.connect() as connection:
+                    connection.exec_driver_sql('SELECT 1')
+                pool.stats.inc('health_checks')
+            except exc.DBAPIError as e:
+                pool.stats.inc('health_check_failures')
+                logger.warning('Health check of %s failed: %s', engine, e)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Health check failed')
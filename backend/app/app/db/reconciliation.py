@@ -0,0 +1,458 @@
+import contextlib
+import datetime
+import decimal
+import multiprocessing
+import time
+import uuid
+from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import settings
+from app.db.session import DBSessionMaker
+from app.db.session import ShardSessionMakers
+
+# any number, only reconciliation takes it
+ADVISORY_LOCK = 7283301
+
+# Transaction ids are taken from a sequence before the insert and become
+# visible at commit, a smaller id may still show up later. The ids taken
+# before a moment are final once every transaction in flight at that
+# moment has finished, see _finished_upper_id. On top of that, rows are
+# only summed up to the first one younger than the lag.
+SAFE_UPPER_ID = '''
+    SELECT max(id)
+    FROM {source}
+    WHERE id < coalesce(
+        (SELECT min(id) FROM {source} WHERE created_at >= :safe_before),
+        'Infinity'::numeric
+    )
+'''
+
+LEDGER_DELTAS = '''
+    SELECT wallet_id, sum(amount) AS amount
+    FROM (
+        SELECT to_wallet_id AS wallet_id, amount
+        FROM {source}
+        WHERE to_wallet_id IS NOT NULL
+        UNION ALL
+        SELECT from_wallet_id, -amount
+        FROM {source}
+        WHERE from_wallet_id IS NOT NULL
+    ) AS moves
+    GROUP BY wallet_id
+'''
+
+# The last id taken from the sequence. It has no cache, so the ids are
+# taken in order by all the sessions.
+LAST_TAKEN_ID_STATEMENT = text(
+    'SELECT CASE WHEN is_called THEN last_value ELSE 0 END'
+    ' FROM transaction_id_seq'
+)
+
+# Transactions of the other clients that may have taken an id by then:
+# the writing ones started by then, and the statements running since,
+# which take the id before they write. Their sessions must be visible
+# to the role of the reconciliation: it is the role of the workers, or
+# has pg_read_all_stats.
+IN_FLIGHT_STATEMENT = text(
+    '''
+    SELECT count(*)
+    FROM pg_stat_activity
+    WHERE datname = current_database()
+        AND backend_type = 'client backend'
+        AND pid <> pg_backend_pid()
+        AND (
+            xact_start <= :started_at AND backend_xid IS NOT NULL
+            OR query_start <= :started_at AND state = 'active'
+        )
+    '''
+)
+
+APPLY_CHUNK_STATEMENT = text(
+    '''
+    WITH chunk AS (
+        SELECT id, amount, from_wallet_id, to_wallet_id, created_at
+        FROM transaction
+        WHERE id > :last_transaction_id AND id <= :finished_upper_id
+        ORDER BY id
+        LIMIT :chunk_size
+    ), safe AS (
+        SELECT *
+        FROM chunk
+        WHERE id <= ({safe_upper_id})
+    ), deltas AS (
+        {deltas}
+    ), applied AS (
+        INSERT INTO reconciliationbalance (wallet_id, amount)
+        SELECT wallet_id, amount FROM deltas
+        ON CONFLICT (wallet_id) DO UPDATE
+        SET amount = reconciliationbalance.amount + excluded.amount
+        RETURNING 1
+    )
+    SELECT
+        (SELECT count(*) FROM safe) AS rows,
+        (SELECT max(id) FROM safe) AS last_transaction_id,
+        (SELECT count(*) FROM applied) AS wallets
+    '''.format(
+        safe_upper_id=SAFE_UPPER_ID.format(source='chunk'),
+        deltas=LEDGER_DELTAS.format(source='safe'),
+    )
+)
+
+# Balances of all wallets against the ledger in one snapshot: the
+# reconciled sums plus the transactions after the checkpoint.
+MISMATCHES_STATEMENT = text(
+    '''
+    WITH recent AS (
+        SELECT *
+        FROM transaction
+        WHERE id > (
+            SELECT coalesce(max(last_transaction_id), 0)
+            FROM reconciliationcheckpoint
+        )
+    ), recent_deltas AS (
+        {deltas}
+    ), slots AS (
+        SELECT wallet_id, sum(amount) AS amount
+        FROM walletslot
+        GROUP BY wallet_id
+    )
+    SELECT
+        wallet.wallet_id,
+        wallet.amount + coalesce(slots.amount, 0) AS amount,
+        coalesce(reconciliationbalance.amount, 0)
+            + coalesce(recent_deltas.amount, 0) AS ledger_amount
+    FROM wallet
+    LEFT JOIN slots USING (wallet_id)
+    LEFT JOIN reconciliationbalance USING (wallet_id)
+    LEFT JOIN recent_deltas USING (wallet_id)
+    WHERE wallet.amount + coalesce(slots.amount, 0)
+        <> coalesce(reconciliationbalance.amount, 0)
+            + coalesce(recent_deltas.amount, 0)
+    ORDER BY wallet.wallet_id
+    '''.format(deltas=LEDGER_DELTAS.format(source='recent'))
+)
+
+# Sums of a partition of transaction about to be detached, see
+# archive_partition.
+ARCHIVE_STATEMENT = '''
+    INSERT INTO reconciliationarchive (partition, wallet_id, amount)
+    SELECT :partition, wallet_id, amount
+    FROM ({deltas}) AS deltas
+'''
+
+# Wallet ids are random, so ranges of the uuid space are of about the
+# same size. high is excluded, NULL for the last range. The sums of the
+# partitions detached since are added from reconciliationarchive.
+REBUILD_RANGE_STATEMENT = text(
+    '''
+    INSERT INTO reconciliationbalance (wallet_id, amount)
+    SELECT wallet_id, sum(amount)
+    FROM (
+        SELECT to_wallet_id AS wallet_id, amount
+        FROM transaction
+        WHERE to_wallet_id >= :low
+            AND (CAST(:high AS uuid) IS NULL OR to_wallet_id < :high)
+            AND id <= :last_transaction_id
+        UNION ALL
+        SELECT from_wallet_id, -amount
+        FROM transaction
+        WHERE from_wallet_id >= :low
+            AND (CAST(:high AS uuid) IS NULL OR from_wallet_id < :high)
+            AND id <= :last_transaction_id
+        UNION ALL
+        SELECT wallet_id, amount
+        FROM reconciliationarchive
+        WHERE wallet_id >= :low
+            AND (CAST(:high AS uuid) IS NULL OR wallet_id < :high)
+            AND partition <> ALL(CAST(:attached AS text[]))
+    ) AS moves
+    GROUP BY wallet_id
+    '''
+)
+
+CLEAR_RANGE_STATEMENT = text(
+    '''
+    DELETE FROM reconciliationbalance
+    WHERE wallet_id >= :low
+        AND (CAST(:high AS uuid) IS NULL OR wallet_id < :high)
+    '''
+)
+
+
+class Mismatch(NamedTuple):
+    wallet_id: uuid.UUID
+    amount: decimal.Decimal
+    ledger_amount: decimal.Decimal
+
+
+@contextlib.contextmanager
+def exclusive(db: Session) -> Iterator[None]:
+    """Don't let two reconciliations of the database of db run at once,
+    nor one with app.db.partitions.detach_partitions.
+
+    The advisory lock is held by a connection of its own in autocommit
+    mode, so no transaction stays open for the whole run.
+    """
+    with db.get_bind().connect().execution_options(
+            isolation_level='AUTOCOMMIT',
+    ) as connection:
+        if not connection.execute(
+                text('SELECT pg_try_advisory_lock(:key)'),
+                dict(key=ADVISORY_LOCK),
+        ).scalar():
+            raise RuntimeError('reconciliation is already running')
+        try:
+            yield
+        finally:
+            connection.execute(
+                text('SELECT pg_advisory_unlock(:key)'),
+                dict(key=ADVISORY_LOCK),
+            )
+
+
+def _set_checkpoint(db: Session, last_transaction_id: int) -> None:
+    db.execute(
+        text(
+            '''
+            INSERT INTO reconciliationcheckpoint (
+                id, last_transaction_id, updated_at
+            )
+            VALUES (1, :last_transaction_id, :utcnow)
+            ON CONFLICT (id) DO UPDATE
+            SET last_transaction_id = excluded.last_transaction_id,
+                updated_at = excluded.updated_at
+            '''
+        ),
+        dict(
+            last_transaction_id=last_transaction_id,
+            utcnow=datetime.datetime.utcnow(),
+        ),
+    )
+
+
+def archive_partition(db: Session, name: str) -> None:
+    """Keep the sums of a partition of transaction about to be detached.
+
+    rebuild adds them up instead of its rows once it is detached. Its
+    rows must be reconciled already, reconcile won't see them after,
+    otherwise it raises RuntimeError. Archiving the same partition
+    again replaces its sums. Run under exclusive, the caller commits.
+    """
+    unreconciled = db.execute(text(
+        '''
+        SELECT count(*)
+        FROM {}
+        WHERE id > (
+            SELECT coalesce(max(last_transaction_id), 0)
+            FROM reconciliationcheckpoint
+        )
+        '''.format(name)
+    )).scalar()
+    if unreconciled:
+        raise RuntimeError('{} is not reconciled yet'.format(name))
+
+    db.execute(
+        text('DELETE FROM reconciliationarchive WHERE partition = :name'),
+        dict(name=name),
+    )
+    db.execute(
+        text(ARCHIVE_STATEMENT.format(
+            deltas=LEDGER_DELTAS.format(source=name),
+        )),
+        dict(partition=name),
+    )
+
+
+def _attached_partitions(db: Session) -> List[str]:
+    """Partitions of transaction its queries read.
+
+    Since PostgreSQL 14 one being detached concurrently is not read
+    any more.
+    """
+    pending = db.execute(text(
+        "SELECT current_setting('server_version_num')::int >= 140000"
+    )).scalar()
+    return [
+        name for name, in db.execute(text(
+            '''
+            SELECT inhrelid::regclass::text
+            FROM pg_inherits
+            WHERE inhparent = 'transaction'::regclass
+            ''' + (' AND NOT inhdetachpending' if pending else '')
+        ))
+    ]
+
+
+def _finished_upper_id(db: Session) -> Optional[int]:
+    """The last id taken, once every transaction in flight has finished.
+
+    A transaction that has taken an id by now has started by now too.
+    None when they are still running after RECONCILIATION_WAIT.
+    """
+    upper_id = db.execute(LAST_TAKEN_ID_STATEMENT).scalar()
+    started_at = db.execute(text('SELECT clock_timestamp()')).scalar()
+    deadline = time.monotonic() + settings.RECONCILIATION_WAIT
+    while True:
+        in_flight = db.execute(
+            IN_FLIGHT_STATEMENT, dict(started_at=started_at),
+        ).scalar()
+        # the activity is read once per transaction
+        db.commit()
+        if not in_flight:
+            return upper_id
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.1)
+
+
+def _safe_before(lag: Optional[float]) -> datetime.datetime:
+    if lag is None:
+        lag = settings.RECONCILIATION_LAG
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=lag)
+
+
+def reconcile(
+        db: Session,
+        chunk_size: Optional[int] = None,
+        lag: Optional[float] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+) -> int:
+    """Add the ledger rows after the checkpoint to the balances.
+
+    Every chunk is applied with the checkpoint in its own short
+    transaction. Returns the number of rows, none are applied when the
+    transactions in flight don't finish within RECONCILIATION_WAIT.
+    """
+    chunk_size = chunk_size or settings.RECONCILIATION_CHUNK_SIZE
+    total = 0
+    with exclusive(db):
+        finished_upper_id = _finished_upper_id(db)
+        if finished_upper_id is None:
+            return total
+        while True:
+            last_transaction_id = db.execute(text(
+                'SELECT coalesce(max(last_transaction_id), 0)'
+                ' FROM reconciliationcheckpoint'
+            )).scalar()
+            result = db.execute(
+                APPLY_CHUNK_STATEMENT,
+                dict(
+                    last_transaction_id=last_transaction_id,
+                    finished_upper_id=finished_upper_id,
+                    chunk_size=chunk_size,
+                    safe_before=_safe_before(lag),
+                ),
+            ).first()
+            if result['rows']:
+                _set_checkpoint(db, result['last_transaction_id'])
+            db.commit()
+
+            total += result['rows']
+            if progress and result['rows']:
+                progress(total, result['last_transaction_id'])
+            if result['rows'] < chunk_size:
+                return total
+
+
+def mismatches(db: Session) -> List[Mismatch]:
+    """Wallets whose balance is not what their transactions imply.
+
+    One statement sees one snapshot, so the balances and the ledger are
+    compared as of the same moment.
+    """
+    rows = db.execute(MISMATCHES_STATEMENT).all()
+    db.commit()
+    return [Mismatch(*row) for row in rows]
+
+
+def _ranges(count: int) -> List[Tuple[str, Optional[str]]]:
+    bounds: List[Optional[str]] = [
+        str(uuid.UUID(int=(2 ** 128) * i // count)) for i in range(count)
+    ]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def _session_maker(shard: Optional[int]) -> sessionmaker:
+    return DBSessionMaker if shard is None else ShardSessionMakers[shard]
+
+
+def _rebuild_range(
+        args: Tuple[str, Optional[str], int, List[str], Optional[int]],
+) -> None:
+    low, high, last_transaction_id, attached, shard = args
+    db = _session_maker(shard)()
+    try:
+        params = dict(
+            low=low,
+            high=high,
+            last_transaction_id=last_transaction_id,
+            attached=attached,
+        )
+        db.execute(CLEAR_RANGE_STATEMENT, params)
+        db.execute(REBUILD_RANGE_STATEMENT, params)
+        db.commit()
+    finally:
+        db.close()
+
+
+def rebuild(
+        db: Session,
+        processes: int = 1,
+        lag: Optional[float] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        shard: Optional[int] = None,
+) -> int:
+    """Sum the whole ledger up again, in parallel by wallet_id ranges.
+
+    There are more ranges than processes, so every statement is short.
+    The detached partitions are summed up from their archive, see
+    archive_partition. db is a session of the shard given, or of the
+    primary by default. Returns the new checkpoint. Raises RuntimeError when the
+    transactions in flight don't finish within RECONCILIATION_WAIT.
+    """
+    with exclusive(db):
+        finished_upper_id = _finished_upper_id(db)
+        if finished_upper_id is None:
+            raise RuntimeError('transactions in flight have not finished')
+        last_transaction_id = min(
+            db.execute(
+                text(SAFE_UPPER_ID.format(source='transaction')),
+                dict(safe_before=_safe_before(lag)),
+            ).scalar() or 0,
+            finished_upper_id,
+        )
+        attached = _attached_partitions(db)
+        db.commit()
+
+        tasks = [
+            (low, high, last_transaction_id, attached, shard)
+            for low, high in _ranges(processes * 8)
+        ]
+        if processes == 1:
+            for done, task in enumerate(tasks, 1):
+                _rebuild_range(task)
+                if progress:
+                    progress(done, len(tasks))
+        else:
+            # the workers must not inherit open connections: closing
+            # them there would close them for this process too
+            db.get_bind().dispose()
+            with multiprocessing.Pool(processes) as pool:
+                for done, _ in enumerate(
+                        pool.imap_unordered(_rebuild_range, tasks), 1,
+                ):
+                    if progress:
+                        progress(done, len(tasks))
+
+        _set_checkpoint(db, last_transaction_id)
+        db.commit()
+        return last_transaction_id
@@ -0,0 +1,74 @@
+import asyncio
+import random
+import time
+from typing import AsyncIterator
+from typing import Iterator
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import exc
+
+from app.core.config import settings
+from app.core.stats import Counters
+
+UNIQUE_VIOLATION = '23505'
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+def pgcode(exception: exc.DBAPIError) -> Optional[str]:
+    # asyncpg errors are wrapped by the SQLAlchemy adapter, the original
+    # one with its sqlstate is the cause
+    return getattr(exception.orig, 'pgcode', None) or getattr(
+        exception.orig.__cause__, 'sqlstate', None,
+    )
+
+
+def is_transient(exception: exc.DBAPIError) -> bool:
+    return pgcode(exception) in (SERIALIZATION_FAILURE, DEADLOCK_DETECTED)
+
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter, in seconds."""
+    return random.uniform(
+        0,
+        min(
+            settings.TRANSFER_RETRY_BACKOFF_MAX,
+            settings.TRANSFER_RETRY_BACKOFF_BASE * 2 ** attempt,
+        ),
+    )
+
+
+def attempts(counters: Counters) -> Iterator[int]:
+    """Yield attempt numbers, sleeping between them.
+
+    The caller returns from the loop on success; running out of
+    attempts is reported to the client as 503.
+    """
+    for attempt in range(settings.TRANSFER_MAX_RETRIES + 1):
+        if attempt:
+            counters.inc('retries')
+            time.sleep(backoff(attempt - 1))
+        yield attempt
+
+    counters.inc('retries_exhausted')
+    raise HTTPException(
+        status_code=503,
+        detail='transfer is not possible right now, try again later',
+    )
+
+
+async def async_attempts(counters: Counters) -> AsyncIterator[int]:
+    """Same as attempts, but doesn't block the event loop while waiting."""
+    for attempt in range(settings.TRANSFER_MAX_RETRIES + 1):
+        if attempt:
+            counters.inc('retries')
+            await asyncio.sleep(backoff(attempt - 1))
+        yield attempt
+
+    counters.inc('retries_exhausted')
+    raise HTTPException(
+        status_code=503,
+        detail='transfer is not possible right now, try again later',
+    )
@@ -1,13 +1,29 @@
+import itertools
+import time
+from typing import AsyncGenerator
 from typing import Generator
 
+from fastapi import Request
+from fastapi import Response
 from sqlalchemy import create_engine
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
 
 from app.core.config import settings
+from app.core.stats import Counters
+from app.db.pool import HealthChecker
+from app.db.pool import engine_options
+
+PRIMARY_COOKIE = 'primary_until'
+
+replica_stats = Counters('replicas')
 
 engine = create_engine(
     settings.SQLALCHEMY_DATABASE_URI,
-    pool_pre_ping=True,
+    **engine_options('primary'),
 )
 DBSessionMaker = sessionmaker(
     autocommit=False,
@@ -15,10 +31,109 @@ DBSessionMaker = sessionmaker(
     bind=engine,
 )
 
+replica_engines = [
+    create_engine(uri, **engine_options('replica_{}'.format(i)))
+    for i, uri in enumerate(settings.SQLALCHEMY_REPLICA_URIS)
+]
+ReplicaSessionMakers = [
+    sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+    for replica_engine in replica_engines
+]
+replica_counter = itertools.count()
+
+# see app.db.sharded_helper
+shard_engines = [
+    create_engine(uri, **engine_options('shard_{}'.format(i)))
+    for i, uri in enumerate(settings.SQLALCHEMY_SHARD_URIS)
+]
+ShardSessionMakers = [
+    sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+    for shard_engine in shard_engines
+]
+
+health_checker = HealthChecker(
+    [engine] + replica_engines + shard_engines,
+    settings.DB_POOL_HEALTH_CHECK_INTERVAL,
+)
+
+
+def replica_session() -> Session:
+    """Session on the next replica in turn.
+
+    Unreachable replicas are skipped, the primary is used when there
+    are no replicas or none of them is reachable.
+    """
+    for _ in range(len(ReplicaSessionMakers)):
+        session_maker = ReplicaSessionMakers[
+            next(replica_counter) % len(ReplicaSessionMakers)
+        ]
+        db = session_maker()
+        try:
+            db.connection()
+            replica_stats.inc('reads')
+            return db
+        except exc.DBAPIError:
+            db.close()
+            replica_stats.inc('errors')
+
+    if ReplicaSessionMakers:
+        replica_stats.inc('primary_fallbacks')
+    return DBSessionMaker()
+
+
+def get_db_session(response: Response) -> Generator:
+    if settings.READ_YOUR_WRITES_SECONDS:
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            str(time.time() + settings.READ_YOUR_WRITES_SECONDS),
+            max_age=int(settings.READ_YOUR_WRITES_SECONDS) + 1,
+        )
 
-def get_db_session() -> Generator:
     try:
         db = DBSessionMaker()
         yield db
     finally:
         db.close()
+
+
+def get_read_db_session(request: Request) -> Generator:
+    """Session for read-only endpoints, usually on a replica."""
+    try:
+        primary_until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        primary_until = 0
+
+    try:
+        if primary_until > time.time():
+            db = DBSessionMaker()
+        else:
+            db = replica_session()
+        yield db
+    finally:
+        db.close()
+
+
+async_engine = None
+if settings.DB_ASYNC:
+    # asyncpg is needed only in the async mode
+    async_engine = create_async_engine(
+        settings.SQLALCHEMY_DATABASE_URI.replace(
+            'postgresql://', 'postgresql+asyncpg://', 1,
+        ),
+        **engine_options('async', is_async=True),
+    )
+AsyncDBSessionMaker = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+    bind=async_engine,
+    class_=AsyncSession,
+)
+
+
+async def get_async_db_session() -> AsyncGenerator:
+    try:
+        db = AsyncDBSessionMaker()
+        yield db
+    finally:
+        await db.close()
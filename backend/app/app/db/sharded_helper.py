@@ -0,0 +1,491 @@
+"""Wallets spread over several databases, see SQLALCHEMY_SHARD_URIS.
+
+A wallet lives on the shard its wallet_id hashes to, so any worker
+finds it without a directory. A new wallet is placed on the shard of
+its idempotency key, and given an id that hashes to the same shard:
+the key is looked up where the wallet is. Every operation on one
+wallet runs on its shard as usual, by DBHelper.
+
+A transfer between two shards is a saga of two local transactions,
+each of them durable on its own:
+
+* the debit, on the shard of from_wallet_id, writes the ledger row of
+  the debit and a shardtransfer row, the credit still to make;
+* the credit, on the shard of to_wallet_id, writes the ledger row of
+  the credit under credit_key of the idempotency key, so it is made
+  once however many times it is tried, and the shardtransfer row is
+  marked credited.
+
+Keys are unique on each shard only. The client's key is checked to be
+unused on the shard of the credit too, and the credit doesn't take its
+row, whose key is derived, for one of another request.
+
+The credit can't fail for lack of money, and to_wallet_id is checked to
+exist before the debit, so the saga never has to be compensated. The
+credit is made right after the debit; when that fails, the client is
+answered all the same and settle_transfers makes it later. The ledger
+row of each shard names only the wallet of that shard, so every shard
+reconciles on its own; shardtransfer keeps both.
+"""
+import contextlib
+import datetime
+import hashlib
+import logging
+import uuid
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+from fastapi import HTTPException
+from psycopg2.errors import UniqueViolation
+from sqlalchemy import exc
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.core.stats import Counters
+from app.db import retry
+from app.db import session
+from app.db.cache import wallet_cache
+from app.db.helper import DBHelper
+from app.db.helper import transaction_by_key
+from app.db.idempotency import recent_keys
+from app.models import ShardTransfer
+from app.models import Transaction
+from app.models import Wallet
+from app.schemas import WalletCreateBatchRequest
+from app.schemas import WalletCreateBatchResponse
+from app.schemas import WalletDonateRequest
+from app.schemas import WalletGetBatchItemResponse
+from app.schemas import WalletGetBatchRequest
+from app.schemas import WalletGetBatchResponse
+from app.schemas import WalletResponse
+from app.schemas import WalletSlotsRequest
+from app.schemas import WalletTransaction
+from app.schemas import WalletTransactionsRequest
+from app.schemas import WalletTransactionsResponse
+from app.schemas import WalletTransferBatchRequest
+from app.schemas import WalletTransferBatchResponse
+from app.schemas import WalletTransferRequest
+
+logger = logging.getLogger(__name__)
+
+shard_stats = Counters('shards')
+
+# the credits of the transfers between shards are keyed in it
+CREDIT_KEY_NAMESPACE = uuid.UUID('5d1f3b2e-8c4a-4e6f-9b7d-2a0c6e8f1b34')
+
+
+def shard_index(key: uuid.UUID) -> int:
+    """The shard of a wallet_id, or of a wallet idempotency key.
+
+    Keys are chosen by the clients and may not be random, they are
+    hashed rather than taken as they are.
+    """
+    digest = hashlib.blake2b(key.bytes, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % len(session.ShardSessionMakers)
+
+
+def new_wallet_id(shard: int) -> uuid.UUID:
+    """A random wallet_id of the shard, one in shard count is."""
+    while True:
+        wallet_id = uuid.uuid4()
+        if shard_index(wallet_id) == shard:
+            return wallet_id
+
+
+def credit_key(idempotency_key: uuid.UUID) -> uuid.UUID:
+    """The key of the credit of a transfer between shards."""
+    return uuid.uuid5(CREDIT_KEY_NAMESPACE, str(idempotency_key))
+
+
+@contextlib.contextmanager
+def shard_session(shard: int) -> Iterator[Session]:
+    db = session.ShardSessionMakers[shard]()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+class ShardedDBHelper(DBHelper):
+    """DBHelper on the shards of the wallets instead of the session given.
+
+    The session of the request is left unused, it never connects.
+    """
+
+    @classmethod
+    def wallet_get(cls, db: Session, wallet_id: uuid.UUID) -> WalletResponse:
+        with shard_session(shard_index(wallet_id)) as shard_db:
+            return DBHelper.wallet_get(shard_db, wallet_id)
+
+    @classmethod
+    def wallet_get_batch(
+            cls,
+            db: Session,
+            request: WalletGetBatchRequest,
+    ) -> WalletGetBatchResponse:
+        """DBHelper.wallet_get_batch on every shard of the wallets."""
+        by_shard: Dict[int, List[uuid.UUID]] = {}
+        for wallet_id in request.wallet_ids:
+            by_shard.setdefault(shard_index(wallet_id), []).append(wallet_id)
+
+        results: Dict[uuid.UUID, WalletGetBatchItemResponse] = {}
+        for shard, wallet_ids in by_shard.items():
+            with shard_session(shard) as shard_db:
+                response = DBHelper.wallet_get_batch(
+                    shard_db, WalletGetBatchRequest(wallet_ids=wallet_ids),
+                )
+            results.update(
+                (result.wallet_id, result) for result in response.results
+            )
+        return WalletGetBatchResponse(
+            results=[results[wallet_id] for wallet_id in request.wallet_ids],
+        )
+
+    @classmethod
+    def wallet_check(cls, db: Session, wallet_id: uuid.UUID) -> None:
+        with shard_session(shard_index(wallet_id)) as shard_db:
+            DBHelper.wallet_check(shard_db, wallet_id)
+
+    @classmethod
+    def wallet_transactions(
+            cls,
+            db: Session,
+            request: WalletTransactionsRequest,
+    ) -> WalletTransactionsResponse:
+        with shard_session(shard_index(request.wallet_id)) as shard_db:
+            return DBHelper.wallet_transactions(shard_db, request)
+
+    @classmethod
+    def wallet_transactions_export(
+            cls,
+            db: Session,
+            wallet_id: uuid.UUID,
+    ) -> Iterator[WalletTransaction]:
+        with shard_session(shard_index(wallet_id)) as shard_db:
+            yield from DBHelper.wallet_transactions_export(shard_db, wallet_id)
+
+    @classmethod
+    def wallet_create(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+    ) -> WalletResponse:
+        shard = shard_index(idempotency_key)
+        with shard_session(shard) as shard_db:
+            return DBHelper.wallet_create(
+                shard_db, idempotency_key, wallet_id=new_wallet_id(shard),
+            )
+
+    @classmethod
+    def wallet_create_batch(
+            cls,
+            db: Session,
+            request: WalletCreateBatchRequest,
+    ) -> WalletCreateBatchResponse:
+        # one by one, the keys are spread over the shards
+        return WalletCreateBatchResponse(wallets=[
+            cls.wallet_create(db, idempotency_key)
+            for idempotency_key in request.idempotency_keys
+        ])
+
+    @classmethod
+    def wallet_donate(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletDonateRequest,
+    ) -> WalletResponse:
+        with shard_session(shard_index(request.wallet_id)) as shard_db:
+            return DBHelper.wallet_donate(shard_db, idempotency_key, request)
+
+    @classmethod
+    def wallet_set_slots(
+            cls,
+            db: Session,
+            request: WalletSlotsRequest,
+    ) -> WalletResponse:
+        with shard_session(shard_index(request.wallet_id)) as shard_db:
+            return DBHelper.wallet_set_slots(shard_db, request)
+
+    @classmethod
+    def wallet_transfer_batch(
+            cls,
+            db: Session,
+            request: WalletTransferBatchRequest,
+    ) -> WalletTransferBatchResponse:
+        shards = {
+            shard_index(wallet_id)
+            for transfer in request.transfers
+            for wallet_id in (transfer.from_wallet_id, transfer.to_wallet_id)
+        }
+        if len(shards) > 1:
+            raise HTTPException(
+                status_code=400,
+                detail='the wallets of a batch must be on one shard',
+            )
+        with shard_session(shards.pop()) as shard_db:
+            return DBHelper.wallet_transfer_batch(shard_db, request)
+
+    @classmethod
+    def wallet_transfer(
+            cls,
+            db: Session,
+            idempotency_key: uuid.UUID,
+            request: WalletTransferRequest,
+    ) -> WalletResponse:
+        from_shard = shard_index(request.from_wallet_id)
+        to_shard = shard_index(request.to_wallet_id)
+        with shard_session(from_shard) as from_db:
+            if from_shard == to_shard:
+                return DBHelper.wallet_transfer(
+                    from_db, idempotency_key, request,
+                )
+
+            response = cls._debit(from_db, to_shard, idempotency_key, request)
+            try:
+                cls._settle(from_db, idempotency_key)
+            except Exception:
+                # made by settle_transfers later
+                logger.exception(
+                    'Crediting transfer %s failed', idempotency_key,
+                )
+                from_db.rollback()
+                shard_stats.inc('credits_deferred')
+            return response
+
+    @classmethod
+    def settle_transfers(
+            cls,
+            db: Session,
+            before: datetime.datetime,
+            batch_size: int = 1000,
+    ) -> int:
+        """Credit the transfers debited on the shard of db before the time.
+
+        Returns the number of transfers credited. The ones that fail are
+        logged and left for the next run.
+        """
+        settled = 0
+        while True:
+            idempotency_keys = [
+                idempotency_key
+                for idempotency_key, in db.query(ShardTransfer.idempotency_key)
+                .filter(
+                    ShardTransfer.credited_at.is_(None),
+                    ShardTransfer.created_at < before,
+                )
+                .order_by(ShardTransfer.created_at)
+                .limit(batch_size)
+            ]
+            db.commit()
+            credited = 0
+            for idempotency_key in idempotency_keys:
+                try:
+                    cls._settle(db, idempotency_key)
+                except Exception:
+                    # tried again by the next run
+                    logger.exception(
+                        'Crediting transfer %s failed', idempotency_key,
+                    )
+                    db.rollback()
+                    shard_stats.inc('credits_failed')
+                else:
+                    credited += 1
+            settled += credited
+            if len(idempotency_keys) < batch_size or not credited:
+                return settled
+
+    @classmethod
+    def _debit(
+            cls,
+            db: Session,
+            to_shard: int,
+            idempotency_key: uuid.UUID,
+            request: WalletTransferRequest,
+    ) -> WalletResponse:
+        """The debit and the shardtransfer row, in one transaction."""
+        existed_response = cls._existed_response(
+            db, idempotency_key, to_wallet=False,
+        )
+        if existed_response:
+            return existed_response
+
+        for _ in retry.attempts(shard_stats):
+            try:
+                db_from_wallet = (
+                    db.query(Wallet)
+                    .filter(Wallet.wallet_id == request.from_wallet_id)
+                    .with_for_update()
+                    .first()
+                )
+                if not db_from_wallet:
+                    raise HTTPException(
+                        status_code=404, detail='from_wallet_id is not found'
+                    )
+                if db_from_wallet.slots:
+                    db_from_wallet.amount += cls._fold_slots(
+                        db, [db_from_wallet.wallet_id],
+                    ).get(db_from_wallet.wallet_id, 0)
+                if db_from_wallet.amount < request.amount:
+                    raise HTTPException(
+                        status_code=400,
+                        detail='not enough money',
+                    )
+                # wallets are never deleted, it still exists at the credit
+                with shard_session(to_shard) as to_db:
+                    if not (
+                        to_db.query(Wallet.id)
+                        .filter(Wallet.wallet_id == request.to_wallet_id)
+                        .first()
+                    ):
+                        raise HTTPException(
+                            status_code=404,
+                            detail='db_to_wallet is not found',
+                        )
+                    if (
+                        to_db.query(Transaction.id)
+                        .filter(transaction_by_key(idempotency_key))
+                        .first()
+                    ):
+                        raise HTTPException(
+                            status_code=400,
+                            detail='idempotency key is used by another '
+                                   'request',
+                        )
+
+                utcnow = datetime.datetime.utcnow()
+                db_from_wallet.amount = db_from_wallet.amount - request.amount
+                db_from_wallet.updated_at = utcnow
+                db.add(db_from_wallet)
+                db.flush()
+                db.execute(pg_insert(Transaction).values(
+                    idempotency_key=idempotency_key,
+                    amount=request.amount,
+                    from_wallet_id=db_from_wallet.wallet_id,
+                    from_wallet_amount=db_from_wallet.amount,
+                    created_at=utcnow,
+                ))
+                db.add(ShardTransfer(
+                    idempotency_key=idempotency_key,
+                    from_wallet_id=request.from_wallet_id,
+                    to_wallet_id=request.to_wallet_id,
+                    amount=request.amount,
+                    created_at=utcnow,
+                ))
+                db.commit()
+                shard_stats.inc('debits')
+                wallet_cache.put(
+                    db_from_wallet.wallet_id, db_from_wallet.amount, utcnow,
+                )
+
+                response = WalletResponse(
+                    wallet_id=db_from_wallet.wallet_id,
+                    amount=db_from_wallet.amount,
+                )
+                recent_keys.put(idempotency_key, response)
+                return response
+            except exc.IntegrityError as exception:
+                db.rollback()
+
+                # a concurrent request with the key has been committed
+                if not isinstance(exception.orig, UniqueViolation):
+                    raise
+                shard_stats.inc('debit_integrity_errors')
+                return cls._existed_response(
+                    db, idempotency_key, to_wallet=False, committed=True,
+                )
+            except exc.OperationalError as exception:
+                db.rollback()
+
+                if not retry.is_transient(exception):
+                    raise
+                shard_stats.inc('debit_aborts')
+
+    @classmethod
+    def _settle(cls, db: Session, idempotency_key: uuid.UUID) -> None:
+        """Credit the transfer debited on the shard of db, if not yet."""
+        transfer = db.query(ShardTransfer).get(idempotency_key)
+        if transfer is not None:
+            db.expunge(transfer)
+        db.commit()
+        if transfer is None or transfer.credited_at is not None:
+            return
+        with shard_session(shard_index(transfer.to_wallet_id)) as to_db:
+            cls._credit(to_db, transfer)
+        db.query(ShardTransfer).filter(
+            ShardTransfer.idempotency_key == idempotency_key,
+        ).update(
+            dict(credited_at=datetime.datetime.utcnow()),
+            synchronize_session=False,
+        )
+        db.commit()
+
+    @classmethod
+    def _credit(cls, db: Session, transfer: ShardTransfer) -> None:
+        """The credit of the transfer, once whatever the tries."""
+        idempotency_key = credit_key(transfer.idempotency_key)
+        for _ in retry.attempts(shard_stats):
+            try:
+                credited = db.query(
+                    Transaction.from_wallet_id,
+                    Transaction.to_wallet_id,
+                    Transaction.amount,
+                ).filter(transaction_by_key(idempotency_key)).first()
+                db.commit()
+                if credited:
+                    if tuple(credited) != (
+                        None, transfer.to_wallet_id, transfer.amount,
+                    ):
+                        # never credited, the money stays accounted
+                        # in shardtransfer
+                        shard_stats.inc('credit_key_conflicts')
+                        raise RuntimeError(
+                            'Key {} of the credit of transfer {} is used by '
+                            'another request'.format(
+                                idempotency_key, transfer.idempotency_key,
+                            )
+                        )
+                    return
+
+                db_to_wallet = (
+                    db.query(Wallet)
+                    .filter(Wallet.wallet_id == transfer.to_wallet_id)
+                    .with_for_update()
+                    .one()
+                )
+                if db_to_wallet.slots:
+                    db_to_wallet.amount += cls._fold_slots(
+                        db, [db_to_wallet.wallet_id],
+                    ).get(db_to_wallet.wallet_id, 0)
+                utcnow = datetime.datetime.utcnow()
+                db_to_wallet.amount = db_to_wallet.amount + transfer.amount
+                db_to_wallet.updated_at = utcnow
+                db.add(db_to_wallet)
+                db.flush()
+                db.execute(pg_insert(Transaction).values(
+                    idempotency_key=idempotency_key,
+                    amount=transfer.amount,
+                    to_wallet_id=db_to_wallet.wallet_id,
+                    to_wallet_amount=db_to_wallet.amount,
+                    created_at=utcnow,
+                ))
+                db.commit()
+                shard_stats.inc('credits')
+                wallet_cache.put(
+                    db_to_wallet.wallet_id, db_to_wallet.amount, utcnow,
+                )
+                return
+            except exc.IntegrityError as exception:
+                db.rollback()
+
+                # credited by a concurrent settle, checked by the next try
+                if not isinstance(exception.orig, UniqueViolation):
+                    raise
+                shard_stats.inc('credit_integrity_errors')
+            except exc.OperationalError as exception:
+                db.rollback()
+
+                if not retry.is_transient(exception):
+                    raise
+                shard_stats.inc('credit_aborts')
@@ -0,0 +1,218 @@
+"""Transfers accepted now and applied later, queued in Postgres.
+
+/v1/wallet/transfer/async records the request by its idempotency key
+and answers 202 at once. The threads of app/transfer_worker.py claim
+the oldest pending requests with FOR UPDATE SKIP LOCKED, so they never
+wait for each other, apply them with the rules of the batch endpoint
+and record every outcome in the same transaction: a request is either
+pending or done with its result, never both or lost in between.
+"""
+import datetime
+import uuid
+from typing import List
+
+from psycopg2.errors import UniqueViolation
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.core.stats import Counters
+from app.db import retry
+from app.db.amount import AMOUNT_SQL_TYPE
+from app.db.helper import DBHelper
+from app.models import TransferRequest
+from app.schemas import WalletTransferBatchItem
+from app.schemas import WalletTransferRequest
+from app.schemas import WalletTransferStatus
+from app.schemas import to_stored_amount
+
+queue_stats = Counters('transfer_queue')
+
+CLAIM_STATEMENT = text(
+    '''
+    SELECT idempotency_key, from_wallet_id, to_wallet_id, amount
+    FROM transferrequest
+    WHERE status_code IS NULL
+    ORDER BY created_at
+    LIMIT :batch_size
+    FOR UPDATE SKIP LOCKED
+    '''
+)
+
+RECORD_OUTCOMES_STATEMENT = text(
+    '''
+    UPDATE transferrequest
+    SET
+        status_code = outcome.status_code,
+        detail = outcome.detail,
+        from_wallet_amount = outcome.amount,
+        processed_at = :processed_at
+    FROM unnest(
+        CAST(:idempotency_keys AS uuid[]),
+        CAST(:status_codes AS integer[]),
+        CAST(:details AS varchar[]),
+        CAST(:amounts AS {amount_type}[])
+    ) AS outcome(idempotency_key, status_code, detail, amount)
+    WHERE transferrequest.idempotency_key = outcome.idempotency_key
+    '''.format(amount_type=AMOUNT_SQL_TYPE)
+)
+
+
+def enqueue(
+        db: Session,
+        idempotency_key: uuid.UUID,
+        request: WalletTransferRequest,
+) -> None:
+    """Record the transfer, a known key keeps its first request."""
+    result = db.execute(
+        pg_insert(TransferRequest)
+        .values(
+            idempotency_key=idempotency_key,
+            from_wallet_id=request.from_wallet_id,
+            to_wallet_id=request.to_wallet_id,
+            amount=request.amount,
+            created_at=datetime.datetime.utcnow(),
+        )
+        .on_conflict_do_nothing()
+    )
+    db.commit()
+    queue_stats.inc('accepted' if result.rowcount else 'replayed')
+
+
+def statuses(
+        db: Session,
+        idempotency_keys: List[uuid.UUID],
+) -> List[WalletTransferStatus]:
+    """Status of every key, in the order of the keys."""
+    requests = {
+        request.idempotency_key: request
+        for request in db.query(TransferRequest).filter(
+            TransferRequest.idempotency_key.in_(set(idempotency_keys))
+        )
+    }
+    results = []
+    for key in idempotency_keys:
+        request = requests.get(key)
+        if request is None:
+            results.append(
+                WalletTransferStatus(idempotency_key=key, status='unknown')
+            )
+        elif request.status_code is None:
+            results.append(
+                WalletTransferStatus(idempotency_key=key, status='pending')
+            )
+        elif request.status_code == 200:
+            results.append(
+                WalletTransferStatus(
+                    idempotency_key=key,
+                    status='done',
+                    status_code=200,
+                    wallet_id=request.from_wallet_id,
+                    amount=request.from_wallet_amount,
+                )
+            )
+        else:
+            results.append(
+                WalletTransferStatus(
+                    idempotency_key=key,
+                    status='done',
+                    status_code=request.status_code,
+                    detail=request.detail,
+                )
+            )
+    return results
+
+
+def process(db: Session, batch_size: int) -> int:
+    """Apply up to batch_size pending transfers, oldest first.
+
+    Returns how many were applied, 0 when there are none left to claim.
+    """
+    for _ in retry.attempts(queue_stats):
+        try:
+            rows = db.execute(
+                CLAIM_STATEMENT, dict(batch_size=batch_size),
+            ).fetchall()
+            if not rows:
+                db.commit()
+                return 0
+
+            # the amounts are stored ones already
+            transfers = [
+                WalletTransferBatchItem.construct(
+                    idempotency_key=row.idempotency_key,
+                    from_wallet_id=row.from_wallet_id,
+                    to_wallet_id=row.to_wallet_id,
+                    amount=row.amount,
+                )
+                for row in rows
+            ]
+            utcnow = datetime.datetime.utcnow()
+            results, _ = DBHelper._apply_transfer_batch(db, transfers, utcnow)
+            db.execute(
+                RECORD_OUTCOMES_STATEMENT,
+                dict(
+                    idempotency_keys=[
+                        str(result.idempotency_key) for result in results
+                    ],
+                    status_codes=[result.status_code for result in results],
+                    details=[result.detail for result in results],
+                    amounts=[
+                        None if result.amount is None
+                        else to_stored_amount(result.amount)
+                        for result in results
+                    ],
+                    processed_at=utcnow,
+                ),
+            )
+            db.commit()
+            queue_stats.inc('batches')
+            queue_stats.inc('processed', len(results))
+            return len(results)
+        except exc.IntegrityError as exception:
+            db.rollback()
+
+            # a transfer with one of the keys has been committed by
+            # /v1/wallet/transfer meanwhile, the next pass replays it
+            if not isinstance(exception.orig, UniqueViolation):
+                raise
+            queue_stats.inc('integrity_errors')
+        except exc.OperationalError as exception:
+            db.rollback()
+
+            if not retry.is_transient(exception):
+                raise
+            queue_stats.inc('aborts')
+
+
+def prune(
+        db: Session,
+        before: datetime.datetime,
+        batch_size: int = 10000,
+) -> int:
+    """Delete the requests processed before the time, in batches.
+
+    Pending requests are kept whatever their age. Returns the number
+    of requests deleted.
+    """
+    deleted = 0
+    while True:
+        result = db.execute(
+            text(
+                '''
+                DELETE FROM transferrequest
+                WHERE idempotency_key IN (
+                    SELECT idempotency_key
+                    FROM transferrequest
+                    WHERE processed_at < :before
+                    LIMIT :batch_size
+                )
+                '''
+            ),
+            dict(before=before, batch_size=batch_size),
+        )
+        db.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
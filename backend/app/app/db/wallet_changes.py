@@ -0,0 +1,192 @@
+"""Balance changes of the wallets, pushed to the subscribers.
+
+Every ledger row NOTIFYs the balances of its wallets on commit, see
+alembic/versions/06_wallet_changes.py. Each worker LISTENs on one
+connection of its own, read on the event loop, and hands the changes
+to the subscriptions of the wallets. A subscription keeps the last
+balance of every wallet only, a slow client skips the ones in between
+and the memory of a subscription stays bounded.
+"""
+import asyncio
+import collections
+import decimal
+import logging
+import select
+import uuid
+from typing import Any
+from typing import DefaultDict
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Set
+
+import psycopg2.extensions
+
+from app.core.stats import Counters
+from app.db.session import engine
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'wallet_changes'
+# seconds to wait before listening again when the connection is lost
+RECONNECT_DELAY = 1.0
+
+
+class WalletChangeStats(Counters):
+
+    def __init__(self, changes: 'WalletChanges') -> None:
+        super().__init__('wallet_changes')
+        self.changes = changes
+
+    def snapshot(self) -> Dict[str, int]:
+        values = super().snapshot()
+        values['subscriptions'] = len(self.changes.subscriptions)
+        return values
+
+
+class Subscription:
+    """Balance changes of some wallets for one client."""
+
+    def __init__(self, wallet_ids: Iterable[uuid.UUID]) -> None:
+        self.wallet_ids = frozenset(wallet_ids)
+        self._changed: Dict[uuid.UUID, decimal.Decimal] = {}
+        self._event = asyncio.Event()
+        # changes may have been missed, the client has to read again
+        self.lost = False
+
+    def push(self, wallet_id: uuid.UUID, amount: decimal.Decimal) -> None:
+        self._changed[wallet_id] = amount
+        self._event.set()
+
+    def lose(self) -> None:
+        self.lost = True
+        self._event.set()
+
+    async def changes(
+            self,
+            timeout: Optional[float] = None,
+    ) -> Dict[uuid.UUID, decimal.Decimal]:
+        """The balances changed since the last call, waits for one.
+
+        Empty after the timeout without changes, or once lost.
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+        self._event.clear()
+        changed, self._changed = self._changed, {}
+        return changed
+
+
+class WalletChanges:
+    """The listener of the process and its subscriptions.
+
+    The amounts are the stored ones, app.schemas.Amount converts them.
+    """
+
+    def __init__(self) -> None:
+        self.subscriptions: Set[Subscription] = set()
+        self._by_wallet: DefaultDict[uuid.UUID, Set[Subscription]] = (
+            collections.defaultdict(set)
+        )
+        self._connection: Optional[Any] = None
+        self._fd: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped = True
+        self.stats = WalletChangeStats(self)
+
+    def subscribe(self, wallet_ids: Iterable[uuid.UUID]) -> Subscription:
+        subscription = Subscription(wallet_ids)
+        self.subscriptions.add(subscription)
+        for wallet_id in subscription.wallet_ids:
+            self._by_wallet[wallet_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+        for wallet_id in subscription.wallet_ids:
+            subscribers = self._by_wallet.get(wallet_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_wallet[wallet_id]
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._stopped = False
+        await self._listen()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._close()
+
+    def dispatch(self, payload: str) -> None:
+        wallet_id, amount = payload.split(' ')
+        wallet_id = uuid.UUID(wallet_id)
+        subscribers = self._by_wallet.get(wallet_id)
+        if not subscribers:
+            return
+        amount = decimal.Decimal(amount)
+        for subscription in subscribers:
+            subscription.push(wallet_id, amount)
+        self.stats.inc('deliveries', len(subscribers))
+
+    async def _listen(self) -> None:
+        try:
+            # a connection of the pool's kind, taken out of the pool
+            self._connection = await self._loop.run_in_executor(
+                None, engine.raw_connection,
+            )
+            self._connection.detach()
+            self._connection.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT,
+            )
+            with self._connection.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(CHANNEL))
+        except Exception:
+            logger.exception('Listening for wallet changes failed')
+            self._reconnect()
+            return
+        self._fd = self._connection.fileno()
+        self._loop.add_reader(self._fd, self._read)
+        self.stats.inc('listens')
+
+    def _read(self) -> None:
+        try:
+            self._connection.poll()
+        except (psycopg2.Error, select.error):
+            logger.exception('Lost the wallet changes connection')
+            self._reconnect()
+            return
+        notifies = self._connection.notifies
+        self.stats.inc('notifications', len(notifies))
+        for notify in notifies:
+            self.dispatch(notify.payload)
+        notifies.clear()
+
+    def _reconnect(self) -> None:
+        # changes made meanwhile are missed, the subscribers are told
+        self._close()
+        for subscription in self.subscriptions:
+            subscription.lose()
+        self._loop.call_later(RECONNECT_DELAY, self._restart)
+
+    def _restart(self) -> None:
+        if not self._stopped:
+            self._loop.create_task(self._listen())
+
+    def _close(self) -> None:
+        if self._fd is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._fd)
+        self._fd = None
+        if self._connection is None:
+            return
+        try:
+            self._connection.close()
+        except psycopg2.Error:
+            pass
+        self._connection = None
+
+
+wallet_changes = WalletChanges()
@@ -0,0 +1,91 @@
+"""Import donations from a CSV or NDJSON file.
+
+Every row has idempotency_key, wallet_id and amount; CSV files have a
+header. The import can be run again after a failure, the imported rows
+are skipped by their keys:
+
+    python /app/app/import_donations.py donations.csv
+    zcat donations.ndjson.gz | python /app/app/import_donations.py \\
+        --format ndjson -
+
+With shards the file is read once per shard, each shard importing the
+rows of its wallets, so it can't be read from stdin.
+"""
+import argparse
+import csv
+import decimal
+import json
+import logging
+import sys
+import time
+from typing import Iterator
+from typing import TextIO
+from typing import Tuple
+
+from app.core.config import settings
+from app.db.donation_import import import_donations
+from app.db.session import DBSessionMaker
+from app.db.session import ShardSessionMakers
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('idempotency_key', 'wallet_id', 'amount')
+
+
+def read_csv(file: TextIO) -> Iterator[Tuple[str, str, str]]:
+    for row in csv.DictReader(file):
+        yield tuple(row.get(column) for column in COLUMNS)
+
+
+def read_ndjson(file: TextIO) -> Iterator[Tuple[str, str, str]]:
+    for line in file:
+        if line.strip():
+            row = json.loads(line, parse_float=decimal.Decimal)
+            yield tuple(str(row.get(column)) for column in COLUMNS)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file', help='path of the file, - for stdin')
+    parser.add_argument('--format', choices=('csv', 'ndjson'))
+    parser.add_argument(
+        '--chunk-size', type=int, default=settings.DONATION_IMPORT_CHUNK_SIZE,
+    )
+    args = parser.parse_args()
+
+    file_format = args.format or (
+        'ndjson' if args.file.endswith(('.ndjson', '.jsonl')) else 'csv'
+    )
+    read = read_ndjson if file_format == 'ndjson' else read_csv
+    if ShardSessionMakers and args.file == '-':
+        parser.error('the file is read once per shard, stdin is not')
+
+    def progress(totals):
+        logger.info(
+            '%(rows)s rows: %(imported)s imported, %(duplicates)s used keys,'
+            ' %(unknown_wallets)s unknown wallets, %(rate).0f rows/s',
+            dict(
+                totals,
+                rate=totals['rows'] / (time.monotonic() - started_at),
+            ),
+        )
+
+    for shard in range(len(ShardSessionMakers)) or [None]:
+        if shard is not None:
+            logger.info('Shard %s', shard)
+        started_at = time.monotonic()
+        file = sys.stdin if args.file == '-' else open(args.file, newline='')
+        db = DBSessionMaker() if shard is None else ShardSessionMakers[shard]()
+        try:
+            totals = import_donations(
+                db, read(file), args.chunk_size, progress=progress, shard=shard,
+            )
+            logger.info('Done: %s', totals)
+        finally:
+            db.close()
+            file.close()
+
+
+if __name__ == '__main__':
+    main()
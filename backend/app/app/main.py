@@ -1,6 +1,31 @@
 from fastapi import FastAPI
 
 from app.api.routers import api_router
+from app.core.config import settings
+from app.db.session import health_checker
+from app.db.wallet_changes import wallet_changes
 
 app = FastAPI()
 app.include_router(api_router)
+
+
+@app.on_event('startup')
+def start_health_checker() -> None:
+    # in every worker, threads don't survive the fork
+    health_checker.start()
+
+
+@app.on_event('shutdown')
+def stop_health_checker() -> None:
+    health_checker.stop()
+
+
+@app.on_event('startup')
+async def start_wallet_changes() -> None:
+    if settings.WALLET_CHANGES_ENABLED:
+        await wallet_changes.start()
+
+
+@app.on_event('shutdown')
+def stop_wallet_changes() -> None:
+    wallet_changes.stop()
@@ -0,0 +1,131 @@
+"""Maintenance of the transaction partitions and idempotency keys.
+
+Meant to be run by cron, e.g. daily:
+
+    python /app/app/maintenance.py create-partitions
+    python /app/app/maintenance.py prune-keys
+    python /app/app/maintenance.py prune-transfer-requests
+    python /app/app/maintenance.py detach-partitions --before 2024-01
+
+and, with SQLALCHEMY_SHARD_URIS, every minute:
+
+    python /app/app/maintenance.py settle-transfers
+
+Every command runs on each shard in turn when there are shards.
+"""
+import argparse
+import datetime
+import logging
+
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import partitions
+from app.db import transfer_queue
+from app.db.session import DBSessionMaker
+from app.db.session import ShardSessionMakers
+from app.db.sharded_helper import ShardedDBHelper
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def month(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, '%Y-%m').date()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser(
+        'create-partitions', help='create the next monthly partitions',
+    )
+    create.add_argument(
+        '--months-ahead',
+        type=int,
+        default=settings.TRANSACTION_PARTITIONS_AHEAD,
+    )
+    create.add_argument(
+        '--since', type=month, help='first month, for backdated rows',
+    )
+
+    detach = commands.add_parser(
+        'detach-partitions', help='detach the partitions of old months',
+    )
+    detach.add_argument(
+        '--before',
+        type=month,
+        required=True,
+        help='first month to keep, IDEMPOTENCY_KEY_RETENTION_DAYS ago at most',
+    )
+    detach.add_argument(
+        '--drop', action='store_true', help='drop them after detaching',
+    )
+
+    prune = commands.add_parser(
+        'prune-keys', help='forget the idempotency keys of old transactions',
+    )
+    prune.add_argument(
+        '--days', type=int, default=settings.IDEMPOTENCY_KEY_RETENTION_DAYS,
+    )
+
+    prune_requests = commands.add_parser(
+        'prune-transfer-requests',
+        help='forget the outcomes of old asynchronous transfers',
+    )
+    prune_requests.add_argument(
+        '--days', type=int, default=settings.TRANSFER_QUEUE_RETENTION_DAYS,
+    )
+
+    commands.add_parser(
+        'settle-transfers',
+        help='credit the cross-shard transfers left debited only',
+    )
+
+    args = parser.parse_args()
+    for session_maker in ShardSessionMakers or [DBSessionMaker]:
+        run(session_maker(), args)
+
+
+def run(db: Session, args: argparse.Namespace) -> None:
+    try:
+        if args.command == 'create-partitions':
+            for name in partitions.create_partitions(
+                    db, args.months_ahead, since=args.since,
+            ):
+                logger.info('Created %s', name)
+        elif args.command == 'detach-partitions':
+            for name in partitions.detach_partitions(
+                    db, args.before, drop=args.drop,
+            ):
+                logger.info('Detached %s', name)
+        elif args.command == 'prune-keys':
+            deleted = partitions.prune_keys(
+                db,
+                datetime.datetime.utcnow()
+                - datetime.timedelta(days=args.days),
+            )
+            logger.info('Deleted %s keys', deleted)
+        elif args.command == 'prune-transfer-requests':
+            deleted = transfer_queue.prune(
+                db,
+                datetime.datetime.utcnow()
+                - datetime.timedelta(days=args.days),
+            )
+            logger.info('Deleted %s transfer requests', deleted)
+        elif args.command == 'settle-transfers':
+            settled = ShardedDBHelper.settle_transfers(
+                db,
+                datetime.datetime.utcnow()
+                - datetime.timedelta(
+                    seconds=settings.SHARD_TRANSFER_SETTLE_DELAY,
+                ),
+            )
+            logger.info('Credited %s transfers', settled)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Convert the amount columns from numeric to minor units while serving.
+
+The steps are run one by one, see app/db/amount_migration.py:
+
+    python /app/app/migrate_amounts.py expand
+    python /app/app/migrate_amounts.py backfill --batch-size 10000
+    # stop the workers
+    python /app/app/migrate_amounts.py switch
+    # start them with AMOUNT_MINOR_UNITS=true
+    python /app/app/migrate_amounts.py cleanup
+
+revert before cleanup goes back to numeric, the workers are restarted
+with AMOUNT_MINOR_UNITS=false then. Every step runs on each shard in
+turn when there are shards.
+"""
+import argparse
+import logging
+
+from sqlalchemy.orm import Session
+
+from app.db import amount_migration
+from app.db.session import DBSessionMaker
+from app.db.session import ShardSessionMakers
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('expand', help='add the bigint shadow columns')
+    backfill = commands.add_parser(
+        'backfill', help='fill the shadow columns of the existing rows',
+    )
+    backfill.add_argument('--batch-size', type=int, default=10000)
+    commands.add_parser('switch', help='store the amounts in minor units')
+    commands.add_parser('revert', help='store the amounts in numeric again')
+    commands.add_parser('cleanup', help='drop the shadow columns')
+    args = parser.parse_args()
+    for session_maker in ShardSessionMakers or [DBSessionMaker]:
+        run(session_maker(), args)
+
+
+def run(db: Session, args: argparse.Namespace) -> None:
+    try:
+        if args.command == 'backfill':
+            amount_migration.backfill(
+                db,
+                args.batch_size,
+                progress=lambda table, rows: logger.info(
+                    'Filled %s rows of %s', rows, table,
+                ),
+            )
+        else:
+            getattr(amount_migration, args.command)(db)
+        logger.info(
+            'Done, the amounts are stored in %s',
+            amount_migration.stored_type(db),
+        )
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
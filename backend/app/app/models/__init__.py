@@ -1,2 +1,9 @@
 from .transaction import Transaction
 from .wallet import Wallet
+from .wallet_slot import WalletSlot
+from .transaction_key import TransactionKey
+from .reconciliation import ReconciliationArchive
+from .reconciliation import ReconciliationBalance
+from .reconciliation import ReconciliationCheckpoint
+from .transfer_request import TransferRequest
+from .shard_transfer import ShardTransfer
@@ -0,0 +1,50 @@
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import BigInteger
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import UniqueConstraint
+
+from app.db.amount import AmountType
+from app.db.base_class import Base
+
+
+class ReconciliationCheckpoint(Base):
+    """How far the ledger has been summed up into ReconciliationBalance.
+
+    There is a single row, transactions up to last_transaction_id are
+    accounted for.
+    """
+
+    id = Column(Integer, primary_key=True)
+    last_transaction_id = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+
+class ReconciliationBalance(Base):
+    """Balance of the wallet as its transactions up to the checkpoint
+    imply."""
+
+    wallet_id = Column(UUID(as_uuid=True), primary_key=True)
+    amount = Column(
+        AmountType,
+        nullable=False,
+        default=0,
+    )
+
+
+class ReconciliationArchive(Base):
+    """Sum of the transactions of the wallet in a partition of the ledger
+    that has been detached, see app.db.partitions."""
+
+    __table_args__ = (UniqueConstraint('partition', 'wallet_id'),)
+
+    id = Column(Integer, primary_key=True)
+    partition = Column(String, nullable=False)
+    wallet_id = Column(UUID(as_uuid=True), nullable=False)
+    amount = Column(
+        AmountType,
+        nullable=False,
+        default=0,
+    )
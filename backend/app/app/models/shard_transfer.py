@@ -0,0 +1,38 @@
+import datetime
+
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
+from sqlalchemy import text
+
+from app.db.amount import AmountType
+from app.db.base_class import Base
+
+
+class ShardTransfer(Base):
+    """Cross-shard transfer debited on the shard of this row.
+
+    Written with the debit, credited_at is set once the shard of
+    to_wallet_id has the credit, see app.db.sharded_helper.
+    """
+
+    # the transfers left to credit, oldest first
+    __table_args__ = (
+        Index(
+            'ix_shardtransfer_pending_created_at',
+            'created_at',
+            postgresql_where=text('credited_at IS NULL'),
+        ),
+    )
+
+    idempotency_key = Column(UUID(as_uuid=True), primary_key=True)
+    from_wallet_id = Column(UUID(as_uuid=True), nullable=False)
+    to_wallet_id = Column(UUID(as_uuid=True), nullable=False)
+    amount = Column(AmountType, nullable=False)
+    created_at = Column(
+        DateTime,
+        nullable=False,
+        default=datetime.datetime.utcnow,
+    )
+    credited_at = Column(DateTime)
@@ -1,33 +1,60 @@
 import datetime
 
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
-from sqlalchemy import Integer
-from sqlalchemy import Numeric
+from sqlalchemy import Index
 
-from app.core.config import settings
+from app.db.amount import AmountType
 from app.db.base_class import Base
 
 
 class Transaction(Base):
-    id = Column(Integer, primary_key=True)
-    idempotency_key = Column(UUID(as_uuid=True), unique=True)
-    amount = Column(Numeric(scale=settings.CURRENCY_SCALE))
-
-    from_wallet_id = Column(
-        UUID(as_uuid=True), ForeignKey("wallet.wallet_id"), index=True,
+    # Partitioned by month of created_at, so old months can be detached
+    # and the indexes of the current one stay small. A partitioned table
+    # can't have a unique index without created_at, the keys are kept
+    # unique by TransactionKey.
+    #
+    # The history of a wallet is read newest first by (created_at, id)
+    # from both sides, these indexes cover it without heap access.
+    __table_args__ = (
+        Index(
+            'ix_transaction_from_wallet_id_created_at_id',
+            'from_wallet_id',
+            'created_at',
+            'id',
+            postgresql_include=[
+                'idempotency_key', 'amount', 'to_wallet_id',
+                'from_wallet_amount',
+            ],
+        ),
+        Index(
+            'ix_transaction_to_wallet_id_created_at_id',
+            'to_wallet_id',
+            'created_at',
+            'id',
+            postgresql_include=[
+                'idempotency_key', 'amount', 'from_wallet_id',
+                'to_wallet_amount',
+            ],
+        ),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
     )
-    from_wallet_amount = Column(Numeric(scale=settings.CURRENCY_SCALE))
 
-    to_wallet_id = Column(
-        UUID(as_uuid=True), ForeignKey("wallet.wallet_id"), index=True,
-    )
-    to_wallet_amount = Column(Numeric(scale=settings.CURRENCY_SCALE))
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    idempotency_key = Column(UUID(as_uuid=True), index=True)
+    amount = Column(AmountType)
+
+    from_wallet_id = Column(UUID(as_uuid=True), ForeignKey("wallet.wallet_id"))
+    from_wallet_amount = Column(AmountType)
+
+    to_wallet_id = Column(UUID(as_uuid=True), ForeignKey("wallet.wallet_id"))
+    to_wallet_amount = Column(AmountType)
 
     created_at = Column(
         DateTime,
-        nullable=False,
+        primary_key=True,
         default=datetime.datetime.utcnow,
     )
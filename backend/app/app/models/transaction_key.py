@@ -0,0 +1,17 @@
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+
+from app.db.base_class import Base
+
+
+class TransactionKey(Base):
+    """Used idempotency key of a Transaction.
+
+    Rows are inserted by a trigger on transaction, a duplicate key fails
+    the insert. created_at points to the partition of the transaction.
+    Keys older than IDEMPOTENCY_KEY_RETENTION_DAYS are deleted.
+    """
+
+    idempotency_key = Column(UUID(as_uuid=True), primary_key=True)
+    created_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,46 @@
+import datetime
+
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import text
+
+from app.db.amount import AmountType
+from app.db.base_class import Base
+
+
+class TransferRequest(Base):
+    """Transfer accepted by /v1/wallet/transfer/async.
+
+    Applied later by app/transfer_worker.py, which records its outcome
+    the way /v1/wallet/transfer/batch reports it: status_code is NULL
+    until then. The wallets are checked when it is applied.
+    """
+
+    # the queue, oldest first; done requests leave the index
+    __table_args__ = (
+        Index(
+            'ix_transferrequest_pending_created_at',
+            'created_at',
+            postgresql_where=text('status_code IS NULL'),
+        ),
+    )
+
+    idempotency_key = Column(UUID(as_uuid=True), primary_key=True)
+    from_wallet_id = Column(UUID(as_uuid=True), nullable=False)
+    to_wallet_id = Column(UUID(as_uuid=True), nullable=False)
+    amount = Column(AmountType, nullable=False)
+    created_at = Column(
+        DateTime,
+        nullable=False,
+        default=datetime.datetime.utcnow,
+    )
+
+    status_code = Column(Integer)
+    detail = Column(String)
+    # balance of from_wallet_id right after the transfer
+    from_wallet_amount = Column(AmountType)
+    processed_at = Column(DateTime, index=True)
@@ -5,9 +5,8 @@ from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import Integer
-from sqlalchemy import Numeric
 
-from app.core.config import settings
+from app.db.amount import AmountType
 from app.db.base_class import Base
 
 
@@ -23,10 +22,13 @@ class Wallet(Base):
         default=uuid.uuid4,
     )
     amount = Column(
-        Numeric(scale=settings.CURRENCY_SCALE),
+        AmountType,
         nullable=False,
         default=0,
     )
+    # A hot wallet credits donations to one of its WalletSlot rows
+    # instead of this one, its balance is amount plus all the slots.
+    slots = Column(Integer, nullable=False, default=0, server_default='0')
 
     created_at = Column(
         DateTime,
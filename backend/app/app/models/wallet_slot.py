@@ -0,0 +1,25 @@
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Integer
+from sqlalchemy import UniqueConstraint
+
+from app.db.amount import AmountType
+from app.db.base_class import Base
+
+
+class WalletSlot(Base):
+    """Part of the balance of a hot wallet, see Wallet.slots."""
+
+    __table_args__ = (UniqueConstraint('wallet_id', 'slot'),)
+
+    id = Column(Integer, primary_key=True)
+    wallet_id = Column(
+        UUID(as_uuid=True), ForeignKey("wallet.wallet_id"), nullable=False,
+    )
+    slot = Column(Integer, nullable=False)
+    amount = Column(
+        AmountType,
+        nullable=False,
+        default=0,
+    )
@@ -0,0 +1,85 @@
+"""Check the wallet balances against the ledger.
+
+The transactions are summed up per wallet incrementally from the last
+checkpoint, --rebuild sums the whole ledger up again. Exits with 1 when
+a balance doesn't match:
+
+    python /app/app/reconcile.py
+    python /app/app/reconcile.py --rebuild --processes 8
+
+Every shard is reconciled on its own in turn when there are shards.
+"""
+import argparse
+import logging
+import sys
+from typing import List
+from typing import Optional
+
+from app.core.config import settings
+from app.db import reconciliation
+from app.db.session import DBSessionMaker
+from app.db.session import ShardSessionMakers
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument(
+        '--chunk-size', type=int, default=settings.RECONCILIATION_CHUNK_SIZE,
+    )
+    args = parser.parse_args()
+
+    mismatches: List[reconciliation.Mismatch] = []
+    for shard in range(len(ShardSessionMakers)) or [None]:
+        mismatches += run(args, shard)
+
+    for mismatch in mismatches:
+        logger.error(
+            'Wallet %s has %s, its transactions make %s',
+            mismatch.wallet_id, mismatch.amount, mismatch.ledger_amount,
+        )
+    if mismatches:
+        sys.exit(1)
+    logger.info('All balances match')
+
+
+def run(
+        args: argparse.Namespace,
+        shard: Optional[int] = None,
+) -> List[reconciliation.Mismatch]:
+    if shard is not None:
+        logger.info('Shard %s', shard)
+    db = DBSessionMaker() if shard is None else ShardSessionMakers[shard]()
+    try:
+        if args.rebuild:
+            last_transaction_id = reconciliation.rebuild(
+                db,
+                args.processes,
+                progress=lambda done, total: logger.info(
+                    'Rebuilt %s of %s wallet ranges', done, total,
+                ),
+                shard=shard,
+            )
+            logger.info('Rebuilt up to transaction %s', last_transaction_id)
+        else:
+            rows = reconciliation.reconcile(
+                db,
+                args.chunk_size,
+                progress=lambda rows, last_transaction_id: logger.info(
+                    '%s rows, up to transaction %s',
+                    rows, last_transaction_id,
+                ),
+            )
+            logger.info('Reconciled %s rows', rows)
+
+        return reconciliation.mismatches(db)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,23 @@
+from .wallets import Amount
+from .wallets import to_stored_amount
 from .wallets import WalletGetRequest
 from .wallets import WalletResponse
+from .wallets import WalletGetBatchRequest
+from .wallets import WalletGetBatchItemResponse
+from .wallets import WalletGetBatchResponse
 from .wallets import WalletDonateRequest
 from .wallets import WalletTransferRequest
+from .wallets import WalletCreateBatchRequest
+from .wallets import WalletCreateBatchResponse
+from .wallets import WalletSlotsRequest
+from .wallets import WalletTransferBatchItem
+from .wallets import WalletTransferBatchRequest
+from .wallets import WalletTransferBatchItemResponse
+from .wallets import WalletTransferBatchResponse
+from .wallets import WalletTransferAcceptedResponse
+from .wallets import WalletTransferStatusRequest
+from .wallets import WalletTransferStatus
+from .wallets import WalletTransferStatusResponse
+from .wallets import WalletTransactionsRequest
+from .wallets import WalletTransaction
+from .wallets import WalletTransactionsResponse
@@ -1,26 +1,173 @@
+import datetime
 import decimal
 import uuid
+from typing import Any
+from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Union
 
-from pydantic import BaseModel, condecimal
+from pydantic import BaseModel, condecimal, conint, conlist, validator
 
 from app.core.config import settings
 
 
+def to_stored_amount(amount: decimal.Decimal) -> Union[int, decimal.Decimal]:
+    """The amount of a request as the database stores it."""
+    if settings.AMOUNT_MINOR_UNITS:
+        return int(amount.scaleb(settings.CURRENCY_SCALE))
+    return amount
+
+
+class Amount(decimal.Decimal):
+    """Amount of a response, made from the amount the database stores.
+
+    An Amount is converted already and validates as it is: FastAPI
+    validates the response once more and must not convert it again.
+    """
+
+    @classmethod
+    def __get_validators__(cls) -> Iterator[Callable]:
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value: Any) -> 'Amount':
+        if isinstance(value, cls):
+            return value
+        if settings.AMOUNT_MINOR_UNITS:
+            return cls(
+                decimal.Decimal(value).scaleb(-settings.CURRENCY_SCALE)
+            )
+        return cls(value)
+
+
 class WalletGetRequest(BaseModel):
     wallet_id: uuid.UUID
 
 
 class WalletResponse(BaseModel):
     wallet_id: uuid.UUID
-    amount: decimal.Decimal
+    amount: Amount
+
+
+class WalletGetBatchRequest(BaseModel):
+    wallet_ids: conlist(
+        uuid.UUID,
+        min_items=1,
+        max_items=settings.WALLET_GET_BATCH_MAX_SIZE,
+    )
+
+
+class WalletGetBatchItemResponse(BaseModel):
+    wallet_id: uuid.UUID
+    status_code: int
+    detail: Optional[str] = None
+    amount: Optional[Amount] = None
+
+
+class WalletGetBatchResponse(BaseModel):
+    results: List[WalletGetBatchItemResponse]
 
 
 class WalletDonateRequest(BaseModel):
     wallet_id: uuid.UUID
+    # as the database stores it once validated, see to_stored_amount
     amount: condecimal(gt=0, decimal_places=settings.CURRENCY_SCALE)
 
+    _stored_amount = validator('amount', allow_reuse=True)(to_stored_amount)
+
 
 class WalletTransferRequest(BaseModel):
     from_wallet_id: uuid.UUID
     to_wallet_id: uuid.UUID
+    # as the database stores it once validated, see to_stored_amount
     amount: condecimal(gt=0, decimal_places=settings.CURRENCY_SCALE)
+
+    _stored_amount = validator('amount', allow_reuse=True)(to_stored_amount)
+
+
+class WalletCreateBatchRequest(BaseModel):
+    idempotency_keys: conlist(
+        uuid.UUID,
+        min_items=1,
+        max_items=settings.WALLET_CREATE_BATCH_MAX_SIZE,
+    )
+
+
+class WalletCreateBatchResponse(BaseModel):
+    wallets: List[WalletResponse]
+
+
+class WalletSlotsRequest(BaseModel):
+    wallet_id: uuid.UUID
+    slots: conint(ge=0, le=settings.WALLET_MAX_SLOTS)
+
+
+class WalletTransferBatchItem(WalletTransferRequest):
+    idempotency_key: uuid.UUID
+
+
+class WalletTransferBatchRequest(BaseModel):
+    transfers: conlist(
+        WalletTransferBatchItem,
+        min_items=1,
+        max_items=settings.TRANSFER_BATCH_MAX_SIZE,
+    )
+
+
+class WalletTransferBatchItemResponse(BaseModel):
+    idempotency_key: uuid.UUID
+    status_code: int
+    detail: Optional[str] = None
+    wallet_id: Optional[uuid.UUID] = None
+    amount: Optional[Amount] = None
+
+
+class WalletTransferBatchResponse(BaseModel):
+    results: List[WalletTransferBatchItemResponse]
+
+
+class WalletTransferAcceptedResponse(BaseModel):
+    idempotency_key: uuid.UUID
+    status_url: str
+
+
+class WalletTransferStatusRequest(BaseModel):
+    idempotency_keys: conlist(
+        uuid.UUID,
+        min_items=1,
+        max_items=settings.TRANSFER_BATCH_MAX_SIZE,
+    )
+
+
+class WalletTransferStatus(WalletTransferBatchItemResponse):
+    # pending until a worker applies it, then as the batch reports it;
+    # unknown keys were never accepted, or pruned already
+    status: str
+    status_code: Optional[int] = None
+
+
+class WalletTransferStatusResponse(BaseModel):
+    results: List[WalletTransferStatus]
+
+
+class WalletTransactionsRequest(BaseModel):
+    wallet_id: uuid.UUID
+    limit: conint(ge=1, le=settings.TRANSACTIONS_PAGE_MAX_SIZE) = 100
+    cursor: Optional[str] = None
+
+
+class WalletTransaction(BaseModel):
+    idempotency_key: Optional[uuid.UUID]
+    from_wallet_id: Optional[uuid.UUID]
+    to_wallet_id: Optional[uuid.UUID]
+    amount: Amount
+    # balance of the requested wallet right after the transaction
+    balance: Amount
+    created_at: datetime.datetime
+
+
+class WalletTransactionsResponse(BaseModel):
+    transactions: List[WalletTransaction]
+    next_cursor: Optional[str] = None
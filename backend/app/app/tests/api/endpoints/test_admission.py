@@ -0,0 +1,112 @@
+import asyncio
+import uuid
+from typing import Generator
+
+import pytest
+from fastapi import APIRouter
+from fastapi import FastAPI
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from app.api.endpoints import wallets
+from app.core.admission import admission
+from app.core.admission import admitted
+from app.core.config import settings
+from app.core.metrics import MeasuredRoute
+from app.models import Wallet
+from app.schemas import WalletResponse
+
+WALLET_ID = uuid.UUID('11111111-1111-1111-1111-111111111111')
+
+
+@pytest.fixture()
+def limits(mocker) -> Generator:
+    mocker.patch.object(settings, 'ADMISSION_MAX_IN_FLIGHT', 1)
+    mocker.patch.object(settings, 'ADMISSION_MAX_QUEUED', 1)
+    mocker.patch.object(settings, 'ADMISSION_QUEUE_TIMEOUT', 0.05)
+    mocker.patch.object(settings, 'ADMISSION_WALLET_MAX_IN_FLIGHT', 1)
+    yield
+    admission.in_flight = 0
+    admission.waiters.clear()
+    admission.wallets.clear()
+
+
+def test_admission_endpoint(db: Session, limits: None) -> None:
+    router = APIRouter(route_class=admitted(MeasuredRoute))
+    router.add_api_route(
+        '/v1/wallet/donate',
+        wallets.v1_wallet_donate,
+        methods=['POST'],
+        response_model=WalletResponse,
+    )
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+
+    def donate():
+        return client.post(
+            'v1/wallet/donate',
+            json={'wallet_id': str(WALLET_ID), 'amount': 2},
+            headers={'Idempotency-Key': str(uuid.uuid4())},
+        )
+
+    # another donation to the wallet is in flight
+    admission.wallets[WALLET_ID] = 1
+    response = donate()
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert response.json() == {'detail': 'wallet is busy, try again later'}
+
+    # so is another request
+    admission.wallets.clear()
+    admission.in_flight = 1
+    response = donate()
+    assert response.status_code == 429
+    assert response.json() == {'detail': 'too many requests'}
+    assert not admission.waiters
+
+    admission.in_flight = 0
+    response = donate()
+    assert response.status_code == 200
+    assert response.json()['amount'] == 3
+    assert admission.in_flight == 0
+    assert not admission.wallets
+
+
+def test_admission_queue(limits: None) -> None:
+    other_wallet_id = uuid.uuid4()
+
+    async def scenario() -> None:
+        await admission.acquire([WALLET_ID])
+        queued = asyncio.ensure_future(admission.acquire([other_wallet_id]))
+        await asyncio.sleep(0)
+        assert len(admission.waiters) == 1
+
+        # the queue is full
+        with pytest.raises(HTTPException) as rejected:
+            await admission.acquire([])
+        assert rejected.value.status_code == 429
+
+        # the queued one gets the slot released
+        admission.release([WALLET_ID])
+        await queued
+        assert admission.in_flight == 1
+        assert dict(admission.wallets) == {other_wallet_id: 1}
+
+        # and holds it past the deadline of the next one
+        with pytest.raises(HTTPException):
+            await admission.acquire([])
+        assert not admission.waiters
+        admission.release([other_wallet_id])
+        assert admission.in_flight == 0
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+    assert admission.stats.snapshot()['rejected_queue_full'] >= 1
@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+import uuid
+
+from fastapi.testclient import TestClient
+from prometheus_client.parser import text_string_to_metric_families
+from sqlalchemy.orm import Session
+
+from app.core import metrics
+from app.models import Wallet
+
+WALLET_ID = '11111111-1111-1111-1111-111111111111'
+
+
+def read_samples(text: str):
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(text)
+        for sample in family.samples
+    }
+
+
+def test_metrics(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+    before = read_samples(client.get('/metrics').text)
+
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+    request = {'wallet_id': WALLET_ID, 'amount': 2}
+    client.post('v1/wallet/donate', json=request, headers=headers)
+    client.post('v1/wallet/donate', json=request, headers=headers)
+    client.post('v1/wallet/get', json={'wallet_id': str(uuid.uuid4())})
+
+    samples = read_samples(client.get('/metrics').text)
+
+    def increase(name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return samples.get(key, 0) - before.get(key, 0)
+
+    route = '/v1/wallet/donate'
+    assert increase(
+        'paymarket_request_duration_seconds_count', route=route,
+    ) == 2
+    assert increase('paymarket_responses_total', route=route, status='200') == 2
+    assert increase(
+        'paymarket_responses_total', route='/v1/wallet/get', status='404',
+    ) == 1
+    assert increase(
+        'paymarket_requests_in_progress', route=route,
+    ) == 0
+    # the replay only looks its key up
+    for phase, count in (
+            ('lookup', 2), ('lock', 1), ('update', 1), ('ledger', 1),
+            ('commit', 1),
+    ):
+        assert increase(
+            'paymarket_db_phase_duration_seconds_count',
+            operation='donate',
+            phase=phase,
+        ) == count
+    assert increase(
+        'paymarket_events_total', namespace='idempotency', event='cache_hits',
+    ) == 1
+
+
+def test_metrics_multiprocess(tmp_path, monkeypatch) -> None:
+    # each process writes its own files, the registry sums them up
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    for _ in range(2):
+        subprocess.run(
+            [
+                sys.executable, '-c',
+                'from app.core.stats import Counters; '
+                'Counters("test").inc("runs")',
+            ],
+            env=env,
+            check=True,
+        )
+
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    samples = {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in metrics.registry().collect()
+        for sample in family.samples
+    }
+    assert samples[(
+        'paymarket_events_total',
+        (('event', 'runs'), ('namespace', 'test')),
+    )] == 2
@@ -0,0 +1,181 @@
+import datetime
+import importlib
+import uuid
+from typing import AsyncGenerator
+from typing import Generator
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from app.api.endpoints import wallets_async
+from app.core.admission import admission
+from app.core.config import settings
+from app.db.session import get_async_db_session
+from app.models import Wallet
+from app.models import Transaction
+from app.models import TransactionKey
+
+IDEMPOTENCY_KEY = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+HEADERS = {'Idempotency-Key': IDEMPOTENCY_KEY}
+DONATE_IDEMPOTENCY_KEY = 'bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb'
+FROM_WALLET_ID = '11111111-1111-1111-1111-111111111111'
+TO_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+
+
+@pytest.fixture()
+def admission_enabled(mocker) -> Generator:
+    mocker.patch.object(settings, 'ADMISSION_ENABLED', True)
+    mocker.patch.object(settings, 'ADMISSION_WALLET_MAX_IN_FLIGHT', 1)
+    importlib.reload(wallets_async)
+    yield
+    mocker.stopall()
+    importlib.reload(wallets_async)
+    admission.wallets.clear()
+
+
+@pytest.fixture()
+def async_client() -> Generator:
+    engine = create_async_engine(
+        settings.SQLALCHEMY_DATABASE_URI.replace(
+            'postgresql://', 'postgresql+asyncpg://', 1,
+        ),
+        poolclass=NullPool,
+    )
+
+    async def _get_async_db_session() -> AsyncGenerator:
+        async with AsyncSession(engine, expire_on_commit=False) as db:
+            yield db
+
+    app = FastAPI()
+    app.include_router(wallets_async.router)
+    app.dependency_overrides[get_async_db_session] = _get_async_db_session
+    with TestClient(app) as c:
+        yield c
+
+
+def test_wallet_async(async_client: TestClient, db: Session, mocker) -> None:
+    mocker.patch('uuid.uuid4', return_value=FROM_WALLET_ID)
+    response = async_client.post('v1/wallet/create', headers=HEADERS)
+    assert response.json() == {'wallet_id': FROM_WALLET_ID, 'amount': 0}
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=0))
+    db.commit()
+
+    request = {'wallet_id': FROM_WALLET_ID, 'amount': 10}
+    response = async_client.post(
+        'v1/wallet/donate',
+        json=request,
+        headers={'Idempotency-Key': DONATE_IDEMPOTENCY_KEY},
+    )
+    assert response.json() == {'wallet_id': FROM_WALLET_ID, 'amount': 10}
+
+    request = {
+        'from_wallet_id': FROM_WALLET_ID,
+        'to_wallet_id': TO_WALLET_ID,
+        'amount': 2.5,
+    }
+    expected = {'wallet_id': FROM_WALLET_ID, 'amount': 7.5}
+    response = async_client.post(
+        'v1/wallet/transfer', json=request, headers=HEADERS,
+    )
+    assert response.status_code == 200
+    assert response.json() == expected
+
+    # check idempotency
+    response = async_client.post(
+        'v1/wallet/transfer', json=request, headers=HEADERS,
+    )
+    assert response.json() == expected
+    assert db.query(Transaction).count() == 2
+
+    response = async_client.post(
+        'v1/wallet/get', json={'wallet_id': TO_WALLET_ID},
+    )
+    assert response.json() == {'wallet_id': TO_WALLET_ID, 'amount': 2.5}
+
+
+def test_wallet_async_errors(async_client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=1))
+    db.commit()
+
+    response = async_client.post(
+        'v1/wallet/get', json={'wallet_id': TO_WALLET_ID},
+    )
+    assert response.status_code == 404
+
+    response = async_client.post(
+        'v1/wallet/transfer',
+        json={
+            'from_wallet_id': FROM_WALLET_ID,
+            'to_wallet_id': TO_WALLET_ID,
+            'amount': 2,
+        },
+        headers=HEADERS,
+    )
+    assert response.status_code == 400
+    assert response.json() == {'detail': 'not enough money'}
+
+
+def test_wallet_async_archived_key(
+        async_client: TestClient, db: Session,
+) -> None:
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=0))
+    # the keys of a detached month, their transactions are gone
+    for key in (IDEMPOTENCY_KEY, DONATE_IDEMPOTENCY_KEY):
+        db.add(TransactionKey(
+            idempotency_key=key, created_at=datetime.datetime(2020, 1, 10),
+        ))
+    db.commit()
+
+    response = async_client.post(
+        'v1/wallet/donate',
+        json={'wallet_id': FROM_WALLET_ID, 'amount': 1},
+        headers={'Idempotency-Key': DONATE_IDEMPOTENCY_KEY},
+    )
+    assert response.status_code == 410
+
+    response = async_client.post(
+        'v1/wallet/transfer',
+        json={
+            'from_wallet_id': FROM_WALLET_ID,
+            'to_wallet_id': TO_WALLET_ID,
+            'amount': 2,
+        },
+        headers=HEADERS,
+    )
+    assert response.status_code == 410
+    assert db.query(Wallet.amount).filter(
+        Wallet.wallet_id == FROM_WALLET_ID,
+    ).scalar() == 10
+
+
+def test_wallet_async_admission(
+        admission_enabled: None,
+        async_client: TestClient,
+        db: Session,
+) -> None:
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=1))
+    db.commit()
+
+    def donate():
+        return async_client.post(
+            'v1/wallet/donate',
+            json={'wallet_id': FROM_WALLET_ID, 'amount': 2},
+            headers={'Idempotency-Key': str(uuid.uuid4())},
+        )
+
+    # another donation to the wallet is in flight
+    admission.wallets[uuid.UUID(FROM_WALLET_ID)] = 1
+    response = donate()
+    assert response.status_code == 429
+    assert response.json() == {'detail': 'wallet is busy, try again later'}
+
+    admission.wallets.clear()
+    response = donate()
+    assert response.status_code == 200
+    assert response.json()['amount'] == 3
@@ -0,0 +1,89 @@
+import uuid
+from decimal import Decimal
+
+import pytest
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.api.endpoints import wallets
+from app.db.core_helper import CoreDBHelper
+from app.db.idempotency import recent_keys
+from app.models import Transaction
+from app.models import Wallet
+from app.models import WalletSlot
+
+FROM_WALLET_ID = '11111111-1111-1111-1111-111111111111'
+TO_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+
+
+@pytest.fixture(autouse=True)
+def core_helper(mocker) -> None:
+    mocker.patch.object(wallets, 'helper', CoreDBHelper)
+
+
+def test_wallet_create(client: TestClient, db: Session) -> None:
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+    response = client.post('v1/wallet/create', headers=headers)
+    assert response.status_code == 200
+    wallet = response.json()
+    assert wallet['amount'] == 0
+
+    # the same key gets the same wallet
+    response = client.post('v1/wallet/create', headers=headers)
+    assert response.json() == wallet
+    assert db.query(Wallet).count() == 1
+
+
+def test_wallet_get(client: TestClient, db: Session) -> None:
+    response = client.post('v1/wallet/get', json={'wallet_id': TO_WALLET_ID})
+    assert response.status_code == 404
+    assert response.json() == {'detail': 'Wallet is not found'}
+
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=Decimal('1.5'), slots=2))
+    db.commit()
+    db.add(WalletSlot(wallet_id=TO_WALLET_ID, slot=0, amount=2))
+    db.commit()
+
+    response = client.post('v1/wallet/get', json={'wallet_id': TO_WALLET_ID})
+    assert response.status_code == 200
+    assert response.json() == {'wallet_id': TO_WALLET_ID, 'amount': 3.5}
+
+
+def test_wallet_donate_and_transfer(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=0))
+    db.commit()
+
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+    request = {'wallet_id': FROM_WALLET_ID, 'amount': 2.5}
+    response = client.post('v1/wallet/donate', json=request, headers=headers)
+    assert response.json() == {'wallet_id': FROM_WALLET_ID, 'amount': 12.5}
+    recent_keys.clear()
+    response = client.post('v1/wallet/donate', json=request, headers=headers)
+    assert response.json() == {'wallet_id': FROM_WALLET_ID, 'amount': 12.5}
+
+    headers = {'Idempotency-Key': str(uuid.uuid4())}
+    request = {
+        'from_wallet_id': FROM_WALLET_ID,
+        'to_wallet_id': TO_WALLET_ID,
+        'amount': 20,
+    }
+    response = client.post('v1/wallet/transfer', json=request, headers=headers)
+    assert response.status_code == 400
+    assert response.json() == {'detail': 'not enough money'}
+
+    request['amount'] = 5
+    response = client.post('v1/wallet/transfer', json=request, headers=headers)
+    assert response.json() == {'wallet_id': FROM_WALLET_ID, 'amount': 7.5}
+
+    # a replay is answered from the ledger
+    recent_keys.clear()
+    response = client.post('v1/wallet/transfer', json=request, headers=headers)
+    assert response.json() == {'wallet_id': FROM_WALLET_ID, 'amount': 7.5}
+    assert db.query(Transaction).count() == 2
+
+    db_wallets = dict(db.query(Wallet.wallet_id, Wallet.amount).all())
+    assert db_wallets == {
+        uuid.UUID(FROM_WALLET_ID): Decimal('7.5'),
+        uuid.UUID(TO_WALLET_ID): Decimal('5'),
+    }
@@ -53,3 +53,53 @@ def test_wallet_create_error(client: TestClient, db: Session, mocker) -> None:
             }
         ]
     }
+
+
+def test_wallet_create_batch(client: TestClient, db: Session) -> None:
+    # one key is used already, one is repeated in the request
+    existed_key = str(uuid.uuid4())
+    response = client.post(
+        'v1/wallet/create', headers={'Idempotency-Key': existed_key},
+    )
+    existed_wallet = response.json()
+    keys = [str(uuid.uuid4()) for _ in range(3)]
+    request = {'idempotency_keys': [keys[0], existed_key, keys[1], keys[0]]}
+
+    response = client.post('v1/wallet/create/batch', json=request)
+    assert response.status_code == 200
+    wallets = response.json()['wallets']
+    assert len(wallets) == 4
+    assert wallets[1] == existed_wallet
+    assert wallets[0] == wallets[3]
+    assert len({wallet['wallet_id'] for wallet in wallets}) == 3
+    assert all(wallet['amount'] == 0 for wallet in wallets)
+    assert db.query(Wallet).count() == 3
+
+    # check idempotency, a replay writes nothing
+    db_wallets = {wallet.wallet_id: wallet for wallet in db.query(Wallet)}
+    xmins = dict(
+        db.execute('SELECT wallet_id, xmin::text FROM wallet').fetchall()
+    )
+    db.close()
+    request['idempotency_keys'].append(keys[2])
+    response = client.post('v1/wallet/create/batch', json=request)
+    assert response.json()['wallets'][:4] == wallets
+    new_xmins = dict(
+        db.execute('SELECT wallet_id, xmin::text FROM wallet').fetchall()
+    )
+    assert {i: new_xmins[i] for i in xmins} == xmins
+    assert db.query(Wallet).count() == 4
+
+    # the keys of the batch work with the single endpoint too
+    response = client.post(
+        'v1/wallet/create', headers={'Idempotency-Key': keys[1]},
+    )
+    assert response.json() == wallets[2]
+    assert uuid.UUID(wallets[2]['wallet_id']) in db_wallets
+
+
+def test_wallet_create_batch_error(client: TestClient, db: Session) -> None:
+    response = client.post(
+        'v1/wallet/create/batch', json={'idempotency_keys': []},
+    )
+    assert response.status_code == 422
@@ -1,12 +1,22 @@
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
+import pytest
+from fastapi import HTTPException
 from sqlalchemy.orm import Session
 from fastapi.testclient import TestClient
 
+from app.core import stats
+from app.core.config import settings
+from app.db.donations import donation_batcher
+from app.db.helper import DBHelper
+from app.db.idempotency import recent_keys
+from app.db.session import DBSessionMaker
 from app.models import Wallet
 from app.models import Transaction
+from app.schemas import WalletDonateRequest
 
 WALLET_ID = '11111111-1111-1111-1111-111111111111'
 IDEMPOTENCY_KEY = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
@@ -119,3 +129,117 @@ def test_wallet_donate_invalid_amount_precision(client: TestClient) -> None:
             }
         ]
     }
+
+
+def test_wallet_donate_single_statement(
+        client: TestClient,
+        db: Session,
+        mocker,
+) -> None:
+    mocker.patch.object(settings, 'WALLET_SINGLE_STATEMENT', True)
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+
+    request = {'wallet_id': WALLET_ID, 'amount': 2.5}
+    expected = {'wallet_id': WALLET_ID, 'amount': 3.5}
+
+    response = client.post('v1/wallet/donate', json=request, headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json() == expected
+
+    # check idempotency
+    response = client.post('v1/wallet/donate', json=request, headers=HEADERS)
+    assert response.json() == expected
+
+    db_wallet = db.query(Wallet).filter(Wallet.wallet_id == WALLET_ID).first()
+    assert db_wallet.amount == Decimal('3.5')
+    assert db_wallet.updated_at
+    assert db.query(Transaction).count() == 1
+
+    response = client.post(
+        'v1/wallet/donate',
+        json={'wallet_id': str(uuid.uuid4()), 'amount': 1},
+        headers={'Idempotency-Key': str(uuid.uuid4())},
+    )
+    assert response.status_code == 404
+    assert response.json() == {'detail': 'Wallet is not found'}
+
+
+def test_wallet_donate_replay(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+    request = {'wallet_id': WALLET_ID, 'amount': 1}
+    expected = {'wallet_id': WALLET_ID, 'amount': 2}
+
+    response = client.post('v1/wallet/donate', json=request, headers=HEADERS)
+    assert response.json() == expected
+    idempotency_stats = stats.snapshot()['idempotency']
+
+    # the key is found before the wallet is locked
+    recent_keys.clear()
+    response = client.post('v1/wallet/donate', json=request, headers=HEADERS)
+    assert response.json() == expected
+
+    # and then answered from memory
+    response = client.post('v1/wallet/donate', json=request, headers=HEADERS)
+    assert response.json() == expected
+
+    assert stats.snapshot()['idempotency'] == {
+        **idempotency_stats,
+        'lookup_hits': idempotency_stats.get('lookup_hits', 0) + 1,
+        'cache_hits': idempotency_stats.get('cache_hits', 0) + 1,
+    }
+
+
+def test_wallet_donate_batched(db: Session, monkeypatch) -> None:
+    monkeypatch.setattr(settings, 'DONATION_BATCH_ENABLED', True)
+    monkeypatch.setattr(donation_batcher, 'window', 0.2)
+    monkeypatch.setattr(donation_batcher, 'max_size', 5)
+
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.commit()
+
+    # the first donation is already done, its retry joins the batch
+    request = WalletDonateRequest(wallet_id=WALLET_ID, amount=1)
+    DBHelper.wallet_donate(db, uuid.UUID(IDEMPOTENCY_KEY), request)
+    db.close()
+    recent_keys.clear()
+    batches = stats.snapshot()['donations'].get('batches', 0)
+
+    keys = [uuid.UUID(IDEMPOTENCY_KEY)] + [uuid.uuid4() for _ in range(4)]
+
+    def _donate(key):
+        session = DBSessionMaker()
+        try:
+            return DBHelper.wallet_donate(session, key, request)
+        finally:
+            session.close()
+
+    with ThreadPoolExecutor(len(keys)) as executor:
+        responses = list(executor.map(_donate, keys))
+
+    assert stats.snapshot()['donations']['batches'] == batches + 1
+    assert responses[0].amount == 1
+    assert sorted(response.amount for response in responses[1:]) == [
+        2, 3, 4, 5,
+    ]
+
+    db_wallet = db.query(Wallet).filter(Wallet.wallet_id == WALLET_ID).first()
+    assert db_wallet.amount == 5
+    for key, response in zip(keys, responses):
+        db_transaction = (
+            db.query(Transaction)
+            .filter(Transaction.idempotency_key == key)
+            .first()
+        )
+        assert db_transaction.to_wallet_amount == response.amount
+
+
+def test_wallet_donate_batched_not_found(db: Session, monkeypatch) -> None:
+    monkeypatch.setattr(settings, 'DONATION_BATCH_ENABLED', True)
+
+    request = WalletDonateRequest(wallet_id=WALLET_ID, amount=1)
+    with pytest.raises(HTTPException) as e:
+        DBHelper.wallet_donate(db, uuid.uuid4(), request)
+    assert e.value.status_code == 404
+    assert e.value.detail == 'Wallet is not found'
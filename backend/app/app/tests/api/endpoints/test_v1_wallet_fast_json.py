@@ -0,0 +1,111 @@
+import uuid
+from decimal import Decimal
+
+import pytest
+from fastapi import APIRouter
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from app.api.endpoints import wallets
+from app.core.config import settings
+from app.core.metrics import MeasuredRoute
+from app.core.responses import FastJSONRoute
+from app.core.responses import encode_json
+from app.models import Wallet
+from app.schemas import WalletResponse
+
+WALLET_ID = '11111111-1111-1111-1111-111111111111'
+
+
+def wallets_app(route_class) -> FastAPI:
+    router = APIRouter()
+    for route in wallets.router.routes:
+        router.add_api_route(
+            route.path,
+            route.endpoint,
+            response_model=route.response_model,
+            methods=route.methods,
+            name=route.name,
+            route_class_override=route_class,
+        )
+    app = FastAPI()
+    app.include_router(router)
+    return app
+
+
+@pytest.fixture(scope='module')
+def fast_client() -> TestClient:
+    return TestClient(wallets_app(FastJSONRoute))
+
+
+def test_openapi_is_the_same() -> None:
+    assert (
+        wallets_app(FastJSONRoute).openapi()
+        == wallets_app(MeasuredRoute).openapi()
+    )
+
+
+def test_encode_json() -> None:
+    response = WalletResponse.construct(
+        wallet_id=uuid.UUID(WALLET_ID),
+        amount=Decimal('12345678901234567890.01'),
+    )
+    assert encode_json({'wallets': [response], 'cursor': None}) == (
+        '{"wallets":[{"wallet_id":"%s","amount":12345678901234567890.01}],'
+        '"cursor":null}' % WALLET_ID
+    )
+
+
+def test_wallet_get(fast_client: TestClient, db: Session) -> None:
+    response = fast_client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.status_code == 404
+    assert response.json() == {'detail': 'Wallet is not found'}
+
+    db.add(Wallet(wallet_id=WALLET_ID, amount=Decimal('9007199254740993.01')))
+    db.commit()
+
+    response = fast_client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    # a float would have lost the cents
+    assert response.text == (
+        '{"wallet_id":"%s","amount":9007199254740993.01}' % WALLET_ID
+    )
+
+
+def test_wallet_donate_keeps_cookies(
+        fast_client: TestClient,
+        db: Session,
+        mocker,
+) -> None:
+    mocker.patch.object(settings, 'READ_YOUR_WRITES_SECONDS', 10)
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+
+    response = fast_client.post(
+        'v1/wallet/donate',
+        json={'wallet_id': WALLET_ID, 'amount': '0.5'},
+        headers={'Idempotency-Key': str(uuid.uuid4())},
+    )
+    assert response.status_code == 200
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1.5}
+    assert 'primary_until' in response.cookies
+    fast_client.cookies.clear()
+
+
+def test_responses_of_endpoints() -> None:
+    router = APIRouter(route_class=FastJSONRoute)
+
+    @router.get('/text')
+    def text():
+        return PlainTextResponse('1.10')
+
+    app = FastAPI()
+    app.include_router(router)
+
+    # responses made by the endpoints themselves are sent as they are
+    response = TestClient(app).get('/text')
+    assert response.headers['content-type'].startswith('text/plain')
+    assert response.text == '1.10'
@@ -1,6 +1,15 @@
+import itertools
+import uuid
+
+from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker
 from fastapi.testclient import TestClient
 
+from app.core import stats
+from app.core.config import settings
+from app.db import session
+from app.db.cache import wallet_cache
 from app.models import Wallet
 
 WALLET_ID = '11111111-1111-1111-1111-111111111111'
@@ -24,3 +33,85 @@ def test_wallet_get_not_found(client: TestClient) -> None:
     response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
     assert response.status_code == 404
     assert response.json() == {'detail': 'Wallet is not found'}
+
+
+def test_wallet_get_cache(client: TestClient, db: Session, mocker) -> None:
+    mocker.patch.object(settings, 'WALLET_CACHE_ENABLED', True)
+    wallet_cache.clear()
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+    hits = stats.snapshot()['wallet_cache'].get('hits', 0)
+
+    response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1}
+
+    # a write of another worker is not seen until the entry expires
+    db.query(Wallet).update({Wallet.amount: 2})
+    db.commit()
+    response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1}
+    assert stats.snapshot()['wallet_cache']['hits'] == hits + 1
+
+    # writes of this process go through the cache
+    response = client.post(
+        'v1/wallet/donate',
+        json={'wallet_id': WALLET_ID, 'amount': 3},
+        headers={'Idempotency-Key': str(uuid.uuid4())},
+    )
+    response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 5}
+
+    # expired entries are read again
+    wallet_cache.clear()
+    mocker.patch.object(wallet_cache, 'ttl', 0)
+    client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    db.query(Wallet).update({Wallet.amount: 7})
+    db.commit()
+    response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 7}
+
+
+def test_wallet_get_replicas(client: TestClient, db: Session, mocker) -> None:
+    unreachable_replica = sessionmaker(
+        bind=create_engine('postgresql://postgres@localhost:1/paymarket'),
+    )
+    replica = sessionmaker(bind=session.engine)
+    mocker.patch.object(
+        session, 'ReplicaSessionMakers', [unreachable_replica, replica],
+    )
+    mocker.patch.object(session, 'replica_counter', itertools.count())
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+    replica_stats = stats.snapshot()['replicas']
+
+    for _ in range(2):
+        response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+        assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1}
+
+    assert stats.snapshot()['replicas']['reads'] == (
+        replica_stats.get('reads', 0) + 2
+    )
+    assert stats.snapshot()['replicas']['errors'] == (
+        replica_stats.get('errors', 0) + 2
+    )
+
+
+def test_wallet_get_read_your_writes(
+        client: TestClient,
+        db: Session,
+        mocker,
+) -> None:
+    mocker.patch.object(settings, 'READ_YOUR_WRITES_SECONDS', 10)
+    replica = mocker.Mock(side_effect=AssertionError('replica is used'))
+    mocker.patch.object(session, 'ReplicaSessionMakers', [replica])
+    db.add(Wallet(wallet_id=WALLET_ID, amount=1))
+    db.commit()
+
+    client.post(
+        'v1/wallet/donate',
+        json={'wallet_id': WALLET_ID, 'amount': 1},
+        headers={'Idempotency-Key': str(uuid.uuid4())},
+    )
+    response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 2}
+    client.cookies.clear()
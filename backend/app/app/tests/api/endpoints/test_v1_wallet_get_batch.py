@@ -0,0 +1,75 @@
+from decimal import Decimal
+
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.models import Wallet
+from app.models import WalletSlot
+
+FIRST_WALLET_ID = '11111111-1111-1111-1111-111111111111'
+SECOND_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+MISSING_WALLET_ID = '33333333-3333-3333-3333-333333333333'
+
+
+def test_wallet_get_batch(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=FIRST_WALLET_ID, amount=Decimal('1.5')))
+    db.add(Wallet(wallet_id=SECOND_WALLET_ID, amount=2, slots=2))
+    db.add(WalletSlot(wallet_id=SECOND_WALLET_ID, slot=0, amount=3))
+    db.commit()
+
+    response = client.post(
+        'v1/wallet/get/batch',
+        json={
+            'wallet_ids': [
+                SECOND_WALLET_ID,
+                MISSING_WALLET_ID,
+                FIRST_WALLET_ID,
+                SECOND_WALLET_ID,
+            ],
+        },
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        'results': [
+            {
+                'wallet_id': SECOND_WALLET_ID,
+                'status_code': 200,
+                'detail': None,
+                'amount': 5,
+            },
+            {
+                'wallet_id': MISSING_WALLET_ID,
+                'status_code': 404,
+                'detail': 'Wallet is not found',
+                'amount': None,
+            },
+            {
+                'wallet_id': FIRST_WALLET_ID,
+                'status_code': 200,
+                'detail': None,
+                'amount': 1.5,
+            },
+            {
+                'wallet_id': SECOND_WALLET_ID,
+                'status_code': 200,
+                'detail': None,
+                'amount': 5,
+            },
+        ]
+    }
+
+
+def test_wallet_get_batch_limit(client: TestClient, mocker) -> None:
+    response = client.post('v1/wallet/get/batch', json={'wallet_ids': []})
+    assert response.status_code == 422
+
+    response = client.post(
+        'v1/wallet/get/batch',
+        json={
+            'wallet_ids': [MISSING_WALLET_ID] * (
+                settings.WALLET_GET_BATCH_MAX_SIZE + 1
+            ),
+        },
+    )
+    assert response.status_code == 422
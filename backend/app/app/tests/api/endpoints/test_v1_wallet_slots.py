@@ -0,0 +1,176 @@
+import uuid
+
+from decimal import Decimal
+
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.db.cache import wallet_cache
+from app.models import Transaction
+from app.models import Wallet
+from app.models import WalletSlot
+
+WALLET_ID = '11111111-1111-1111-1111-111111111111'
+TO_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+
+
+def _get_headers():
+    return {'Idempotency-Key': uuid.uuid4().hex}
+
+
+def test_wallet_slots(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=TO_WALLET_ID))
+    db.commit()
+
+    request = {'wallet_id': WALLET_ID, 'slots': 4}
+    response = client.post('v1/wallet/slots', json=request)
+    assert response.status_code == 200
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 10}
+    assert db.query(WalletSlot).count() == 4
+
+    # donations go to the slots, the wallet row is not touched
+    for i in range(1, 6):
+        request = {'wallet_id': WALLET_ID, 'amount': 1}
+        response = client.post(
+            'v1/wallet/donate', json=request, headers=_get_headers(),
+        )
+        assert response.status_code == 200
+        assert response.json() == {'wallet_id': WALLET_ID, 'amount': 10 + i}
+
+    db_wallet = db.query(Wallet).filter(Wallet.wallet_id == WALLET_ID).first()
+    assert db_wallet.amount == 10
+    assert db.query(Transaction).count() == 5
+
+    response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 15}
+
+    # a transfer folds the slots back before the funds check
+    request = {
+        'from_wallet_id': WALLET_ID,
+        'to_wallet_id': TO_WALLET_ID,
+        'amount': 14,
+    }
+    response = client.post(
+        'v1/wallet/transfer', json=request, headers=_get_headers(),
+    )
+    assert response.status_code == 200
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1}
+
+    db.expire_all()
+    db_wallet = db.query(Wallet).filter(Wallet.wallet_id == WALLET_ID).first()
+    assert db_wallet.amount == 1
+    assert all(not slot.amount for slot in db.query(WalletSlot))
+
+    # cool the wallet down
+    request = {'wallet_id': WALLET_ID, 'slots': 0}
+    response = client.post('v1/wallet/slots', json=request)
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1}
+    assert db.query(WalletSlot).count() == 0
+
+    request = {'wallet_id': WALLET_ID, 'amount': 1}
+    response = client.post(
+        'v1/wallet/donate', json=request, headers=_get_headers(),
+    )
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 2}
+
+
+def test_wallet_slots_transfer_modes(
+        client: TestClient, db: Session, monkeypatch,
+) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.add(Wallet(wallet_id=TO_WALLET_ID))
+    db.commit()
+    client.post('v1/wallet/slots', json={'wallet_id': WALLET_ID, 'slots': 2})
+
+    def _donate(amount):
+        request = {'wallet_id': WALLET_ID, 'amount': amount}
+        client.post('v1/wallet/donate', json=request, headers=_get_headers())
+
+    def _transfer(amount):
+        request = {
+            'from_wallet_id': WALLET_ID,
+            'to_wallet_id': TO_WALLET_ID,
+            'amount': amount,
+        }
+        return client.post(
+            'v1/wallet/transfer', json=request, headers=_get_headers(),
+        )
+
+    monkeypatch.setattr(settings, 'WALLET_SINGLE_STATEMENT', True)
+    _donate(3)
+    response = _transfer(4)
+    assert response.status_code == 400
+    assert response.json() == {'detail': 'not enough money'}
+    response = _transfer(2)
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1}
+
+    _donate(5)
+    request = {
+        'transfers': [
+            {
+                'idempotency_key': str(uuid.uuid4()),
+                'from_wallet_id': WALLET_ID,
+                'to_wallet_id': TO_WALLET_ID,
+                'amount': 6,
+            },
+        ],
+    }
+    response = client.post('v1/wallet/transfer/batch', json=request)
+    assert response.json()['results'][0]['amount'] == 0
+
+    response = client.post('v1/wallet/get', json={'wallet_id': WALLET_ID})
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 0}
+    total = (
+        sum(wallet.amount for wallet in db.query(Wallet))
+        + sum(slot.amount for slot in db.query(WalletSlot))
+    )
+    assert total == Decimal(8)
+
+
+def test_wallet_slots_transfer_to_hot_wallet(
+        client: TestClient, db: Session, mocker,
+) -> None:
+    mocker.patch.object(settings, 'WALLET_CACHE_ENABLED', True)
+    wallet_cache.clear()
+    db.add(Wallet(wallet_id=WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=TO_WALLET_ID))
+    db.commit()
+    client.post('v1/wallet/slots', json={'wallet_id': TO_WALLET_ID, 'slots': 2})
+    request = {'wallet_id': TO_WALLET_ID, 'amount': 3}
+    client.post('v1/wallet/donate', json=request, headers=_get_headers())
+
+    # the recipient's balance includes its slots, in either mode
+    for single_statement, amount, balance in ((False, 4, 7), (True, 1, 8)):
+        mocker.patch.object(
+            settings, 'WALLET_SINGLE_STATEMENT', single_statement,
+        )
+        request = {
+            'from_wallet_id': WALLET_ID,
+            'to_wallet_id': TO_WALLET_ID,
+            'amount': amount,
+        }
+        response = client.post(
+            'v1/wallet/transfer', json=request, headers=_get_headers(),
+        )
+        assert response.status_code == 200
+
+        response = client.post(
+            'v1/wallet/get', json={'wallet_id': TO_WALLET_ID},
+        )
+        assert response.json() == {'wallet_id': TO_WALLET_ID, 'amount': balance}
+        assert db.query(Transaction.to_wallet_amount).order_by(
+            Transaction.created_at.desc(),
+        ).first() == (Decimal(balance),)
+
+
+def test_wallet_slots_validation(client: TestClient, db: Session) -> None:
+    request = {'wallet_id': WALLET_ID, 'slots': settings.WALLET_MAX_SLOTS + 1}
+    response = client.post('v1/wallet/slots', json=request)
+    assert response.status_code == 422
+
+    request = {'wallet_id': WALLET_ID, 'slots': 1}
+    response = client.post('v1/wallet/slots', json=request)
+    assert response.status_code == 404
+    assert response.json() == {'detail': 'Wallet is not found'}
@@ -0,0 +1,118 @@
+import datetime
+import json
+import uuid
+
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.db.helper import DBHelper
+from app.models import Transaction
+from app.models import Wallet
+
+WALLET_ID = '11111111-1111-1111-1111-111111111111'
+OTHER_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+
+
+def _save_history(db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.add(Wallet(wallet_id=OTHER_WALLET_ID))
+    db.commit()
+
+    created_at = datetime.datetime.utcnow().replace(microsecond=0)
+    for i in range(5):
+        db.add(Transaction(
+            idempotency_key=uuid.uuid4(),
+            amount=i + 1,
+            to_wallet_id=WALLET_ID,
+            to_wallet_amount=10 + i,
+            created_at=created_at,
+        ))
+        db.add(Transaction(
+            idempotency_key=uuid.uuid4(),
+            amount=1,
+            from_wallet_id=WALLET_ID,
+            from_wallet_amount=i,
+            to_wallet_id=OTHER_WALLET_ID,
+            to_wallet_amount=i + 1,
+            # the same created_at for some rows, id breaks the tie
+            created_at=created_at + datetime.timedelta(seconds=i // 2),
+        ))
+    db.commit()
+
+
+def test_wallet_transactions(client: TestClient, db: Session) -> None:
+    _save_history(db)
+
+    transactions = []
+    request = {'wallet_id': WALLET_ID, 'limit': 3}
+    while True:
+        response = client.post('v1/wallet/transactions', json=request)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page['transactions']) <= 3
+        transactions += page['transactions']
+        if not page['next_cursor']:
+            break
+        request['cursor'] = page['next_cursor']
+
+    db_transactions = (
+        db.query(Transaction)
+        .order_by(Transaction.created_at.desc(), Transaction.id.desc())
+        .all()
+    )
+    assert len(transactions) == 10
+    assert [t['idempotency_key'] for t in transactions] == [
+        str(t.idempotency_key) for t in db_transactions
+    ]
+    for t, db_t in zip(transactions, db_transactions):
+        if db_t.from_wallet_id:
+            assert t['balance'] == db_t.from_wallet_amount
+        else:
+            assert t['balance'] == db_t.to_wallet_amount
+
+    # the other side sees only its transfers
+    request = {'wallet_id': OTHER_WALLET_ID}
+    response = client.post('v1/wallet/transactions', json=request)
+    page = response.json()
+    assert [t['balance'] for t in page['transactions']] == [5, 4, 3, 2, 1]
+    assert page['next_cursor'] is None
+
+
+def test_wallet_transactions_errors(client: TestClient, db: Session) -> None:
+    request = {'wallet_id': WALLET_ID}
+    response = client.post('v1/wallet/transactions', json=request)
+    assert response.status_code == 404
+    assert response.json() == {'detail': 'Wallet is not found'}
+
+    response = client.post('v1/wallet/transactions/export', json=request)
+    assert response.status_code == 404
+
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.commit()
+
+    request = {'wallet_id': WALLET_ID, 'cursor': 'not-a-cursor'}
+    response = client.post('v1/wallet/transactions', json=request)
+    assert response.status_code == 400
+    assert response.json() == {'detail': 'cursor is not valid'}
+
+    request = {'wallet_id': WALLET_ID, 'limit': 0}
+    response = client.post('v1/wallet/transactions', json=request)
+    assert response.status_code == 422
+
+
+def test_wallet_transactions_export(client: TestClient, db: Session) -> None:
+    _save_history(db)
+
+    # what the endpoint streams line by line
+    exported = [
+        json.loads(transaction.json())
+        for transaction in DBHelper.wallet_transactions_export(
+            db, uuid.UUID(WALLET_ID),
+        )
+    ]
+
+    response = client.post(
+        'v1/wallet/transactions', json={'wallet_id': WALLET_ID, 'limit': 100},
+    )
+    assert len(exported) == 10
+    assert exported == response.json()['transactions']
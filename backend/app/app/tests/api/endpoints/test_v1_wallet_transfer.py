@@ -6,6 +6,10 @@ from typing import Any
 from sqlalchemy.orm import Session
 from fastapi.testclient import TestClient
 
+from app.core import stats
+from app.core.config import TransferLocking
+from app.core.config import settings
+from app.db.idempotency import recent_keys
 from app.models import Wallet
 from app.models import Transaction
 
@@ -106,3 +110,106 @@ def test_wallet_transfer_self(client: TestClient, db: Session) -> None:
     response = client.post('v1/wallet/transfer', json=request, headers=HEADERS)
     assert response.status_code == 400
     assert response.json() == {'detail': 'self-transfer is not possible'}
+
+
+def test_wallet_transfer_pessimistic(
+        client: TestClient,
+        db: Session,
+        mocker,
+) -> None:
+    mocker.patch.object(
+        settings, 'TRANSFER_LOCKING', TransferLocking.pessimistic,
+    )
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=5))
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=0))
+    db.commit()
+    commits = stats.snapshot()['transfer'].get('pessimistic_commits', 0)
+
+    request = {
+        'from_wallet_id': FROM_WALLET_ID,
+        'to_wallet_id': TO_WALLET_ID,
+        'amount': 2,
+    }
+    response = client.post('v1/wallet/transfer', json=request, headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json() == {'wallet_id': FROM_WALLET_ID, 'amount': 3}
+
+    check_db_wallet(db, {'wallet_id': FROM_WALLET_ID, 'amount': 3})
+    check_db_wallet(db, {'wallet_id': TO_WALLET_ID, 'amount': 2})
+    assert stats.snapshot()['transfer']['pessimistic_commits'] == commits + 1
+
+
+def test_wallet_transfer_single_statement(
+        client: TestClient,
+        db: Session,
+        mocker,
+) -> None:
+    mocker.patch.object(settings, 'WALLET_SINGLE_STATEMENT', True)
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=5))
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=1))
+    db.commit()
+
+    request = {
+        'from_wallet_id': FROM_WALLET_ID,
+        'to_wallet_id': TO_WALLET_ID,
+        'amount': 2,
+    }
+    expected = {'wallet_id': FROM_WALLET_ID, 'amount': 3}
+
+    response = client.post('v1/wallet/transfer', json=request, headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json() == expected
+
+    # check idempotency
+    response = client.post('v1/wallet/transfer', json=request, headers=HEADERS)
+    assert response.json() == expected
+    recent_keys.clear()
+    response = client.post('v1/wallet/transfer', json=request, headers=HEADERS)
+    assert response.json() == expected
+
+    check_db_wallet(db, {'wallet_id': FROM_WALLET_ID, 'amount': 3})
+    check_db_wallet(db, {'wallet_id': TO_WALLET_ID, 'amount': 3})
+
+    db_transaction = (
+        db.query(Transaction)
+        .filter(Transaction.idempotency_key == IDEMPOTENCY_KEY)
+        .first()
+    )
+    assert db_transaction.from_wallet_amount == Decimal('3')
+    assert db_transaction.to_wallet_amount == Decimal('3')
+
+
+def test_wallet_transfer_single_statement_errors(
+        client: TestClient,
+        db: Session,
+        mocker,
+) -> None:
+    mocker.patch.object(settings, 'WALLET_SINGLE_STATEMENT', True)
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=5))
+    db.commit()
+
+    def _transfer(from_wallet_id, to_wallet_id, amount):
+        return client.post(
+            'v1/wallet/transfer',
+            json={
+                'from_wallet_id': from_wallet_id,
+                'to_wallet_id': to_wallet_id,
+                'amount': amount,
+            },
+            headers=HEADERS,
+        )
+
+    response = _transfer(TO_WALLET_ID, FROM_WALLET_ID, 1)
+    assert response.status_code == 404
+    assert response.json() == {'detail': 'from_wallet_id is not found'}
+
+    response = _transfer(FROM_WALLET_ID, TO_WALLET_ID, 7)
+    assert response.status_code == 400
+    assert response.json() == {'detail': 'not enough money'}
+
+    response = _transfer(FROM_WALLET_ID, TO_WALLET_ID, 1)
+    assert response.status_code == 404
+    assert response.json() == {'detail': 'db_to_wallet is not found'}
+
+    check_db_wallet(db, {'wallet_id': FROM_WALLET_ID, 'amount': 5}, False)
+    assert not db.query(Transaction).count()
@@ -0,0 +1,139 @@
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.db import transfer_queue
+from app.db.session import DBSessionMaker
+from app.models import Transaction
+from app.models import Wallet
+
+FIRST_KEY = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+SECOND_KEY = 'bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb'
+THIRD_KEY = 'cccccccc-cccc-cccc-cccc-cccccccccccc'
+FIRST_WALLET_ID = '11111111-1111-1111-1111-111111111111'
+SECOND_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+
+
+def _transfer(client: TestClient, key: str, amount: str) -> dict:
+    response = client.post(
+        'v1/wallet/transfer/async',
+        json={
+            'from_wallet_id': FIRST_WALLET_ID,
+            'to_wallet_id': SECOND_WALLET_ID,
+            'amount': amount,
+        },
+        headers={'Idempotency-Key': key},
+    )
+    assert response.status_code == 202
+    assert response.headers['Location'] == response.json()['status_url']
+    return response.json()
+
+
+def test_wallet_transfer_async(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=FIRST_WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=SECOND_WALLET_ID, amount=0))
+    db.commit()
+
+    accepted = _transfer(client, FIRST_KEY, '7.5')
+    assert accepted == {
+        'idempotency_key': FIRST_KEY,
+        'status_url': '/v1/wallet/transfer/status/' + FIRST_KEY,
+    }
+    _transfer(client, SECOND_KEY, '5')
+    # a retry keeps the first request
+    _transfer(client, FIRST_KEY, '1')
+
+    response = client.get(accepted['status_url'])
+    assert response.status_code == 200
+    assert response.json()['status'] == 'pending'
+    assert db.query(Transaction).count() == 0
+
+    assert transfer_queue.process(db, batch_size=10) == 2
+    assert transfer_queue.process(db, batch_size=10) == 0
+
+    response = client.post(
+        'v1/wallet/transfer/status',
+        json={'idempotency_keys': [SECOND_KEY, THIRD_KEY, FIRST_KEY]},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        'results': [
+            {
+                'idempotency_key': SECOND_KEY,
+                'status': 'done',
+                'status_code': 400,
+                'detail': 'not enough money',
+                'wallet_id': None,
+                'amount': None,
+            },
+            {
+                'idempotency_key': THIRD_KEY,
+                'status': 'unknown',
+                'status_code': None,
+                'detail': None,
+                'wallet_id': None,
+                'amount': None,
+            },
+            {
+                'idempotency_key': FIRST_KEY,
+                'status': 'done',
+                'status_code': 200,
+                'detail': None,
+                'wallet_id': FIRST_WALLET_ID,
+                'amount': 2.5,
+            },
+        ]
+    }
+    assert sorted(
+        wallet.amount for wallet in db.query(Wallet)
+    ) == [Decimal('2.5'), Decimal('7.5')]
+
+    response = client.get('/v1/wallet/transfer/status/' + THIRD_KEY)
+    assert response.status_code == 404
+
+
+def test_wallet_transfer_async_skips_claimed(
+        client: TestClient,
+        db: Session,
+) -> None:
+    db.add(Wallet(wallet_id=FIRST_WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=SECOND_WALLET_ID, amount=0))
+    db.commit()
+    _transfer(client, FIRST_KEY, '1')
+    _transfer(client, SECOND_KEY, '2')
+
+    # another worker is applying the first one
+    other_db = DBSessionMaker()
+    try:
+        other_db.execute(
+            text(
+                'SELECT 1 FROM transferrequest'
+                ' WHERE idempotency_key = :key FOR UPDATE'
+            ),
+            dict(key=FIRST_KEY),
+        )
+        assert transfer_queue.process(db, batch_size=10) == 1
+    finally:
+        other_db.rollback()
+        other_db.close()
+
+    statuses = transfer_queue.statuses(
+        db, [uuid.UUID(FIRST_KEY), uuid.UUID(SECOND_KEY)],
+    )
+    assert [status.status for status in statuses] == ['pending', 'done']
+
+
+def test_wallet_transfer_async_self_transfer(client: TestClient) -> None:
+    response = client.post(
+        'v1/wallet/transfer/async',
+        json={
+            'from_wallet_id': FIRST_WALLET_ID,
+            'to_wallet_id': FIRST_WALLET_ID,
+            'amount': '1',
+        },
+        headers={'Idempotency-Key': FIRST_KEY},
+    )
+    assert response.status_code == 400
@@ -0,0 +1,159 @@
+import uuid
+from decimal import Decimal
+
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.models import Wallet
+from app.models import Transaction
+
+FIRST_KEY = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+SECOND_KEY = 'bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb'
+THIRD_KEY = 'cccccccc-cccc-cccc-cccc-cccccccccccc'
+FIRST_WALLET_ID = '11111111-1111-1111-1111-111111111111'
+SECOND_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+MISSING_WALLET_ID = '33333333-3333-3333-3333-333333333333'
+
+
+def test_wallet_transfer_batch(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=FIRST_WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=SECOND_WALLET_ID, amount=1))
+    db.commit()
+
+    request = {
+        'transfers': [
+            {
+                'idempotency_key': FIRST_KEY,
+                'from_wallet_id': FIRST_WALLET_ID,
+                'to_wallet_id': SECOND_WALLET_ID,
+                'amount': 7.5,
+            },
+            {
+                'idempotency_key': SECOND_KEY,
+                'from_wallet_id': FIRST_WALLET_ID,
+                'to_wallet_id': SECOND_WALLET_ID,
+                'amount': 5,
+            },
+            {
+                'idempotency_key': THIRD_KEY,
+                'from_wallet_id': SECOND_WALLET_ID,
+                'to_wallet_id': FIRST_WALLET_ID,
+                'amount': 8.5,
+            },
+            {
+                'idempotency_key': FIRST_KEY,
+                'from_wallet_id': FIRST_WALLET_ID,
+                'to_wallet_id': SECOND_WALLET_ID,
+                'amount': 7.5,
+            },
+        ]
+    }
+    expected = {
+        'results': [
+            {
+                'idempotency_key': FIRST_KEY,
+                'status_code': 200,
+                'detail': None,
+                'wallet_id': FIRST_WALLET_ID,
+                'amount': 2.5,
+            },
+            {
+                'idempotency_key': SECOND_KEY,
+                'status_code': 400,
+                'detail': 'not enough money',
+                'wallet_id': None,
+                'amount': None,
+            },
+            {
+                'idempotency_key': THIRD_KEY,
+                'status_code': 200,
+                'detail': None,
+                'wallet_id': SECOND_WALLET_ID,
+                'amount': 0,
+            },
+            {
+                'idempotency_key': FIRST_KEY,
+                'status_code': 200,
+                'detail': None,
+                'wallet_id': FIRST_WALLET_ID,
+                'amount': 2.5,
+            },
+        ]
+    }
+
+    response = client.post('v1/wallet/transfer/batch', json=request)
+    assert response.status_code == 200
+    assert response.json() == expected
+
+    # check idempotency
+    request['transfers'] = request['transfers'][2:]
+    response = client.post('v1/wallet/transfer/batch', json=request)
+    assert response.json()['results'] == expected['results'][2:]
+
+    # check DB wallets
+    db_first_wallet = (
+        db.query(Wallet).filter(Wallet.wallet_id == FIRST_WALLET_ID).first()
+    )
+    assert db_first_wallet.amount == Decimal('11')
+    assert db_first_wallet.updated_at
+    db_second_wallet = (
+        db.query(Wallet).filter(Wallet.wallet_id == SECOND_WALLET_ID).first()
+    )
+    assert db_second_wallet.amount == Decimal('0')
+
+    # check DB transactions
+    db_transaction = (
+        db.query(Transaction)
+        .filter(Transaction.idempotency_key == THIRD_KEY)
+        .first()
+    )
+    assert db_transaction.from_wallet_id == uuid.UUID(SECOND_WALLET_ID)
+    assert db_transaction.from_wallet_amount == Decimal('0')
+    assert db_transaction.to_wallet_id == uuid.UUID(FIRST_WALLET_ID)
+    assert db_transaction.to_wallet_amount == Decimal('11')
+    assert db.query(Transaction).count() == 2
+
+
+def test_wallet_transfer_batch_errors(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=FIRST_WALLET_ID, amount=10))
+    db.commit()
+
+    request = {
+        'transfers': [
+            {
+                'idempotency_key': FIRST_KEY,
+                'from_wallet_id': FIRST_WALLET_ID,
+                'to_wallet_id': FIRST_WALLET_ID,
+                'amount': 1,
+            },
+            {
+                'idempotency_key': SECOND_KEY,
+                'from_wallet_id': MISSING_WALLET_ID,
+                'to_wallet_id': FIRST_WALLET_ID,
+                'amount': 1,
+            },
+            {
+                'idempotency_key': THIRD_KEY,
+                'from_wallet_id': FIRST_WALLET_ID,
+                'to_wallet_id': MISSING_WALLET_ID,
+                'amount': 1,
+            },
+        ]
+    }
+
+    response = client.post('v1/wallet/transfer/batch', json=request)
+    assert response.status_code == 200
+    assert [
+        (result['status_code'], result['detail'])
+        for result in response.json()['results']
+    ] == [
+        (400, 'self-transfer is not possible'),
+        (404, 'from_wallet_id is not found'),
+        (404, 'db_to_wallet is not found'),
+    ]
+    assert not db.query(Transaction).count()
+
+
+def test_wallet_transfer_batch_empty(client: TestClient) -> None:
+    response = client.post('v1/wallet/transfer/batch', json={'transfers': []})
+    assert response.status_code == 422
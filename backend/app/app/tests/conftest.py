@@ -5,6 +5,9 @@ from fastapi.testclient import TestClient
 
 from app.db.session import DBSessionMaker
 from app.db.base_class import Base
+from app.db.cache import wallet_cache
+from app.db.hot_wallets import hot_wallets
+from app.db.idempotency import recent_keys
 from app.main import app
 
 
@@ -21,6 +24,11 @@ def db() -> Generator:
     )
     session.commit()
 
+    # clear what the process remembers about the DB
+    wallet_cache.clear()
+    recent_keys.clear()
+    hot_wallets.invalidate()
+
 
 @pytest.fixture(scope='module')
 def client() -> Generator:
@@ -0,0 +1,103 @@
+import uuid
+from decimal import Decimal
+from typing import Generator
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.db import amount_migration
+from app.models import Wallet
+from app.schemas import WalletResponse
+from app.schemas import WalletTransferRequest
+
+FROM_WALLET_ID = '11111111-1111-1111-1111-111111111111'
+TO_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+
+
+@pytest.fixture()
+def migration(db: Session) -> Generator:
+    yield
+    # leave the schema as alembic made it
+    if amount_migration.stored_type(db) == 'bigint':
+        amount_migration.revert(db)
+    amount_migration.cleanup(db)
+
+
+def _amounts(db: Session, table: str, columns: str) -> list:
+    return db.execute(text(
+        'SELECT {} FROM {} ORDER BY 1'.format(columns, table)
+    )).fetchall()
+
+
+def test_migrate_amounts(
+        client: TestClient,
+        db: Session,
+        migration: None,
+) -> None:
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=Decimal('10.25')))
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=0))
+    db.commit()
+
+    amount_migration.expand(db)
+    # written after expand, the trigger fills its minor units in
+    response = client.post(
+        'v1/wallet/transfer',
+        json={
+            'from_wallet_id': FROM_WALLET_ID,
+            'to_wallet_id': TO_WALLET_ID,
+            'amount': '0.5',
+        },
+        headers={'Idempotency-Key': str(uuid.uuid4())},
+    )
+    assert response.status_code == 200
+    with pytest.raises(ValueError):
+        amount_migration.switch(db)
+
+    amount_migration.backfill(db, batch_size=1)
+    amount_migration.switch(db)
+    assert amount_migration.stored_type(db) == 'bigint'
+    assert _amounts(db, 'wallet', 'amount, amount_numeric') == [
+        (0 + 50, Decimal('0.50')),
+        (1025 - 50, Decimal('9.75')),
+    ]
+    assert _amounts(
+        db, 'transaction', 'amount, from_wallet_amount, to_wallet_amount',
+    ) == [(50, 975, 50)]
+
+    # the numeric columns are kept up to date until cleanup
+    db.execute(text(
+        'UPDATE wallet SET amount = amount + 1 WHERE wallet_id = :wallet_id'
+    ), dict(wallet_id=TO_WALLET_ID))
+    db.commit()
+    amount_migration.revert(db)
+    assert amount_migration.stored_type(db) == 'numeric'
+    assert _amounts(db, 'wallet', 'amount') == [
+        (Decimal('0.51'),), (Decimal('9.75'),),
+    ]
+
+    amount_migration.cleanup(db)
+    assert 'amount_minor' not in dict(
+        db.execute(text('SELECT * FROM wallet LIMIT 1')).first()
+    )
+
+
+def test_minor_units_schemas(mocker) -> None:
+    mocker.patch.object(settings, 'AMOUNT_MINOR_UNITS', True)
+
+    request = WalletTransferRequest(
+        from_wallet_id=FROM_WALLET_ID,
+        to_wallet_id=TO_WALLET_ID,
+        amount='12.34',
+    )
+    assert request.amount == 1234
+
+    response = WalletResponse(wallet_id=FROM_WALLET_ID, amount=1234)
+    assert response.amount == Decimal('12.34')
+    # validated again the way FastAPI does, it isn't converted twice
+    assert WalletResponse(**response.dict()).amount == Decimal('12.34')
+    # sums of bigint columns come as numeric
+    response = WalletResponse(wallet_id=FROM_WALLET_ID, amount=Decimal(5))
+    assert response.amount == Decimal('0.05')
@@ -0,0 +1,118 @@
+import io
+import uuid
+from decimal import Decimal
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app.db import session
+from app.db.donation_import import import_donations
+from app.db.sharded_helper import shard_index
+from app.import_donations import read_csv
+from app.import_donations import read_ndjson
+from app.models import Transaction
+from app.models import Wallet
+
+WALLET_ID = '11111111-1111-1111-1111-111111111111'
+OTHER_WALLET_ID = '22222222-2222-2222-2222-222222222222'
+UNKNOWN_WALLET_ID = '33333333-3333-3333-3333-333333333333'
+
+
+def test_import_donations(db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=OTHER_WALLET_ID))
+    db.commit()
+
+    keys = [str(uuid.uuid4()) for _ in range(6)]
+    rows = [
+        (keys[0], WALLET_ID, '1.5'),
+        (keys[1], OTHER_WALLET_ID, '2'),
+        (keys[2], WALLET_ID, '3'),
+        (keys[0], WALLET_ID, '100'),  # the same key again
+        (keys[3], UNKNOWN_WALLET_ID, '4'),
+        (keys[4], WALLET_ID, '0.25'),
+    ]
+    file = io.StringIO(
+        'wallet_id,amount,idempotency_key\n'
+        + ''.join(
+            '{},{},{}\n'.format(wallet_id, amount, key)
+            for key, wallet_id, amount in rows
+        )
+    )
+    progress = []
+    totals = import_donations(
+        db, read_csv(file), chunk_size=4, progress=progress.append,
+    )
+    assert totals == dict(
+        rows=6, imported=4, duplicates=1, unknown_wallets=1, other_shards=0,
+    )
+    assert len(progress) == 2
+
+    db_wallets = dict(db.query(Wallet.wallet_id, Wallet.amount).all())
+    assert db_wallets[uuid.UUID(WALLET_ID)] == Decimal('14.75')
+    assert db_wallets[uuid.UUID(OTHER_WALLET_ID)] == 2
+
+    # the balance after each row, in file order
+    db_transactions = db.query(Transaction).order_by(Transaction.id).all()
+    assert [
+        (str(t.idempotency_key), t.to_wallet_amount) for t in db_transactions
+    ] == [
+        (keys[0], Decimal('11.5')),
+        (keys[1], Decimal('2')),
+        (keys[2], Decimal('14.5')),
+        (keys[4], Decimal('14.75')),
+    ]
+
+    # running it again changes nothing
+    file = io.StringIO(''.join(
+        '{{"idempotency_key": "{}", "wallet_id": "{}", "amount": {}}}\n'
+        .format(*row)
+        for row in rows
+    ))
+    totals = import_donations(db, read_ndjson(file))
+    assert totals == dict(
+        rows=6, imported=0, duplicates=5, unknown_wallets=1, other_shards=0,
+    )
+    assert db.query(Transaction).count() == 4
+
+
+def test_import_donations_invalid(db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.commit()
+
+    rows = [
+        (str(uuid.uuid4()), WALLET_ID, '1'),
+        (str(uuid.uuid4()), WALLET_ID, '0.001'),
+    ]
+    with pytest.raises(ValueError, match='amount of row 2'):
+        import_donations(db, iter(rows), chunk_size=1)
+    assert db.query(Transaction).count() == 1
+
+    with pytest.raises(ValueError, match='row 1 is not valid'):
+        import_donations(db, iter([('key', WALLET_ID, '1')]))
+
+
+def test_import_donations_shard(db: Session, mocker) -> None:
+    # db stands for the shard of WALLET_ID
+    mocker.patch.object(session, 'ShardSessionMakers', [None] * 8)
+    wallet_ids = [str(uuid.UUID(int=i)) for i in range(1, 100)]
+    shard = shard_index(uuid.UUID(WALLET_ID))
+    other_id = next(
+        i for i in wallet_ids if shard_index(uuid.UUID(i)) != shard
+    )
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.add(Wallet(wallet_id=other_id))
+    db.commit()
+
+    rows = [
+        (str(uuid.uuid4()), other_id, '1'),
+        (str(uuid.uuid4()), other_id, '1'),
+        (str(uuid.uuid4()), WALLET_ID, '2'),
+    ]
+    totals = import_donations(db, iter(rows), chunk_size=2, shard=shard)
+    assert totals == dict(
+        rows=1, imported=1, duplicates=0, unknown_wallets=0, other_shards=2,
+    )
+    assert db.query(Transaction.to_wallet_id).all() == [
+        (uuid.UUID(WALLET_ID),),
+    ]
@@ -0,0 +1,187 @@
+import datetime
+import uuid
+
+import pytest
+from sqlalchemy import exc
+from sqlalchemy.orm import Session
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from app.db import partitions
+from app.db import reconciliation
+from app.models import Transaction
+from app.models import TransactionKey
+from app.models import Wallet
+
+WALLET_ID = '11111111-1111-1111-1111-111111111111'
+
+
+def _transaction(created_at: datetime.datetime, **kwargs) -> Transaction:
+    return Transaction(
+        idempotency_key=kwargs.get('idempotency_key', uuid.uuid4()),
+        amount=1,
+        to_wallet_id=WALLET_ID,
+        to_wallet_amount=1,
+        created_at=created_at,
+    )
+
+
+def test_idempotency_key_across_partitions(
+        client: TestClient, db: Session,
+) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.commit()
+
+    # the key of an old transaction is still replayed
+    old_month = datetime.datetime.utcnow().replace(day=1)
+    old_month -= datetime.timedelta(days=1)
+    partitions.create_partitions(db, 0, since=old_month.date())
+    idempotency_key = uuid.uuid4()
+    db.add(_transaction(old_month, **locals()))
+    db.commit()
+
+    request = {'wallet_id': WALLET_ID, 'amount': 5}
+    response = client.post(
+        'v1/wallet/donate',
+        json=request,
+        headers={'Idempotency-Key': str(idempotency_key)},
+    )
+    assert response.json() == {'wallet_id': WALLET_ID, 'amount': 1}
+
+    # and can't be used again in the current partition
+    db.add(_transaction(datetime.datetime.utcnow(), **locals()))
+    with pytest.raises(exc.IntegrityError):
+        db.commit()
+    db.rollback()
+
+    assert db.query(TransactionKey).count() == 1
+
+
+def test_create_partitions(db: Session) -> None:
+    partitions.create_partitions(db, 1)
+    assert partitions.create_partitions(db, 1) == []
+
+    month = datetime.datetime.utcnow().strftime('transaction_y%Ym%m')
+    assert month in partitions.list_partitions(db)
+
+    # and backdated ones, with no default partition to take the rows
+    last_month = datetime.datetime.utcnow().replace(day=1)
+    last_month -= datetime.timedelta(days=1)
+    partitions.create_partitions(db, 0, since=last_month.date())
+    assert last_month.strftime('transaction_y%Ym%m') in (
+        partitions.list_partitions(db)
+    )
+    with pytest.raises(exc.DBAPIError):
+        db.add(_transaction(datetime.datetime(2019, 11, 30)))
+        db.commit()
+    db.rollback()
+
+
+def test_detach_partitions(db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.commit()
+    for month in (1, 2):
+        db.execute(
+            'CREATE TABLE transaction_y2020m0{0} PARTITION OF transaction'
+            " FOR VALUES FROM ('2020-0{0}-01') TO ('2020-0{1}-01')".format(
+                month, month + 1,
+            )
+        )
+    db.add(_transaction(datetime.datetime(2020, 1, 10)))
+    db.commit()
+
+    # the rows have to be reconciled first
+    with pytest.raises(RuntimeError):
+        partitions.detach_partitions(db, datetime.date(2020, 2, 1))
+    reconciliation.reconcile(db, lag=0)
+
+    detached = partitions.detach_partitions(db, datetime.date(2020, 2, 1))
+    assert detached == ['transaction_y2020m01']
+    assert db.query(Transaction).count() == 0
+    assert db.execute('SELECT count(*) FROM transaction_y2020m01').scalar()
+    db.execute('DROP TABLE transaction_y2020m01')
+    db.commit()
+
+    detached = partitions.detach_partitions(
+        db, datetime.date(2020, 3, 1), drop=True,
+    )
+    assert detached == ['transaction_y2020m02']
+    assert 'transaction_y2020m02' not in partitions.list_partitions(db)
+
+
+def test_detach_partitions_within_retention(db: Session, mocker) -> None:
+    mocker.patch.object(settings, 'IDEMPOTENCY_KEY_RETENTION_DAYS', 90)
+    month = datetime.datetime.utcnow().date().replace(day=1)
+    with pytest.raises(ValueError):
+        partitions.detach_partitions(db, month)
+
+
+def test_detached_key_replayed(client: TestClient, db: Session) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.commit()
+    db.execute(
+        'CREATE TABLE transaction_y2020m01 PARTITION OF transaction'
+        " FOR VALUES FROM ('2020-01-01') TO ('2020-02-01')"
+    )
+    idempotency_key = uuid.uuid4()
+    db.add(_transaction(datetime.datetime(2020, 1, 10), **locals()))
+    db.commit()
+    reconciliation.reconcile(db, lag=0)
+    partitions.detach_partitions(db, datetime.date(2020, 2, 1), drop=True)
+
+    # the key is kept until pruned, its transaction is gone
+    request = {'wallet_id': WALLET_ID, 'amount': 5}
+    response = client.post(
+        'v1/wallet/donate',
+        json=request,
+        headers={'Idempotency-Key': str(idempotency_key)},
+    )
+    assert response.status_code == 410
+    assert db.query(Transaction).count() == 0
+
+
+def test_detach_partitions_concurrently(db: Session) -> None:
+    assert partitions.detaches_concurrently(db)
+    db.add(Wallet(wallet_id=WALLET_ID))
+    db.commit()
+    db.execute(
+        'CREATE TABLE transaction_y2020m01 PARTITION OF transaction'
+        " FOR VALUES FROM ('2020-01-01') TO ('2020-02-01')"
+    )
+    db.add(_transaction(datetime.datetime(2020, 1, 10)))
+    db.commit()
+    reconciliation.reconcile(db, lag=0)
+
+    detached = partitions.detach_partitions(
+        db, datetime.date(2020, 2, 1), drop=True,
+    )
+    assert detached == ['transaction_y2020m01']
+    assert db.query(Transaction).count() == 0
+    assert 'transaction_y2020m01' not in partitions.list_partitions(db)
+
+    # with a default partition, the plain detach
+    db.execute(
+        'CREATE TABLE transaction_other PARTITION OF transaction DEFAULT'
+    )
+    db.commit()
+    try:
+        assert not partitions.detaches_concurrently(db)
+    finally:
+        db.execute('DROP TABLE transaction_other')
+        db.commit()
+
+
+def test_prune_keys(db: Session) -> None:
+    now = datetime.datetime.utcnow()
+    for days in (1, 100, 200):
+        db.add(TransactionKey(
+            idempotency_key=uuid.uuid4(),
+            created_at=now - datetime.timedelta(days=days),
+        ))
+    db.commit()
+
+    deleted = partitions.prune_keys(
+        db, now - datetime.timedelta(days=90), batch_size=1,
+    )
+    assert deleted == 2
+    assert db.query(TransactionKey).count() == 1
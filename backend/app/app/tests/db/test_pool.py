@@ -0,0 +1,78 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy import exc
+from sqlalchemy.orm import Session
+
+from app.core import stats
+from app.core.config import settings
+from app.db.pool import HealthChecker
+from app.db.pool import engine_options
+
+
+def test_pool_stats(mocker) -> None:
+    mocker.patch.object(settings, 'DB_POOL_SIZE', 1)
+    mocker.patch.object(settings, 'DB_POOL_MAX_OVERFLOW', 0)
+    mocker.patch.object(settings, 'DB_POOL_TIMEOUT', 0.01)
+    mocker.patch.object(settings, 'DB_STATEMENT_TIMEOUT', 1500)
+    engine = create_engine(
+        settings.SQLALCHEMY_DATABASE_URI, **engine_options('test_stats'),
+    )
+    try:
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql(
+                'SHOW statement_timeout',
+            ).scalar() == '1500ms'
+
+            snapshot = stats.snapshot()['pool_test_stats']
+            assert snapshot['checkouts'] == 1
+            assert snapshot['checked_out'] == 1
+            assert snapshot['overflow'] == 0
+
+            with pytest.raises(exc.TimeoutError):
+                engine.connect()
+
+        snapshot = stats.snapshot()['pool_test_stats']
+        assert snapshot['checkouts'] == 1
+        assert snapshot['checkout_timeouts'] == 1
+        assert snapshot['checked_in'] == 1
+        assert snapshot['checked_out'] == 0
+        assert sum(
+            value for name, value in snapshot.items()
+            if name.startswith('wait_')
+            and name != 'wait_us_total'
+        ) == 2
+        assert snapshot['wait_us_total'] >= 10000
+    finally:
+        engine.dispose()
+
+
+def test_health_check(db: Session) -> None:
+    engine = create_engine(
+        settings.SQLALCHEMY_DATABASE_URI, **engine_options('test_health'),
+    )
+    try:
+        # two idle connections, then the server closes both of them
+        connections = [engine.connect(), engine.connect()]
+        pids = [
+            connection.exec_driver_sql('SELECT pg_backend_pid()').scalar()
+            for connection in connections
+        ]
+        for connection in connections:
+            connection.close()
+        for pid in pids:
+            db.execute('SELECT pg_terminate_backend(:pid)', dict(pid=pid))
+        db.commit()
+
+        health_checker = HealthChecker([engine], interval=1)
+        health_checker.check()
+        assert stats.snapshot()['pool_test_health'] == dict(
+            stats.snapshot()['pool_test_health'], health_check_failures=1,
+        )
+
+        # the other dead connection has been invalidated too
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql('SELECT 1').scalar() == 1
+        health_checker.check()
+        assert stats.snapshot()['pool_test_health']['health_checks'] == 1
+    finally:
+        engine.dispose()
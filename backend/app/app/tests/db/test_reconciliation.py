@@ -0,0 +1,159 @@
+import datetime
+import uuid
+from decimal import Decimal
+
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db import partitions
+from app.db import reconciliation
+from app.db.session import DBSessionMaker
+from app.models import ReconciliationBalance
+from app.models import Transaction
+from app.models import Wallet
+
+WALLET_ID = '11111111-1111-1111-1111-111111111111'
+OTHER_WALLET_ID = 'eeeeeeee-eeee-eeee-eeee-eeeeeeeeeeee'
+
+
+def _add_ledger(db: Session, **kwargs) -> None:
+    db.add(Wallet(wallet_id=WALLET_ID, amount=Decimal('7.5')))
+    db.add(Wallet(wallet_id=OTHER_WALLET_ID, amount=Decimal('2.5')))
+    db.commit()
+    db.add_all([
+        Transaction(
+            idempotency_key=uuid.uuid4(),
+            amount=10,
+            to_wallet_id=WALLET_ID,
+            to_wallet_amount=10,
+            **kwargs,
+        ),
+        Transaction(
+            idempotency_key=uuid.uuid4(),
+            amount=Decimal('2.5'),
+            from_wallet_id=WALLET_ID,
+            from_wallet_amount=Decimal('7.5'),
+            to_wallet_id=OTHER_WALLET_ID,
+            to_wallet_amount=Decimal('2.5'),
+            **kwargs,
+        ),
+    ])
+    db.commit()
+
+
+def _balances(db: Session):
+    return dict(
+        db.query(
+            ReconciliationBalance.wallet_id, ReconciliationBalance.amount,
+        ).all()
+    )
+
+
+def test_reconcile(db: Session) -> None:
+    _add_ledger(db)
+
+    # rows younger than the lag are left for the next run
+    assert reconciliation.reconcile(db, lag=3600) == 0
+    assert reconciliation.mismatches(db) == []
+
+    progress = []
+    assert reconciliation.reconcile(
+        db, chunk_size=1, lag=0, progress=lambda *args: progress.append(args),
+    ) == 2
+    assert [rows for rows, _ in progress] == [1, 2]
+    assert _balances(db) == {
+        uuid.UUID(WALLET_ID): Decimal('7.5'),
+        uuid.UUID(OTHER_WALLET_ID): Decimal('2.5'),
+    }
+    assert reconciliation.reconcile(db, lag=0) == 0
+    assert reconciliation.mismatches(db) == []
+
+    db.query(Wallet).filter(Wallet.wallet_id == WALLET_ID).update(
+        dict(amount=Decimal('8.5')),
+    )
+    db.commit()
+    assert reconciliation.mismatches(db) == [
+        reconciliation.Mismatch(
+            uuid.UUID(WALLET_ID), Decimal('8.5'), Decimal('7.5'),
+        ),
+    ]
+
+
+def test_reconcile_in_flight(db: Session, mocker) -> None:
+    mocker.patch.object(settings, 'RECONCILIATION_WAIT', 0.2)
+    db.add(Wallet(wallet_id=WALLET_ID, amount=3))
+    db.commit()
+
+    def donation(amount):
+        return Transaction(
+            idempotency_key=uuid.uuid4(),
+            amount=amount,
+            to_wallet_id=WALLET_ID,
+            to_wallet_amount=amount,
+        )
+
+    # a smaller id is committed after a greater one
+    other_db = DBSessionMaker()
+    try:
+        other_db.add(donation(1))
+        other_db.flush()
+        db.add(donation(2))
+        db.commit()
+        assert reconciliation.reconcile(db, lag=0) == 0
+
+        other_db.commit()
+    finally:
+        other_db.close()
+    assert reconciliation.reconcile(db, lag=0) == 2
+    assert _balances(db) == {uuid.UUID(WALLET_ID): Decimal(3)}
+    assert reconciliation.mismatches(db) == []
+
+
+def test_rebuild(db: Session) -> None:
+    _add_ledger(db)
+    db.add(ReconciliationBalance(wallet_id=WALLET_ID, amount=100))
+    db.commit()
+
+    last_transaction_id = reconciliation.rebuild(db, lag=0)
+    assert last_transaction_id == db.query(Transaction.id).order_by(
+        Transaction.id.desc(),
+    ).limit(1).scalar()
+    balances = _balances(db)
+    assert balances == {
+        uuid.UUID(WALLET_ID): Decimal('7.5'),
+        uuid.UUID(OTHER_WALLET_ID): Decimal('2.5'),
+    }
+    assert reconciliation.mismatches(db) == []
+
+    assert reconciliation.rebuild(db, processes=2, lag=0) == (
+        last_transaction_id
+    )
+    assert _balances(db) == balances
+    assert reconciliation.reconcile(db, lag=0) == 0
+
+
+def test_rebuild_after_detach(db: Session) -> None:
+    db.execute(
+        'CREATE TABLE transaction_y2020m01 PARTITION OF transaction'
+        " FOR VALUES FROM ('2020-01-01') TO ('2020-02-01')"
+    )
+    _add_ledger(db, created_at=datetime.datetime(2020, 1, 10))
+    db.add(Transaction(
+        idempotency_key=uuid.uuid4(),
+        amount=1,
+        to_wallet_id=WALLET_ID,
+        to_wallet_amount=Decimal('8.5'),
+    ))
+    db.query(Wallet).filter(Wallet.wallet_id == WALLET_ID).update(
+        dict(amount=Decimal('8.5')),
+    )
+    db.commit()
+    assert reconciliation.reconcile(db, lag=0) == 3
+    balances = _balances(db)
+
+    # the old month is summed up from its archive
+    partitions.detach_partitions(db, datetime.date(2020, 2, 1), drop=True)
+    assert db.query(Transaction).count() == 1
+    reconciliation.rebuild(db, lag=0)
+    assert _balances(db) == balances
+    assert reconciliation.mismatches(db) == []
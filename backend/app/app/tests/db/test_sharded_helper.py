@@ -0,0 +1,228 @@
+import datetime
+import os
+import subprocess
+import sys
+import uuid
+from decimal import Decimal
+from typing import Generator
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+import app
+from app.api.endpoints import wallets
+from app.core.config import settings
+from app.db import session
+from app.db.base_class import Base
+from app.db.idempotency import recent_keys
+from app.db.session import engine
+from app.db.sharded_helper import ShardedDBHelper
+from app.db.sharded_helper import credit_key
+from app.db.sharded_helper import shard_index
+from app.models import ShardTransfer
+from app.models import Transaction
+from app.models import Wallet
+
+SHARDS = 2
+
+
+@pytest.fixture(scope='module')
+def shard_engines() -> Generator:
+    engines = []
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT',
+    ) as connection:
+        for shard in range(SHARDS):
+            url = make_url(settings.SQLALCHEMY_DATABASE_URI).set(
+                database='{}_shard_{}'.format(settings.POSTGRES_DB, shard),
+            )
+            if not connection.execute(
+                text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                dict(name=url.database),
+            ).first():
+                connection.execute(text(
+                    'CREATE DATABASE {}'.format(url.database)
+                ))
+            subprocess.run(
+                [
+                    sys.executable, '-m', 'alembic',
+                    '-x', 'url={}'.format(url), 'upgrade', 'head',
+                ],
+                cwd=os.path.dirname(os.path.dirname(app.__file__)),
+                check=True,
+            )
+            engines.append(create_engine(url))
+    yield engines
+    for shard_engine in engines:
+        shard_engine.dispose()
+
+
+@pytest.fixture()
+def shards(shard_engines: List, db, mocker) -> Generator:
+    mocker.patch.object(session, 'ShardSessionMakers', [
+        sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+        for shard_engine in shard_engines
+    ])
+    mocker.patch.object(wallets, 'helper', ShardedDBHelper)
+    yield session.ShardSessionMakers
+    for shard_engine in shard_engines:
+        with shard_engine.begin() as connection:
+            connection.execute(text(
+                'TRUNCATE {} RESTART IDENTITY'.format(','.join(
+                    table.name for table in Base.metadata.sorted_tables
+                ))
+            ))
+
+
+def _create(client: TestClient, shard: int, amount: int) -> str:
+    # a key of the shard
+    while True:
+        key = uuid.uuid4()
+        if shard_index(key) == shard:
+            break
+    response = client.post(
+        'v1/wallet/create', headers={'Idempotency-Key': str(key)},
+    )
+    assert response.status_code == 200
+    wallet_id = response.json()['wallet_id']
+    assert shard_index(uuid.UUID(wallet_id)) == shard
+    if amount:
+        response = client.post(
+            'v1/wallet/donate',
+            json={'wallet_id': wallet_id, 'amount': amount},
+            headers={'Idempotency-Key': str(uuid.uuid4())},
+        )
+        assert response.status_code == 200
+    return wallet_id
+
+
+def _transfer(client: TestClient, key: str, from_id: str, to_id: str, amount):
+    return client.post(
+        'v1/wallet/transfer',
+        json={
+            'from_wallet_id': from_id,
+            'to_wallet_id': to_id,
+            'amount': amount,
+        },
+        headers={'Idempotency-Key': key},
+    )
+
+
+def _balance(client: TestClient, wallet_id: str) -> float:
+    return client.post(
+        'v1/wallet/get', json={'wallet_id': wallet_id},
+    ).json()['amount']
+
+
+def test_sharded_transfer(client: TestClient, shards: List) -> None:
+    first_id = _create(client, 0, 10)
+    second_id = _create(client, 1, 0)
+    third_id = _create(client, 0, 0)
+
+    # across the shards
+    key = str(uuid.uuid4())
+    response = _transfer(client, key, first_id, second_id, 4)
+    assert response.status_code == 200
+    assert response.json() == {'wallet_id': first_id, 'amount': 6}
+    assert _transfer(client, key, first_id, second_id, 4).json() == {
+        'wallet_id': first_id, 'amount': 6,
+    }
+    # within one
+    response = _transfer(client, str(uuid.uuid4()), first_id, third_id, 1)
+    assert response.json() == {'wallet_id': first_id, 'amount': 5}
+
+    assert [_balance(client, i) for i in (first_id, second_id, third_id)] == [
+        5, 4, 1,
+    ]
+    # each ledger names the wallets of its shard only
+    with shards[1]() as db:
+        credit = db.query(Transaction).filter(
+            Transaction.idempotency_key == credit_key(uuid.UUID(key)),
+        ).one()
+        assert (credit.from_wallet_id, credit.to_wallet_amount) == (
+            None, Decimal(4),
+        )
+    with shards[0]() as db:
+        transfer = db.query(ShardTransfer).one()
+        assert transfer.credited_at is not None
+
+    response = _transfer(client, str(uuid.uuid4()), second_id, first_id, 5)
+    assert response.status_code == 400
+    response = _transfer(
+        client, str(uuid.uuid4()), first_id, str(uuid.uuid4()), 1,
+    )
+    assert response.status_code == 404
+    assert _balance(client, first_id) == 5
+
+
+def test_sharded_transfer_settled_later(
+        client: TestClient,
+        shards: List,
+        mocker,
+) -> None:
+    first_id = _create(client, 0, 10)
+    second_id = _create(client, 1, 0)
+    settle = mocker.patch.object(
+        ShardedDBHelper, '_settle', side_effect=ConnectionError,
+    )
+    response = _transfer(client, str(uuid.uuid4()), first_id, second_id, 3)
+    assert response.status_code == 200
+    assert response.json()['amount'] == 7
+    assert _balance(client, second_id) == 0
+    mocker.stop(settle)
+
+    later = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+    with shards[0]() as db:
+        assert ShardedDBHelper.settle_transfers(db, later) == 1
+        assert ShardedDBHelper.settle_transfers(db, later) == 0
+    assert _balance(client, second_id) == 3
+
+    # a credit made again is made once
+    with shards[0]() as from_db, shards[1]() as to_db:
+        ShardedDBHelper._credit(to_db, from_db.query(ShardTransfer).one())
+        assert to_db.query(Wallet.amount).filter(
+            Wallet.wallet_id == second_id,
+        ).scalar() == 3
+
+
+def test_sharded_transfer_keys(client: TestClient, shards: List) -> None:
+    first_id = _create(client, 0, 10)
+    second_id = _create(client, 1, 0)
+
+    # a key used on the shard of the credit is not taken
+    key = str(uuid.uuid4())
+    response = client.post(
+        'v1/wallet/donate',
+        json={'wallet_id': second_id, 'amount': 1},
+        headers={'Idempotency-Key': key},
+    )
+    assert response.status_code == 200
+    # the transfer comes to another worker
+    recent_keys.clear()
+    response = _transfer(client, key, first_id, second_id, 4)
+    assert response.status_code == 400
+    assert response.json() == {
+        'detail': 'idempotency key is used by another request',
+    }
+    assert [_balance(client, i) for i in (first_id, second_id)] == [10, 1]
+
+    # nor a row of another request under the key of the credit
+    key = str(uuid.uuid4())
+    response = client.post(
+        'v1/wallet/donate',
+        json={'wallet_id': second_id, 'amount': 1},
+        headers={'Idempotency-Key': str(credit_key(uuid.UUID(key)))},
+    )
+    assert response.status_code == 200
+    response = _transfer(client, key, first_id, second_id, 4)
+    assert response.status_code == 200
+    assert [_balance(client, i) for i in (first_id, second_id)] == [6, 2]
+    later = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+    with shards[0]() as db:
+        assert ShardedDBHelper.settle_transfers(db, later) == 0
+        assert db.query(ShardTransfer.credited_at).scalar() is None
@@ -0,0 +1,100 @@
+import asyncio
+import uuid
+from decimal import Decimal
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.api.endpoints import wallet_changes as endpoint
+from app.core.config import settings
+from app.db import wallet_changes as changes_module
+from app.db.wallet_changes import wallet_changes
+from app.models import Transaction
+from app.models import Wallet
+
+FROM_WALLET_ID = uuid.UUID('11111111-1111-1111-1111-111111111111')
+TO_WALLET_ID = uuid.UUID('22222222-2222-2222-2222-222222222222')
+
+
+def _transfer(db: Session, *amounts: int) -> None:
+    # as a worker with WALLET_CHANGES_ENABLED writes it, in one commit
+    db.execute(text("SET paymarket.wallet_changes = 'on'"))
+    for amount in amounts:
+        db.add(Transaction(
+            idempotency_key=uuid.uuid4(),
+            amount=amount,
+            from_wallet_id=FROM_WALLET_ID,
+            from_wallet_amount=10 - amount,
+            to_wallet_id=TO_WALLET_ID,
+            to_wallet_amount=amount,
+        ))
+    db.commit()
+    db.execute(text('RESET paymarket.wallet_changes'))
+
+
+def test_wallet_changes(db: Session, mocker) -> None:
+    mocker.patch.object(changes_module, 'RECONNECT_DELAY', 0)
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=10))
+    db.add(Wallet(wallet_id=TO_WALLET_ID, amount=0))
+    db.commit()
+
+    async def scenario() -> None:
+        await wallet_changes.start()
+        subscription = wallet_changes.subscribe([TO_WALLET_ID])
+        try:
+            # delivered together, not to depend on when they are read
+            _transfer(db, 1, 3)
+            # the subscriber is told the last balance only
+            assert await subscription.changes(5) == {TO_WALLET_ID: 3}
+
+            # the listener connection is lost, the subscriber is told
+            db.execute(text(
+                '''
+                SELECT pg_terminate_backend(pid)
+                FROM pg_stat_activity
+                WHERE query = 'LISTEN wallet_changes'
+                '''
+            ))
+            db.commit()
+            assert await subscription.changes(5) == {}
+            assert subscription.lost
+        finally:
+            wallet_changes.unsubscribe(subscription)
+
+        # and listening again
+        await asyncio.sleep(0.5)
+        subscription = wallet_changes.subscribe([TO_WALLET_ID])
+        _transfer(db, 5)
+        assert await subscription.changes(5) == {TO_WALLET_ID: 5}
+        wallet_changes.unsubscribe(subscription)
+        assert not wallet_changes.subscriptions
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        wallet_changes.stop()
+        loop.close()
+
+
+def test_wallet_changes_endpoint_errors(db: Session, mocker) -> None:
+    mocker.patch.object(settings, 'WALLET_CHANGES_MAX_WALLETS', 2)
+    app = FastAPI()
+    app.include_router(endpoint.router)
+    client = TestClient(app)
+    db.add(Wallet(wallet_id=FROM_WALLET_ID, amount=Decimal('1.5')))
+    db.commit()
+
+    response = client.get(
+        'v1/wallet/changes',
+        params={'wallet_id': [str(FROM_WALLET_ID), str(TO_WALLET_ID)]},
+    )
+    assert response.status_code == 404
+    assert not wallet_changes.subscriptions
+
+    response = client.get(
+        'v1/wallet/changes', params={'wallet_id': [str(FROM_WALLET_ID)] * 3},
+    )
+    assert response.status_code == 400
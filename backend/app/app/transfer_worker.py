@@ -0,0 +1,71 @@
+"""Apply the transfers accepted by /v1/wallet/transfer/async.
+
+Runs until stopped, any number of them side by side:
+
+    python /app/app/transfer_worker.py --threads 4 --batch-size 500
+
+Each thread claims its own batches, see app/db/transfer_queue.py.
+"""
+import argparse
+import logging
+import threading
+import time
+
+from app.core.config import settings
+from app.db import transfer_queue
+from app.db.session import DBSessionMaker
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def work(batch_size: int, poll_interval: float) -> None:
+    db = DBSessionMaker()
+    try:
+        while True:
+            try:
+                processed = transfer_queue.process(db, batch_size)
+            except Exception:
+                logger.exception('Processing transfers failed')
+                db.rollback()
+                processed = 0
+            # a full batch means there may be more right away
+            if processed < batch_size:
+                time.sleep(poll_interval)
+    finally:
+        db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--threads', type=int, default=settings.TRANSFER_QUEUE_WORKERS,
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=settings.TRANSFER_QUEUE_BATCH_SIZE,
+    )
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=settings.TRANSFER_QUEUE_POLL_INTERVAL,
+        help='seconds to wait when the queue is empty',
+    )
+    args = parser.parse_args()
+
+    threads = [
+        threading.Thread(
+            target=work,
+            args=(args.batch_size, args.poll_interval),
+            daemon=True,
+        )
+        for _ in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info('Started %s threads', len(threads))
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()
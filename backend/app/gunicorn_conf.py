@@ -0,0 +1,15 @@
+# The settings of the base image, plus the cleanup of the metrics of
+# the workers that have exited, see app/core/metrics.py
+import runpy
+
+from prometheus_client import multiprocess
+
+globals().update(
+    (name, value)
+    for name, value in runpy.run_path('/gunicorn_conf.py').items()
+    if not name.startswith('__')
+)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
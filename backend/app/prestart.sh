@@ -1,7 +1,20 @@
 #! /usr/bin/env bash
 
+# Forget the metrics of the previous run, before any
+# script writes its own there
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 # Let the DB start
 python /app/app/backend_pre_start.py
 
-# Run migrations
+# Run migrations, of every shard too
 alembic upgrade head
+for url in $(python -c 'from app.core.config import settings; print(*settings.SQLALCHEMY_SHARD_URIS)'); do
+    alembic -x url="$url" upgrade head
+done
+
+# Make sure the next months have their transaction partitions
+python /app/app/maintenance.py create-partitions